@@ -4,17 +4,60 @@
 # and fixes all DNS_PROBE_FINISHED_NXDOMAIN errors.
 
 import os
+import asyncio
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from urllib.parse import quote_plus, urlencode
 import re
 import csv
-from concurrent.futures import ThreadPoolExecutor
+import math
+import unicodedata
+import gzip
+import hashlib
+import hmac
+import base64
+import json
+import time
+import random
+import threading
+import queue
+import sqlite3
+import mmap
+import shutil
+import tempfile
+import itertools
+import contextvars
+import functools
+import inspect
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 
-from flask import Flask, request, jsonify, render_template_string
+import click
+from flask import Flask, Response, request, jsonify, render_template_string, stream_with_context
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from requests.structures import CaseInsensitiveDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 # --- Initial Configuration ---
 app = Flask(__name__)
@@ -33,7 +76,156 @@ BOOKING_HOTEL_LIMIT = 20
 TRIPADVISOR_HOTEL_LIMIT = 15
 URL_REGEX = re.compile(r'\d+')
 
+# --- Upstream HTTP Settings ---
+# Base URLs can point at a local stand-in (api-testing/fake_rapidapi.py) for benchmarks.
+UPSTREAM_BASE_URLS = {
+    BOOKING_API_HOST: os.environ.get('BOOKING_API_BASE_URL', f"https://{BOOKING_API_HOST}").rstrip('/'),
+    TRIPADVISOR_API_HOST: os.environ.get('TRIPADVISOR_API_BASE_URL', f"https://{TRIPADVISOR_API_HOST}").rstrip('/'),
+}
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 20))
+UPSTREAM_ASYNC = os.environ.get('UPSTREAM_ASYNC', '1') == '1'  # fan-out searches on one event loop; needs httpx
+UPSTREAM_ASYNC_MAX_IN_FLIGHT = int(os.environ.get('UPSTREAM_ASYNC_MAX_IN_FLIGHT', 512))
+UPSTREAM_ASYNC_MAX_CONNECTIONS = int(os.environ.get('UPSTREAM_ASYNC_MAX_CONNECTIONS', 100))  # per host
+UPSTREAM_MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', 2))
+UPSTREAM_BACKOFF_FACTOR = float(os.environ.get('UPSTREAM_BACKOFF_FACTOR', 0.3))
+UPSTREAM_BACKOFF_MAX_SECONDS = float(os.environ.get('UPSTREAM_BACKOFF_MAX_SECONDS', 4))
+UPSTREAM_RETRY_STATUSES = (429, 500, 502, 503, 504)
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+UPSTREAM_READ_TIMEOUTS = {
+    'booking-autocomplete': float(os.environ.get('BOOKING_AUTOCOMPLETE_READ_TIMEOUT', 10)),
+    'booking-search': float(os.environ.get('BOOKING_SEARCH_READ_TIMEOUT', 15)),
+    'tripadvisor-search': float(os.environ.get('TRIPADVISOR_SEARCH_READ_TIMEOUT', 15)),
+}
+
+# --- Booking.com Location Index Settings ---
+LOCATION_INDEX_FILE = os.environ.get('BOOKING_LOCATION_INDEX_FILE', 'booking_location_ids.json')
+LOCATION_INDEX_REFRESH_SECONDS = int(os.environ.get('BOOKING_LOCATION_INDEX_REFRESH_SECONDS', 7 * 24 * 3600))
+LOCATION_INDEX_NEGATIVE_TTL_SECONDS = int(os.environ.get('BOOKING_LOCATION_INDEX_NEGATIVE_TTL_SECONDS', 12 * 3600))
+LOCATION_INDEX_LOOKUP_PAUSE_SECONDS = 0.5
+LOCATION_INDEX_SAVE_DELAY_SECONDS = float(os.environ.get('BOOKING_LOCATION_INDEX_SAVE_DELAY_SECONDS', 30))
+
+# --- City Catalog Settings ---
+CITIES_FILE = os.environ.get('CITIES_FILE', 'cities.csv')
+CITY_CATALOG_POLL_SECONDS = float(os.environ.get('CITY_CATALOG_POLL_SECONDS', 5))
+CITY_SUGGEST_MAX_RESULTS = 20
+CITY_TRIE_KEYS_PER_NODE = 20
+
+# --- Search Result Cache Settings ---
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', 2000))
+SEARCH_CACHE_TTLS = {'booking': int(os.environ.get('BOOKING_CACHE_TTL_SECONDS', 600)), 'tripadvisor': int(os.environ.get('TRIPADVISOR_CACHE_TTL_SECONDS', 900))}
+SEARCH_CACHE_STALE_SECONDS = int(os.environ.get('SEARCH_CACHE_STALE_SECONDS', 300))
+SEARCH_FLIGHT_MAX_WAIT_SECONDS = float(os.environ.get('SEARCH_FLIGHT_MAX_WAIT_SECONDS', 30))  # bound on joining another caller's fetch
+
+# --- Cross-source Merge Settings ---
+MERGE_CELL_DEGREES = float(os.environ.get('MERGE_CELL_DEGREES', 0.002))  # ~220 m of latitude
+MERGE_NAME_SIMILARITY = float(os.environ.get('MERGE_NAME_SIMILARITY', 0.6))
+
+# --- Spatial Index Settings ---
+HOTEL_INDEX_CELL_DEGREES = 0.01  # ~1.1 km of latitude
+CITY_INDEX_CELL_DEGREES = 1.0
+SPATIAL_MAX_RADIUS_KM = float(os.environ.get('SPATIAL_MAX_RADIUS_KM', 50))
+SPATIAL_MAX_RESULTS = int(os.environ.get('SPATIAL_MAX_RESULTS', 500))
+VIEWPORT_MAX_FILL_CITIES = int(os.environ.get('VIEWPORT_MAX_FILL_CITIES', 5))
+EARTH_RADIUS_KM = 6371.0
+NAME_STOPWORDS = frozenset(['hotel', 'hotels', 'hostel', 'the', 'by', 'and', 'a', 'an', 'de', 'la', 'le', 'el', 'di', 'das', 'der', 'du', 'suites', 'apartments', 'resort', 'spa', 'inn'])
+NAME_TOKEN_REGEX = re.compile(r'[a-z0-9]+')
+
+# --- Response Encoding Settings ---
+COMPRESSION_MIN_BYTES = 1024
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 5
+COMPRESSED_BODY_CACHE_SIZE = 256
+HOTEL_RESPONSE_MAX_AGE = int(os.environ.get('HOTEL_RESPONSE_MAX_AGE', 60))
+CITIES_RESPONSE_MAX_AGE = int(os.environ.get('CITIES_RESPONSE_MAX_AGE', 3600))
+
+# --- Upstream Concurrency & Quota Settings ---
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get('UPSTREAM_MAX_CONCURRENCY', 16))
+UPSTREAM_MAX_QUEUED = int(os.environ.get('UPSTREAM_MAX_QUEUED', 64))
+UPSTREAM_QUEUE_MAX_WAIT_SECONDS = float(os.environ.get('UPSTREAM_QUEUE_MAX_WAIT_SECONDS', 3))
+UPSTREAM_RATE_LIMITS = {  # host -> (requests per second, burst)
+    BOOKING_API_HOST: (float(os.environ.get('BOOKING_RATE_PER_SECOND', 5)), int(os.environ.get('BOOKING_RATE_BURST', 10))),
+    TRIPADVISOR_API_HOST: (float(os.environ.get('TRIPADVISOR_RATE_PER_SECOND', 5)), int(os.environ.get('TRIPADVISOR_RATE_BURST', 10))),
+}
+UPSTREAM_DAILY_QUOTAS = {  # host -> calls per UTC day, 0 = unlimited
+    BOOKING_API_HOST: int(os.environ.get('BOOKING_DAILY_QUOTA', 0)),
+    TRIPADVISOR_API_HOST: int(os.environ.get('TRIPADVISOR_DAILY_QUOTA', 0)),
+}
+
+# --- Paginated Search Settings ---
+SEARCH_MAX_PAGES = int(os.environ.get('SEARCH_MAX_PAGES', 3))
+SEARCH_PAGE_SIZE_DEFAULT = 20
+SEARCH_PAGE_SIZE_MAX = 100
+RESULT_SET_CACHE_MAX_ENTRIES = 500
+RESULT_SET_TTL_SECONDS = min(SEARCH_CACHE_TTLS.values())
+SEARCH_SORTS = ('rating', 'price', '-price', 'distance')
+# Signs pagination cursors; every worker must share it, so it defaults to one derived from the API key.
+CURSOR_SECRET = (os.environ.get('CURSOR_SECRET') or hashlib.sha256(f'cursor:{RAPIDAPI_KEY}'.encode('utf-8')).hexdigest()).encode('utf-8')
+
+# --- Circuit Breaker & Hedging Settings ---
+CIRCUIT_WINDOW = int(os.environ.get('CIRCUIT_WINDOW', 20))
+CIRCUIT_MIN_CALLS = int(os.environ.get('CIRCUIT_MIN_CALLS', 8))
+CIRCUIT_FAILURE_RATIO = float(os.environ.get('CIRCUIT_FAILURE_RATIO', 0.5))
+CIRCUIT_SLOW_CALL_SECONDS = float(os.environ.get('CIRCUIT_SLOW_CALL_SECONDS', 6))
+CIRCUIT_SLOW_RATIO = float(os.environ.get('CIRCUIT_SLOW_RATIO', 0.8))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', 30))
+UPSTREAM_HEDGING = os.environ.get('UPSTREAM_HEDGING', '0') == '1'
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY_SECONDS = float(os.environ.get('HEDGE_MIN_DELAY_SECONDS', 0.05))
+HEDGE_MAX_RATIO = float(os.environ.get('HEDGE_MAX_RATIO', 0.1))
+LATENCY_SAMPLE_SIZE = 200
+
+# --- Shared Cache Settings ---
+SHARED_CACHE_DB = os.environ.get('SHARED_CACHE_DB', 'actionly_shared_cache.sqlite3')
+SHARED_CACHE_LEASE_SECONDS = float(os.environ.get('SHARED_CACHE_LEASE_SECONDS', 15))
+SHARED_CACHE_POLL_SECONDS = 0.05
+SHARED_CACHE_PRUNE_EVERY = 200
+
+# --- Price History Settings ---
+PRICE_HISTORY_DB = os.environ.get('PRICE_HISTORY_DB', 'price_history.sqlite3')
+PRICE_HISTORY_FLUSH_SECONDS = float(os.environ.get('PRICE_HISTORY_FLUSH_SECONDS', 2))
+PRICE_HISTORY_BATCH_SIZE = 1000
+PRICE_HISTORY_MAX_PENDING = 50000
+PRICE_HISTORY_MIN_INTERVAL_SECONDS = int(os.environ.get('PRICE_HISTORY_MIN_INTERVAL_SECONDS', 3600))
+PRICE_HISTORY_RETENTION_DAYS = int(os.environ.get('PRICE_HISTORY_RETENTION_DAYS', 400))
+PRICE_PERCENTILES = (10, 25, 50, 75, 90)
+
+# --- Offline Snapshot Settings ---
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', 'snapshots')
+SNAPSHOT_MAX_AGE_SECONDS = int(os.environ.get('SNAPSHOT_MAX_AGE_SECONDS', 36 * 3600))
+SNAPSHOT_EXPORT_BUDGET = int(os.environ.get('SNAPSHOT_EXPORT_BUDGET', 200))
+SNAPSHOT_EXPORT_MAX_PARALLEL = int(os.environ.get('SNAPSHOT_EXPORT_MAX_PARALLEL', 4))
+SNAPSHOT_KEEP_VERSIONS = 3
+SNAPSHOT_FORMAT_VERSION = 1
+
+# --- Fan-out Engine Settings ---
+SOURCE_DEADLINES = {'booking': float(os.environ.get('BOOKING_DEADLINE_SECONDS', 6)), 'tripadvisor': float(os.environ.get('TRIPADVISOR_DEADLINE_SECONDS', 5))}
+BATCH_MAX_CITIES = int(os.environ.get('BATCH_MAX_CITIES', 100))
+BATCH_MAX_PARALLEL = int(os.environ.get('BATCH_MAX_PARALLEL', max(1, UPSTREAM_MAX_CONCURRENCY // 2)))
+BATCH_DEADLINE_SECONDS = float(os.environ.get('BATCH_DEADLINE_SECONDS', 30))
+
+# --- Price Calendar Settings ---
+CALENDAR_MAX_DAYS = int(os.environ.get('CALENDAR_MAX_DAYS', 62))
+CALENDAR_MAX_NIGHTS = 30
+CALENDAR_MAX_PARALLEL = int(os.environ.get('CALENDAR_MAX_PARALLEL', BATCH_MAX_PARALLEL))
+CALENDAR_DEADLINE_SECONDS = float(os.environ.get('CALENDAR_DEADLINE_SECONDS', 30))
+
+# --- Cache Warmer Settings ---
+CACHE_WARMER_INTERVAL_SECONDS = int(os.environ.get('CACHE_WARMER_INTERVAL_SECONDS', 120))
+CACHE_WARMER_TOP_N = int(os.environ.get('CACHE_WARMER_TOP_N', 20))
+CACHE_WARMER_QUOTA_SHARE = float(os.environ.get('CACHE_WARMER_QUOTA_SHARE', 0.2))
+CACHE_WARMER_MAX_CALLS_PER_CYCLE = int(os.environ.get('CACHE_WARMER_MAX_CALLS_PER_CYCLE', 20))
+CACHE_WARMER_MAX_PARALLEL = int(os.environ.get('CACHE_WARMER_MAX_PARALLEL', 2))
+SEARCH_DEMAND_DECAY = 0.9
+SEARCH_DEMAND_MAX_TRACKED = 5000
+
 # --- Data Loading ---
+def parse_coordinate(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
 def load_cities_from_csv(filename='cities.csv'):
     """Loads cities from CSV, ensuring all necessary fields are present."""
     cities = {}
@@ -49,8 +241,12 @@ def load_cities_from_csv(filename='cities.csv'):
                     'name': row.get('name', 'N/A').replace('"', '').strip(),
                     'search_query': row.get('search_query', ''),
                     'country': row.get('country', 'com').lower(),
-                    'tripadvisor_id': row.get('tripadvisor_id', '')
+                    'tripadvisor_id': row.get('tripadvisor_id', ''),
+                    'lat': parse_coordinate(row.get('lat')),
+                    'lon': parse_coordinate(row.get('lon'))
                 }
+                if aliases := [alias.strip() for alias in (row.get('aliases') or '').split('|') if alias.strip()]:
+                    cities[key]['aliases'] = aliases
         logging.info(f"Successfully loaded {len(cities)} cities from {filename}.")
         return cities
     except FileNotFoundError:
@@ -60,18 +256,1068 @@ def load_cities_from_csv(filename='cities.csv'):
         logging.error(f"CRITICAL: Failed to read or parse {filename}. Error: {e}", exc_info=True)
         return {}
 
-CITIES = load_cities_from_csv()
+CITIES = load_cities_from_csv(CITIES_FILE)
+
+# --- Upstream HTTP Sessions ---
+
+def retry_backoff_seconds(retry_number):
+    """Full-jitter exponential backoff before the given retry (1-based), so parallel workers do not retry in lockstep."""
+    return random.uniform(0, min(UPSTREAM_BACKOFF_MAX_SECONDS, UPSTREAM_BACKOFF_FACTOR * 2 ** (retry_number - 1)))
+
+# --- Metrics ---
+
+LATENCY_BUCKETS_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0)
+
+class MetricsRegistry:
+    """Minimal thread-safe Prometheus registry: labelled counters, latency histograms and callback gauges."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def gauge(self, name, callback, kind='gauge'):
+        """Registers callback() -> {labels_tuple: value} (or a number), read at scrape time.
+
+        kind='counter' exposes a monotonic total that is kept elsewhere (e.g. cache counters).
+        """
+        self._gauges[name] = (callback, kind)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        """Prometheus text exposition format 0.0.4."""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, ([*buckets], total, count)) for key, (buckets, total, count) in self._histograms.items())
+        seen = set()
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, buckets):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for name, (callback, kind) in sorted(self._gauges.items()):
+            try:
+                values = callback()
+            except Exception as e:
+                logging.error(f"Metrics gauge {name} failed: {e}")
+                continue
+            header(name, kind)
+            for labels, value in (values.items() if isinstance(values, dict) else [((), values)]):
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+METRICS = MetricsRegistry(LATENCY_BUCKETS_SECONDS)
+METRICS.describe('actionly_upstream_request_seconds', 'Latency of RapidAPI calls by host, endpoint and HTTP status.')
+METRICS.describe('actionly_upstream_errors_total', 'Failed RapidAPI calls by host, endpoint and error type.')
+METRICS.describe('actionly_upstream_rejections_total', 'Upstream calls refused by the rate limiter or daily quota.')
+METRICS.describe('actionly_stage_seconds', 'Latency of internal processing stages.')
+METRICS.describe('actionly_source_failures_total', 'Source searches that failed and returned no hotels.')
+METRICS.describe('actionly_request_seconds', 'Latency of backend requests by route and status.')
+METRICS.describe('actionly_circuit_state', 'Circuit breaker state per host: 0 closed, 1 half-open, 2 open.')
+METRICS.describe('actionly_upstream_retries_total', 'Upstream requests repeated after a connection error, 429 or 5xx.')
+METRICS.describe('actionly_upstream_hedges_total', 'Backup requests sent because the first exceeded the recent p95.')
+
+# Per-request Server-Timing entries; the list is shared with worker threads through copied contexts.
+REQUEST_TIMINGS = contextvars.ContextVar('request_timings', default=None)
+
+def record_timing(name, seconds):
+    timings = REQUEST_TIMINGS.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+@contextmanager
+def timed_stage(stage):
+    """Times an internal stage into the stage histogram and the current request's Server-Timing."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        METRICS.observe('actionly_stage_seconds', elapsed, stage=stage)
+        record_timing(stage, elapsed)
+
+# --- Shared Cache ---
+
+class SharedCache:
+    """Host-local cache shared by every worker process through one SQLite file in WAL mode.
+
+    Values are stored as JSON with absolute fresh/stale deadlines; the file is writable by anyone
+    running a worker, so nothing read back from it is ever executed. A lease table provides cross-process
+    single-flight: the worker that takes a key's lease fetches it, and the others wait for its
+    result instead of calling upstream themselves. Failures here are logged and never fail a request.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, fresh_until REAL NOT NULL, stale_until REAL NOT NULL) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID",
+    )
+
+    def __init__(self, path, lease_seconds, poll_seconds, prune_every):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._puts = 0
+        self._counters_lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'fetches': 0, 'waits': 0, 'wait_hits': 0, 'errors': 0}
+        conn = self._connect()
+        with conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _conn(self):
+        # Per thread and per process, so a fork never reuses its parent's connection.
+        conn, pid = getattr(self._local, 'conn', (None, None))
+        if conn is None or pid != os.getpid():
+            conn = self._connect()
+            self._local.conn = (conn, os.getpid())
+        return conn
+
+    @staticmethod
+    def key_for(namespace, key):
+        return f"{namespace}:{json.dumps(key, separators=(',', ':'))}"
+
+    def get(self, key):
+        """Returns (value, fresh_until, stale_until) while the entry is usable, else None."""
+        try:
+            row = self._conn().execute('SELECT value, fresh_until, stale_until FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None or row[2] <= time.time():
+                return None
+            return json.loads(row[0]), row[1], row[2]
+        except (sqlite3.Error, ValueError) as e:
+            self._error('read', e)
+            return None
+
+    def put(self, key, value, fresh_until, stale_until):
+        try:
+            conn = self._conn()
+            conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (key, dump_json_bytes(value), fresh_until, stale_until))
+            with self._counters_lock:
+                self._puts += 1
+                prune = self._puts % self.prune_every == 0
+            if prune:
+                now = time.time()
+                conn.execute('DELETE FROM entries WHERE stale_until < ?', (now,))
+                conn.execute('DELETE FROM leases WHERE expires_at < ?', (now,))
+        except (sqlite3.Error, TypeError) as e:
+            self._error('write', e)
+
+    def _owner(self):
+        return f"{os.getpid()}:{threading.get_ident()}"
+
+    def try_lease(self, key):
+        """Takes the fetch lease for key unless another live worker holds it; True on success.
+
+        If the shared cache is unusable the caller gets the lease, so it simply fetches itself.
+        """
+        now = time.time()
+        try:
+            conn = self._conn()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM leases WHERE key = ? AND expires_at < ?', (key, now))
+                taken = conn.execute('INSERT OR IGNORE INTO leases VALUES (?, ?, ?)', (key, self._owner(), now + self.lease_seconds)).rowcount == 1
+            finally:
+                conn.execute('COMMIT')
+            return taken
+        except sqlite3.Error as e:
+            self._error('lease', e)
+            return True
+
+    def release(self, key):
+        try:
+            self._conn().execute('DELETE FROM leases WHERE key = ? AND owner = ?', (key, self._owner()))
+        except sqlite3.Error as e:
+            self._error('lease', e)
+
+    def _lease_held(self, key):
+        try:
+            return self._conn().execute('SELECT 1 FROM leases WHERE key = ? AND expires_at >= ?', (key, time.time())).fetchone() is not None
+        except sqlite3.Error:
+            return False
+
+    def _fresh_entry(self, key, newer_than):
+        entry = self.get(key)
+        return entry if entry is not None and entry[1] > max(time.time(), newer_than) else None
+
+    def _poll_lease(self, key, newer_than):
+        """(True, entry) once the lease holder stored a fresh value, (True, None) once it gave the lease up, else (False, None)."""
+        entry = self._fresh_entry(key, newer_than)
+        if entry is not None:
+            self._count('wait_hits')
+            return True, entry
+        return not self._lease_held(key), None
+
+    def _wait_for_fresh(self, key, newer_than):
+        """Polls until another worker stores a fresh value or gives up its lease; the entry or None."""
+        self._count('waits')
+        give_up = time.monotonic() + self.lease_seconds
+        while time.monotonic() < give_up:
+            time.sleep(self.poll_seconds)
+            settled, entry = self._poll_lease(key, newer_than)
+            if settled:
+                return entry
+        return None
+
+    async def _wait_for_fresh_async(self, key, newer_than):
+        self._count('waits')
+        give_up = time.monotonic() + self.lease_seconds
+        while time.monotonic() < give_up:
+            await asyncio.sleep(self.poll_seconds)
+            settled, entry = self._poll_lease(key, newer_than)
+            if settled:
+                return entry
+        return None
+
+    def _publish(self, key, value, fresh_seconds, stale_seconds):
+        self._count('fetches')
+        fresh_until = time.time() + (fresh_seconds(value) if callable(fresh_seconds) else fresh_seconds)
+        entry = (value, fresh_until, fresh_until + stale_seconds)
+        self.put(key, *entry)
+        return entry
+
+    def fetch(self, key, fetch, fresh_seconds, stale_seconds=0, newer_than=0.0):
+        """Returns (entry, fetched): a fresh shared entry, one fetched by the worker holding the
+        lease, or fetch() run here and published. entry is (value, fresh_until, stale_until).
+
+        Shared entries only count if fresh beyond newer_than, so a forced refresh can still reuse
+        a value another worker refreshed after ours. fresh_seconds may be a callable taking the value.
+        """
+        entry = self._fresh_entry(key, newer_than)
+        if entry is not None:
+            self._count('hits')
+            return entry, False
+        self._count('misses')
+        if not self.try_lease(key):
+            entry = self._wait_for_fresh(key, newer_than)
+            if entry is not None:
+                return entry, False
+        try:
+            return self._publish(key, fetch(), fresh_seconds, stale_seconds), True
+        finally:
+            self.release(key)
+
+    async def fetch_async(self, key, fetch, fresh_seconds, stale_seconds=0, newer_than=0.0):
+        """fetch() on the async upstream loop: fetch is a coroutine function, and waiting for another
+        worker's lease suspends instead of sleeping. The SQLite calls themselves are local and short.
+        """
+        entry = self._fresh_entry(key, newer_than)
+        if entry is not None:
+            self._count('hits')
+            return entry, False
+        self._count('misses')
+        if not self.try_lease(key):
+            entry = await self._wait_for_fresh_async(key, newer_than)
+            if entry is not None:
+                return entry, False
+        try:
+            return self._publish(key, await fetch(), fresh_seconds, stale_seconds), True
+        finally:
+            self.release(key)
+
+    def increment(self, name, limit=0):
+        """Adds one to a host-wide counter unless it already reached limit (0 means no limit).
+
+        Returns True if it was incremented, False at the limit, or None if the store is unusable.
+        """
+        try:
+            return self._conn().execute('INSERT INTO counters VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1 WHERE ? = 0 OR value < ?',
+                                        (name, limit, limit)).rowcount == 1
+        except sqlite3.Error as e:
+            self._error('counter', e)
+            return None
+
+    def counter(self, name):
+        """Current value of a host-wide counter, or None if the store is unusable."""
+        try:
+            row = self._conn().execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()
+            return row[0] if row else 0
+        except sqlite3.Error as e:
+            self._error('counter', e)
+            return None
+
+    def drop_counters(self, prefix, keep_prefix):
+        """Deletes counters named prefix* except those named keep_prefix*."""
+        try:
+            self._conn().execute('DELETE FROM counters WHERE substr(name, 1, ?) = ? AND substr(name, 1, ?) != ?', (len(prefix), prefix, len(keep_prefix), keep_prefix))
+        except sqlite3.Error as e:
+            self._error('counter', e)
+
+    def _count(self, name):
+        with self._counters_lock:
+            self.counters[name] += 1
+
+    def _error(self, operation, error):
+        self._count('errors')
+        logging.warning(f"Shared cache {operation} failed: {error}")
+
+    def stats(self):
+        with self._counters_lock:
+            return dict(self.counters, path=self.path)
+
+SHARED_CACHE = None
+if os.environ.get('SHARED_CACHE_ENABLED', '1') == '1':
+    try:
+        SHARED_CACHE = SharedCache(SHARED_CACHE_DB, SHARED_CACHE_LEASE_SECONDS, SHARED_CACHE_POLL_SECONDS, SHARED_CACHE_PRUNE_EVERY)
+    except sqlite3.Error as e:
+        logging.error(f"Shared cache disabled, could not open {SHARED_CACHE_DB}: {e}")
+
+# --- Upstream Concurrency & Quota ---
+
+class UpstreamCapacityError(Exception):
+    """Raised instead of queueing indefinitely when the upstream budget is exhausted."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """Thread-safe token bucket; callers wait for a token up to a maximum time."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """Takes a token now or returns the seconds until one is available."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def _next_wait(self, deadline):
+        """0 once a token is taken, else the seconds to wait before trying again; raises if that passes deadline."""
+        wait = self._reserve()
+        if wait and time.monotonic() + wait > deadline:
+            raise UpstreamCapacityError("Upstream rate limit reached", retry_after=max(1, int(wait + 0.999)))
+        return wait
+
+    def acquire(self, max_wait):
+        deadline = time.monotonic() + max_wait
+        while wait := self._next_wait(deadline):
+            time.sleep(wait)
+
+    async def acquire_async(self, max_wait):
+        deadline = time.monotonic() + max_wait
+        while wait := self._next_wait(deadline):
+            await asyncio.sleep(wait)
+
+class DailyQuota:
+    """Counts upstream calls per host per UTC day and refuses calls beyond the configured quota.
+
+    With a SharedCache the counts live in its SQLite file, so every worker process on the host
+    draws from one quota; if that store fails, counting falls back to this process.
+    """
+
+    def __init__(self, quotas, shared=None):
+        self.quotas = quotas
+        self.shared = shared
+        self._day = None
+        self._used = {}
+        self._lock = threading.Lock()
+
+    def _roll(self):
+        today = datetime.now(timezone.utc).date()
+        if today != self._day:
+            self._day = today
+            self._used = {}
+            if self.shared is not None:
+                self.shared.drop_counters('quota:', self._counter_prefix())
+
+    def _counter_prefix(self):
+        return f"quota:{self._day.isoformat()}:"
+
+    def _exhausted(self, host):
+        tomorrow = datetime.combine(self._day + timedelta(days=1), datetime.min.time(), timezone.utc)
+        return UpstreamCapacityError(f"Daily quota for {host} exhausted", retry_after=int((tomorrow - datetime.now(timezone.utc)).total_seconds()) + 1)
+
+    def _used_today(self, host):
+        # Called with self._lock held.
+        used = self.shared.counter(self._counter_prefix() + host) if self.shared is not None else None
+        return self._used.get(host, 0) if used is None else used
+
+    def consume(self, host):
+        with self._lock:
+            self._roll()
+            quota = self.quotas.get(host, 0)
+            if self.shared is not None:
+                counted = self.shared.increment(self._counter_prefix() + host, quota)
+                if counted is False:
+                    raise self._exhausted(host)
+                if counted:
+                    return
+            if quota and self._used.get(host, 0) >= quota:
+                raise self._exhausted(host)
+            self._used[host] = self._used.get(host, 0) + 1
+
+    def remaining(self, host):
+        """Calls left today for host, or None when the host has no quota."""
+        with self._lock:
+            self._roll()
+            quota = self.quotas.get(host, 0)
+            return max(0, quota - self._used_today(host)) if quota else None
+
+    def snapshot(self):
+        with self._lock:
+            self._roll()
+            return {host: {'used': self._used_today(host), 'quota': self.quotas.get(host, 0) or None} for host in set(self.quotas) | set(self._used)}
+
+class UpstreamLimiter:
+    """Per-host token buckets plus the daily quota, checked before every upstream request, retries included."""
+
+    def __init__(self, rate_limits, quotas, max_wait, shared=None):
+        self.buckets = {host: TokenBucket(rate, burst) for host, (rate, burst) in rate_limits.items()}
+        self.quota = DailyQuota(quotas, shared)
+        self.max_wait = max_wait
+
+    def acquire(self, host, max_wait=None):
+        bucket = self.buckets.get(host)
+        if bucket is not None:
+            bucket.acquire(self.max_wait if max_wait is None else max_wait)
+        self.quota.consume(host)
+
+    async def acquire_async(self, host):
+        """acquire() on the async upstream loop: a rate-limit wait suspends the search instead of a thread."""
+        bucket = self.buckets.get(host)
+        if bucket is not None:
+            await bucket.acquire_async(self.max_wait)
+        self.quota.consume(host)
+
+    def try_acquire(self, host):
+        """Takes a token only if one is available right now; used for optional extra calls."""
+        try:
+            self.acquire(host, max_wait=0)
+            return True
+        except UpstreamCapacityError:
+            return False
+
+class UpstreamBudget:
+    """Caps the upstream requests made while it is active, retries, auto-completes and hedges included.
+
+    limits maps a host to its cap, or None to one cap shared by every host; hosts without one are
+    not capped. upstream_get charges each attempt to every budget active in its context, which
+    follows work onto the executor threads, and refuses the attempt once any of them is spent.
+    With a SharedCache and a counter prefix the spend is counted host-wide, across workers.
+    """
+
+    def __init__(self, limits, shared=None, counter_prefix=None):
+        self.limits = limits
+        self.shared = shared if counter_prefix else None
+        self.counter_prefix = counter_prefix
+        self._spent = {}
+        self._lock = threading.Lock()
+
+    def _key(self, host):
+        return host if host in self.limits else None
+
+    def spent(self, host=None):
+        key = self._key(host)
+        if self.shared is not None:
+            used = self.shared.counter(f"{self.counter_prefix}{key or 'all'}")
+            if used is not None:
+                return used
+        with self._lock:
+            return self._spent.get(key, 0)
+
+    def try_charge(self, host):
+        """Counts one request to host and returns True, or False once the budget for it is spent."""
+        key = self._key(host)
+        if key not in self.limits:
+            return True
+        limit = self.limits[key]
+        if limit <= 0:
+            return False
+        if self.shared is not None:
+            counted = self.shared.increment(f"{self.counter_prefix}{key or 'all'}", limit)
+            if counted is not None:
+                return counted
+        with self._lock:
+            if self._spent.get(key, 0) >= limit:
+                return False
+            self._spent[key] = self._spent.get(key, 0) + 1
+            return True
+
+    @contextmanager
+    def active(self):
+        token = UPSTREAM_BUDGETS.set(UPSTREAM_BUDGETS.get() + (self,))
+        try:
+            yield self
+        finally:
+            UPSTREAM_BUDGETS.reset(token)
+
+UPSTREAM_BUDGETS = contextvars.ContextVar('upstream_budgets', default=())
+
+def charge_upstream_budgets(host):
+    """Charges one request to host against every active UpstreamBudget; False if one is spent."""
+    return all(budget.try_charge(host) for budget in UPSTREAM_BUDGETS.get())
+
+class BoundedExecutor:
+    """Process-wide worker pool with a bounded queue; work that waits too long fails fast."""
+
+    def __init__(self, max_workers, max_queued, max_wait):
+        self.max_workers = max_workers
+        self.max_wait = max_wait
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upstream')
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+        self._lock = threading.Lock()
+        self.counters = {'submitted': 0, 'rejected': 0, 'expired': 0, 'active': 0, 'queued': 0}
+
+    def _run(self, enqueued_at, fn, args, kwargs):
+        try:
+            with self._lock:
+                self.counters['queued'] -= 1
+            if time.monotonic() - enqueued_at > self.max_wait:
+                with self._lock:
+                    self.counters['expired'] += 1
+                raise UpstreamCapacityError("Upstream queue wait exceeded")
+            with self._lock:
+                self.counters['active'] += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.counters['active'] -= 1
+        finally:
+            self._slots.release()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queues fn, raising UpstreamCapacityError immediately when the queue is full."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.counters['rejected'] += 1
+            raise UpstreamCapacityError("Too many upstream requests in flight")
+        with self._lock:
+            self.counters['submitted'] += 1
+            self.counters['queued'] += 1
+        try:
+            # Run in a copy of the caller's context so per-request timings follow the work.
+            return self._executor.submit(contextvars.copy_context().run, self._run, time.monotonic(), fn, args, kwargs)
+        except Exception:
+            with self._lock:
+                self.counters['queued'] -= 1
+            self._slots.release()
+            raise
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, max_workers=self.max_workers)
+
+UPSTREAM_LIMITER = UpstreamLimiter(UPSTREAM_RATE_LIMITS, UPSTREAM_DAILY_QUOTAS, UPSTREAM_QUEUE_MAX_WAIT_SECONDS, SHARED_CACHE)
+UPSTREAM_EXECUTOR = BoundedExecutor(UPSTREAM_MAX_CONCURRENCY, UPSTREAM_MAX_QUEUED, UPSTREAM_QUEUE_MAX_WAIT_SECONDS)
+
+# --- Circuit Breaker & Hedging ---
+
+class CircuitOpenError(Exception):
+    """Raised without calling upstream while a host's circuit is open."""
+
+class CircuitBreaker:
+    """Per-host breaker over a rolling window of outcomes; opens on error or slow-call ratios.
+
+    After CIRCUIT_OPEN_SECONDS a single half-open probe is let through; its outcome closes the
+    circuit or re-opens it for another period.
+    """
+    STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+    def __init__(self, host, window, min_calls, failure_ratio, slow_call_seconds, slow_ratio, open_seconds):
+        self.host = host
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_ratio = slow_ratio
+        self.open_seconds = open_seconds
+        self.state = 'closed'
+        self.opens = 0
+        self._outcomes = deque(maxlen=window)
+        self._opened_until = 0.0
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    def _open(self, now):
+        self.state = 'open'
+        self.opens += 1
+        self._opened_until = now + self.open_seconds
+        self._probe_started = None
+        self._outcomes.clear()
+        logging.warning(f"Circuit for {self.host} opened for {self.open_seconds:.0f}s")
+
+    def allow(self):
+        """Raises CircuitOpenError unless a call may go upstream now."""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == 'open' and now >= self._opened_until:
+                self.state = 'half_open'
+            if self.state == 'half_open':
+                # A probe that never reported back (e.g. its worker died) must not wedge the breaker.
+                if self._probe_started is not None and now - self._probe_started < self.open_seconds:
+                    raise CircuitOpenError(f"Circuit for {self.host} is half-open, probe in progress")
+                self._probe_started = now
+            elif self.state == 'open':
+                raise CircuitOpenError(f"Circuit for {self.host} is open")
+
+    def cancel_probe(self):
+        with self._lock:
+            self._probe_started = None
+
+    def record(self, success, elapsed):
+        slow = elapsed >= self.slow_call_seconds
+        now = time.monotonic()
+        with self._lock:
+            if self.state == 'half_open':
+                if success and not slow:
+                    self.state = 'closed'
+                    self._probe_started = None
+                    self._outcomes.clear()
+                    logging.info(f"Circuit for {self.host} closed after successful probe")
+                else:
+                    self._open(now)
+                return
+            if self.state == 'open':
+                return
+            self._outcomes.append((success, slow))
+            if len(self._outcomes) >= self.min_calls:
+                failures = sum(1 for ok, _ in self._outcomes if not ok)
+                slow_calls = sum(1 for _, was_slow in self._outcomes if was_slow)
+                if failures / len(self._outcomes) >= self.failure_ratio or slow_calls / len(self._outcomes) >= self.slow_ratio:
+                    self._open(now)
+
+    def snapshot(self):
+        with self._lock:
+            return {'state': self.state, 'opens': self.opens, 'window': len(self._outcomes)}
+
+CIRCUIT_BREAKERS = {host: CircuitBreaker(host, CIRCUIT_WINDOW, CIRCUIT_MIN_CALLS, CIRCUIT_FAILURE_RATIO, CIRCUIT_SLOW_CALL_SECONDS, CIRCUIT_SLOW_RATIO, CIRCUIT_OPEN_SECONDS)
+                    for host in (BOOKING_API_HOST, TRIPADVISOR_API_HOST)}
+
+class HedgePolicy:
+    """Tracks recent latencies per (host, endpoint) and decides when a backup request is worth sending."""
+
+    def __init__(self, enabled, quantile, min_samples, min_delay, max_ratio, sample_size):
+        self.enabled = enabled
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.sample_size = sample_size
+        self._samples = {}
+        self._calls = 0
+        self._hedges = 0
+        self._lock = threading.Lock()
+
+    def record_latency(self, key, seconds):
+        with self._lock:
+            self._calls += 1
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.sample_size)
+            samples.append(seconds)
+
+    def delay(self, key, read_timeout):
+        """Seconds to wait before hedging, or None when hedging is off or there is no usable estimate."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+        estimate = max(self.min_delay, samples[int(self.quantile * (len(samples) - 1))])
+        return estimate if estimate < read_timeout else None
+
+    def allow_hedge(self):
+        """Keeps hedges to at most max_ratio of all upstream calls."""
+        with self._lock:
+            if self._hedges < self.max_ratio * self._calls + 1:
+                self._hedges += 1
+                return True
+            return False
+
+HEDGE_POLICY = HedgePolicy(UPSTREAM_HEDGING, HEDGE_QUANTILE, HEDGE_MIN_SAMPLES, HEDGE_MIN_DELAY_SECONDS, HEDGE_MAX_RATIO, LATENCY_SAMPLE_SIZE)
+HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=UPSTREAM_MAX_CONCURRENCY * 2, thread_name_prefix='hedge')
+
+_UPSTREAM_SESSIONS = {}
+_UPSTREAM_SESSIONS_LOCK = threading.Lock()
+
+def _build_upstream_session(host):
+    # No transport-level retries: upstream_get retries itself so every attempt passes the rate limiter and quota.
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UPSTREAM_POOL_SIZE, max_retries=0, pool_block=False)
+    session = requests.Session()
+    session.mount(upstream_base_url(host), adapter)
+    session.headers.update({"x-rapidapi-key": RAPIDAPI_KEY, "x-rapidapi-host": host})
+    # Sessions are shared across threads, so they must never accumulate cookie state.
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+def upstream_base_url(host):
+    return UPSTREAM_BASE_URLS.get(host, f"https://{host}")
+
+def get_upstream_session(host):
+    """Returns the shared keep-alive session (one connection pool) for an upstream host."""
+    session = _UPSTREAM_SESSIONS.get(host)
+    if session is None:
+        with _UPSTREAM_SESSIONS_LOCK:
+            session = _UPSTREAM_SESSIONS.get(host)
+            if session is None:
+                session = _UPSTREAM_SESSIONS[host] = _build_upstream_session(host)
+    return session
+
+def hedged_get(host, endpoint, url, params, timeout):
+    """GETs url, sending one backup request if the first is slower than the recent p95.
+
+    Only used for idempotent GETs; the first response that is not a 5xx wins.
+    """
+    session = get_upstream_session(host)
+    delay = HEDGE_POLICY.delay((host, endpoint), timeout[1])
+    if delay is None:
+        return session.get(url, params=params, timeout=timeout)
+    primary = HEDGE_EXECUTOR.submit(contextvars.copy_context().run, session.get, url, params=params, timeout=timeout)
+    try:
+        return primary.result(timeout=delay)
+    except FuturesTimeoutError:
+        pass
+    if not HEDGE_POLICY.allow_hedge() or not charge_upstream_budgets(host) or not UPSTREAM_LIMITER.try_acquire(host):
+        return primary.result()
+    METRICS.inc('actionly_upstream_hedges_total', host=host, endpoint=endpoint)
+    hedge = HEDGE_EXECUTOR.submit(contextvars.copy_context().run, session.get, url, params=params, timeout=timeout)
+    pending, fallback, error = {primary, hedge}, None, None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                response = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if response.status_code < 500:
+                if future is hedge:
+                    METRICS.inc('actionly_upstream_hedge_wins_total', host=host, endpoint=endpoint)
+                return response
+            fallback = response
+    if fallback is not None:
+        return fallback
+    raise error
+
+def _admit_upstream_call(host):
+    """Returns the host's circuit breaker once it admits a call; raises CircuitOpenError while it is open."""
+    breaker = CIRCUIT_BREAKERS.get(host)
+    if breaker is not None:
+        try:
+            breaker.allow()
+        except CircuitOpenError:
+            METRICS.inc('actionly_upstream_rejections_total', host=host, reason='circuit open')
+            raise
+    return breaker
+
+def _observe_upstream_attempt(host, endpoint, status, elapsed):
+    METRICS.observe('actionly_upstream_request_seconds', elapsed, host=host, endpoint=endpoint, status=status)
+    record_timing(endpoint, elapsed)
+
+def _upstream_call_failed(error, host, endpoint, attempts):
+    """Counts a failed call; returns True when the upstream was still healthy (a 4xx other than 429)."""
+    if not isinstance(error, UpstreamCapacityError) or attempts:
+        METRICS.inc('actionly_upstream_errors_total', host=host, endpoint=endpoint, error=type(error).__name__)
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code < 500 and error.response.status_code != 429
+    return False
+
+def _upstream_call_done(breaker, host, endpoint, attempts, success, elapsed):
+    if not attempts:
+        # Refused before anything was sent: not an outcome for the breaker.
+        if breaker is not None: breaker.cancel_probe()
+    else:
+        # The final attempt decides the call's outcome and is its latency sample.
+        if breaker is not None: breaker.record(success, elapsed)
+        if success: HEDGE_POLICY.record_latency((host, endpoint), elapsed)
+
+def upstream_get(host, path, params, endpoint):
+    """GETs an upstream JSON endpoint over the pooled session with the endpoint's timeouts.
+
+    Calls are refused up front while the host's circuit is open, and may be hedged (see hedged_get).
+    Connection errors and 429/5xx answers are retried up to UPSTREAM_MAX_RETRIES times with
+    jittered backoff; each attempt takes its own rate-limit token, daily-quota unit and a unit of
+    every active UpstreamBudget, because each one is a request RapidAPI bills. A long Retry-After
+    is not honoured, so a worker thread is never parked for minutes.
+    """
+    timeout = (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUTS[endpoint])
+    url = f"{upstream_base_url(host)}{path}"
+    breaker = _admit_upstream_call(host)
+    elapsed = None
+    success = False
+    attempts = 0
+    try:
+        while True:
+            if attempts:
+                time.sleep(retry_backoff_seconds(attempts))
+            try:
+                if not charge_upstream_budgets(host):
+                    raise UpstreamCapacityError("Upstream budget for this run spent")
+                UPSTREAM_LIMITER.acquire(host)
+            except UpstreamCapacityError as e:
+                METRICS.inc('actionly_upstream_rejections_total', host=host, reason=str(e))
+                raise
+            attempts += 1
+            retry_left = attempts <= UPSTREAM_MAX_RETRIES
+            # Only the request itself is timed: limiter waits and backoff sleeps are our own time,
+            # and must not reach the latency metrics, the hedge p95 or the breaker's slow-call ratio.
+            status = 'error'
+            attempt_started = time.perf_counter()
+            try:
+                response = hedged_get(host, endpoint, url, params, timeout)
+                status = str(response.status_code)
+            except requests.ConnectionError:
+                if not retry_left: raise
+                METRICS.inc('actionly_upstream_retries_total', host=host, endpoint=endpoint, reason='connection')
+                continue
+            finally:
+                elapsed = time.perf_counter() - attempt_started
+                _observe_upstream_attempt(host, endpoint, status, elapsed)
+            if response.status_code in UPSTREAM_RETRY_STATUSES and retry_left:
+                METRICS.inc('actionly_upstream_retries_total', host=host, endpoint=endpoint, reason=status)
+                continue
+            response.raise_for_status()
+            data = response.json()
+            success = True
+            return data
+    except Exception as e:
+        # Client errors mean the upstream is healthy; only 429/5xx, timeouts and bad payloads trip the breaker.
+        success = _upstream_call_failed(e, host, endpoint, attempts)
+        raise
+    finally:
+        _upstream_call_done(breaker, host, endpoint, attempts, success, elapsed)
+
+# --- Async Upstream ---
+
+class AsyncUpstream:
+    """One asyncio loop thread with a pooled httpx.AsyncClient per upstream host.
+
+    Fan-out jobs that are coroutine functions run here instead of on the upstream executor, so a
+    search waiting on the network, the rate limiter or a retry backoff holds no thread, and one
+    worker keeps up to max_in_flight searches going where the executor holds UPSTREAM_MAX_CONCURRENCY.
+    Responses come back as requests.Response objects and transport errors as requests exceptions,
+    so retries, the breaker and every caller treat both paths alike.
+    """
+
+    def __init__(self, max_in_flight, max_connections, max_keepalive):
+        self.max_in_flight = max_in_flight
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self._loop = None
+        self._clients = {}
+        self._lock = threading.Lock()
+        self.counters = {'submitted': 0, 'rejected': 0, 'active': 0}
+
+    def _get_loop(self):
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name='async-upstream', daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    def submit(self, fn, *args):
+        """Runs the coroutine fn(*args) on the loop in a copy of the caller's context; returns a concurrent Future.
+
+        Raises UpstreamCapacityError immediately when max_in_flight searches are already running.
+        """
+        with self._lock:
+            if self.counters['active'] >= self.max_in_flight:
+                self.counters['rejected'] += 1
+                raise UpstreamCapacityError("Too many upstream requests in flight")
+            self.counters['submitted'] += 1
+            self.counters['active'] += 1
+        future = Future()
+        def settle(task):
+            with self._lock:
+                self.counters['active'] -= 1
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+        def start():
+            asyncio.ensure_future(fn(*args)).add_done_callback(settle)
+        # The task copies the context start runs in, so budgets and request timings follow the work.
+        self._get_loop().call_soon_threadsafe(start, context=contextvars.copy_context())
+        return future
+
+    def _client(self, host):
+        # Only called on the loop thread.
+        client = self._clients.get(host)
+        if client is None:
+            # A jar whose policy accepts nothing: the clients are shared, so they must never accumulate cookie state.
+            client = self._clients[host] = httpx.AsyncClient(headers={"x-rapidapi-key": RAPIDAPI_KEY, "x-rapidapi-host": host}, limits=self.limits,
+                                                             cookies=CookieJar(DefaultCookiePolicy(allowed_domains=[])))
+        return client
+
+    async def get(self, host, url, params, timeout):
+        """One GET with (connect, read) timeouts, as a requests.Response."""
+        try:
+            response = await self._client(host).get(url, params=params, timeout=httpx.Timeout(timeout[1], connect=timeout[0], pool=timeout[0]))
+        except httpx.ConnectTimeout as e:
+            raise requests.ConnectTimeout(str(e)) from e
+        except httpx.TimeoutException as e:
+            raise requests.ReadTimeout(str(e)) from e
+        except httpx.TransportError as e:
+            raise requests.ConnectionError(str(e)) from e
+        converted = requests.Response()
+        converted.status_code = response.status_code
+        converted.headers = CaseInsensitiveDict(response.headers)
+        converted.url = str(response.url)
+        converted.reason = response.reason_phrase
+        converted._content = response.content
+        return converted
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, max_in_flight=self.max_in_flight)
+
+ASYNC_UPSTREAM = AsyncUpstream(UPSTREAM_ASYNC_MAX_IN_FLIGHT, UPSTREAM_ASYNC_MAX_CONNECTIONS, UPSTREAM_POOL_SIZE) if UPSTREAM_ASYNC and httpx is not None else None
+
+async def hedged_get_async(host, endpoint, url, params, timeout):
+    """hedged_get on the async upstream loop: the backup request is a task, and the loser is cancelled."""
+    get = lambda: ASYNC_UPSTREAM.get(host, url, params, timeout)
+    delay = HEDGE_POLICY.delay((host, endpoint), timeout[1])
+    if delay is None:
+        return await get()
+    primary = asyncio.ensure_future(get())
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done or not HEDGE_POLICY.allow_hedge() or not charge_upstream_budgets(host) or not UPSTREAM_LIMITER.try_acquire(host):
+        return await primary
+    METRICS.inc('actionly_upstream_hedges_total', host=host, endpoint=endpoint)
+    hedge = asyncio.ensure_future(get())
+    pending, fallback, error = {primary, hedge}, None, None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    response = task.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if response.status_code < 500:
+                    if task is hedge:
+                        METRICS.inc('actionly_upstream_hedge_wins_total', host=host, endpoint=endpoint)
+                    return response
+                fallback = response
+    finally:
+        for task in pending:
+            task.cancel()
+    if fallback is not None:
+        return fallback
+    raise error
+
+async def upstream_get_async(host, path, params, endpoint):
+    """upstream_get on the async upstream loop, with the same breaker, budgets, limits, retries and metrics."""
+    timeout = (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUTS[endpoint])
+    url = f"{upstream_base_url(host)}{path}"
+    breaker = _admit_upstream_call(host)
+    elapsed = None
+    success = False
+    attempts = 0
+    try:
+        while True:
+            if attempts:
+                await asyncio.sleep(retry_backoff_seconds(attempts))
+            try:
+                if not charge_upstream_budgets(host):
+                    raise UpstreamCapacityError("Upstream budget for this run spent")
+                await UPSTREAM_LIMITER.acquire_async(host)
+            except UpstreamCapacityError as e:
+                METRICS.inc('actionly_upstream_rejections_total', host=host, reason=str(e))
+                raise
+            attempts += 1
+            retry_left = attempts <= UPSTREAM_MAX_RETRIES
+            status = 'error'
+            attempt_started = time.perf_counter()
+            try:
+                response = await hedged_get_async(host, endpoint, url, params, timeout)
+                status = str(response.status_code)
+            except requests.ConnectionError:
+                if not retry_left: raise
+                METRICS.inc('actionly_upstream_retries_total', host=host, endpoint=endpoint, reason='connection')
+                continue
+            finally:
+                elapsed = time.perf_counter() - attempt_started
+                _observe_upstream_attempt(host, endpoint, status, elapsed)
+            if response.status_code in UPSTREAM_RETRY_STATUSES and retry_left:
+                METRICS.inc('actionly_upstream_retries_total', host=host, endpoint=endpoint, reason=status)
+                continue
+            response.raise_for_status()
+            data = response.json()
+            success = True
+            return data
+    except Exception as e:
+        success = _upstream_call_failed(e, host, endpoint, attempts)
+        raise
+    finally:
+        _upstream_call_done(breaker, host, endpoint, attempts, success, elapsed)
 
 # --- External API Functions ---
 
 def get_booking_location_id(city_query, country_code):
     """Intelligently fetches location ID by strictly matching the country code."""
     if not city_query: return None
-    url = f"https://{BOOKING_API_HOST}/stays/auto-complete"
-    params = {"query": city_query}
-    response = requests.get(url, headers={"x-rapidapi-key": RAPIDAPI_KEY, "x-rapidapi-host": BOOKING_API_HOST}, params=params, timeout=10)
-    response.raise_for_status()
-    data = response.json()
+    data = upstream_get(BOOKING_API_HOST, "/stays/auto-complete", {"query": city_query}, 'booking-autocomplete')
     if data and isinstance(data.get('data'), list):
         for result in data['data']:
             api_country_code = result.get('cc1', '')
@@ -79,159 +1325,2467 @@ def get_booking_location_id(city_query, country_code):
                 return result.get('id')
     return None
 
-def search_booking_hotels(location_id, checkin, checkout, adults, rooms):
-    url = f"https://{BOOKING_API_HOST}/stays/search"
-    params = {"locationId": location_id, "checkinDate": checkin, "checkoutDate": checkout, "adults": adults, "rooms": rooms, "currency": "EUR"}
-    response = requests.get(url, headers={"x-rapidapi-key": RAPIDAPI_KEY, "x-rapidapi-host": BOOKING_API_HOST}, params=params, timeout=15)
-    response.raise_for_status()
-    return response.json()
-
-def search_tripadvisor_hotels(geo_id, checkin, checkout, adults):
-    """Searches TripAdvisor using the confirmed working legacy endpoint."""
-    if not geo_id: return None
-    url = f"https://{TRIPADVISOR_API_HOST}/api/v1/hotels/searchHotels"
-    params = {"geoId": geo_id, "checkIn": checkin, "checkOut": checkout, "adults": adults, "rooms": "1", "currencyCode": "EUR"}
-    response = requests.get(url, headers={"x-rapidapi-key": RAPIDAPI_KEY, "x-rapidapi-host": TRIPADVISOR_API_HOST}, params=params, timeout=15)
-    response.raise_for_status()
-    return response.json()
-
-# --- Data Processing Functions ---
-
-def process_booking_hotels(api_data, search_params, city_info):
-    processed = []
-    hotels_data = api_data.get('data', []) if api_data else []
-    if not isinstance(hotels_data, list): return []
-    for hotel in hotels_data[:BOOKING_HOTEL_LIMIT]:
-        price = 'N/A'
-        if price_info := hotel.get('priceBreakdown', {}).get('grossPrice', {}).get('value'):
-            nights = (datetime.strptime(search_params['checkout'], '%Y-%m-%d') - datetime.strptime(search_params['checkin'], '%Y-%m-%d')).days
-            price = int(price_info / nights) if nights > 0 else int(price_info)
-        processed.append({
-            'id': hotel.get('id'), 'name': hotel.get('name', 'Unknown Hotel'),
-            'address': hotel.get('address', 'N/A'),
-            'coordinates': [float(hotel.get('latitude', 0)), float(hotel.get('longitude', 0))],
-            'price': price, 'rating': round(float(hotel.get('reviewScore', 0.0)) / 2, 1),
-            'source': 'booking.com',
-            'booking_url': hotel.get('url', '#')
-        })
-    return processed
-
-def process_tripadvisor_hotels(api_data):
-    processed = []
-    hotels_data = api_data.get('data', {}).get('data', []) if api_data else []
-    if not isinstance(hotels_data, list): return []
-    for hotel in hotels_data[:TRIPADVISOR_HOTEL_LIMIT]:
-        price = 'N/A'
-        if price_str := hotel.get('priceForDisplay'):
-            if numbers := URL_REGEX.findall(price_str.replace(',', '')):
-                price = int(numbers[0])
-        
-        # KORRIGERING: Använd den externa URL:en direkt, eftersom den är komplett.
-        booking_url = hotel.get('commerceInfo', {}).get('externalUrl')
-        # Fallback om den externa länken saknas
-        if not booking_url:
-            booking_url = f"https://www.tripadvisor.com/Search?q={quote_plus(hotel.get('title', 'Hotel'))}"
-
-        processed.append({
-            'id': hotel.get('id'), 'name': hotel.get('title', 'Unknown Hotel'),
-            'address': hotel.get('secondaryInfo', 'N/A'),
-            'coordinates': [float(hotel.get('geoSummary', {}).get('latitude', 0)), float(hotel.get('geoSummary', {}).get('longitude', 0))],
-            'price': price, 'rating': float(hotel.get('bubbleRating', {}).get('rating', 4.0)),
-            'source': 'tripadvisor',
-            'booking_url': booking_url
-        })
-    return processed
+class BookingLocationIndex:
+    """Persistent (search_query, country) -> Booking.com locationId map, so searches skip auto-complete."""
 
-# --- Helper Functions for Parallel Execution ---
+    def __init__(self, filename, shared=None):
+        self.filename = filename
+        self.shared = shared
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._save_timer = None
+
+    @staticmethod
+    def key_for(city_info):
+        return f"{city_info.get('search_query', '')}|{city_info.get('country', '')}"
+
+    def load(self):
+        try:
+            with open(self.filename, mode='r', encoding='utf-8') as infile:
+                entries = json.load(infile).get('entries', {})
+        except FileNotFoundError:
+            logging.info(f"No Booking location index at {self.filename}, it will be built in the background.")
+            return
+        except (ValueError, AttributeError) as e:
+            logging.error(f"Ignoring unreadable Booking location index {self.filename}: {e}")
+            return
+        with self._lock:
+            self._entries = {k: v for k, v in entries.items() if isinstance(v, dict) and 'resolved_at' in v}
+        logging.info(f"Loaded {len(self._entries)} Booking location IDs from {self.filename}.")
+
+    def save(self):
+        """Writes the index atomically; every worker may save, so each uses its own temp file."""
+        with self._lock:
+            payload = {'version': 1, 'entries': dict(self._entries)}
+        tmp_name = None
+        try:
+            fd, tmp_name = tempfile.mkstemp(prefix=f"{os.path.basename(self.filename)}.", suffix='.tmp', dir=os.path.dirname(os.path.abspath(self.filename)))
+            with os.fdopen(fd, mode='w', encoding='utf-8') as outfile:
+                json.dump(payload, outfile, indent=1, sort_keys=True)
+            os.replace(tmp_name, self.filename)
+        except OSError as e:
+            logging.error(f"Could not write Booking location index {self.filename}: {e}")
+            if tmp_name and os.path.exists(tmp_name):
+                os.remove(tmp_name)
+
+    def _schedule_save(self):
+        """Saves once after a short delay, so a burst of new cities costs one write off the request path."""
+        with self._lock:
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(LOCATION_INDEX_SAVE_DELAY_SECONDS, self._deferred_save)
+            self._save_timer.daemon = True
+        self._save_timer.start()
+
+    def _deferred_save(self):
+        with self._lock:
+            self._save_timer = None
+        self.save()
+
+    def _is_fresh(self, entry, now):
+        max_age = LOCATION_INDEX_REFRESH_SECONDS if entry.get('id') else LOCATION_INDEX_NEGATIVE_TTL_SECONDS
+        return now - entry['resolved_at'] < max_age
+
+    def resolve(self, city_info):
+        """Runs the auto-complete lookup and records the answer, including misses (negative caching).
+
+        With a shared cache, an answer another worker resolved recently is reused instead.
+        """
+        lookup = lambda: get_booking_location_id(city_info['search_query'], city_info['country'])
+        resolved_at = time.time()
+        if self.shared is not None:
+            ttl = lambda location_id: LOCATION_INDEX_REFRESH_SECONDS if location_id else LOCATION_INDEX_NEGATIVE_TTL_SECONDS
+            (location_id, fresh_until, _), fetched = self.shared.fetch(SharedCache.key_for('booking-location', self.key_for(city_info)), lookup, ttl)
+            if not fetched:
+                resolved_at = fresh_until - ttl(location_id)
+        else:
+            location_id = lookup()
+        with self._lock:
+            self._entries[self.key_for(city_info)] = {'id': location_id, 'resolved_at': resolved_at}
+        return location_id
+
+    def has(self, city_info):
+        with self._lock:
+            return self.key_for(city_info) in self._entries
+
+    def lookup(self, city_info):
+        """Returns the indexed location ID, only falling back to a live lookup for unknown cities."""
+        with self._lock:
+            entry = self._entries.get(self.key_for(city_info))
+        if entry is not None:
+            return entry.get('id')
+        location_id = self.resolve(city_info)
+        self._schedule_save()
+        return location_id
+
+    def refresh(self, cities):
+        """Resolves every city whose entry is missing, stale, or an expired miss."""
+        now = time.time()
+        changed = 0
+        for city_info in cities.values():
+            with self._lock:
+                entry = self._entries.get(self.key_for(city_info))
+            if entry is not None and self._is_fresh(entry, now):
+                continue
+            try:
+                self.resolve(city_info)
+                changed += 1
+            except Exception as e:
+                logging.warning(f"Location index refresh failed for {city_info.get('name')}: {e}")
+            time.sleep(LOCATION_INDEX_LOOKUP_PAUSE_SECONDS)
+        if changed:
+            self.save()
+            logging.info(f"Booking location index refreshed {changed} entries.")
+
+    def start_background_refresh(self, cities_provider, interval=3600):
+        """Keeps the index current from a daemon thread; safe to call more than once."""
+        if self._refresh_thread is not None:
+            return
+        def run():
+            while True:
+                try:
+                    self.refresh(cities_provider())
+                except Exception as e:
+                    logging.error(f"Booking location index refresh loop error: {e}", exc_info=True)
+                time.sleep(interval)
+        self._refresh_thread = threading.Thread(target=run, name='booking-location-index', daemon=True)
+        self._refresh_thread.start()
+
+BOOKING_LOCATION_INDEX = BookingLocationIndex(LOCATION_INDEX_FILE, SHARED_CACHE)
+BOOKING_LOCATION_INDEX.load()
+
+# --- Hotel Records & Source Adapters ---
+
+class HotelRecord:
+    """One normalized hotel from a single source.
+
+    Slots keep the thousands of records held by the search cache and spatial index small. The
+    record reads like a read-only mapping (get, [], in, keys), so merge, filters and dict(record,
+    extra=...) work unchanged, and dump_json_bytes turns it into a plain object at the edge.
+    """
+    __slots__ = ('id', 'name', 'address', 'coordinates', 'price', 'rating', 'source', 'booking_url')
+
+    def __init__(self, id, name, address, coordinates, price, rating, source, booking_url):
+        self.id = id
+        self.name = name
+        self.address = address
+        self.coordinates = coordinates
+        self.price = price
+        self.rating = rating
+        self.source = source
+        self.booking_url = booking_url
+
+    def __getitem__(self, key):
+        if key not in HotelRecord.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in HotelRecord.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in HotelRecord.__slots__ else default
+
+    def keys(self):
+        return HotelRecord.__slots__
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in HotelRecord.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(*(data.get(field) for field in cls.__slots__))
+
+    def __repr__(self):
+        return f"HotelRecord({self.source}:{self.id} {self.name!r})"
+
+class SourceAdapter(ABC):
+    """A hotel provider: resolve a city to the provider's location, search it, normalize the payload.
+
+    Registered adapters are what the single-source, dual, batch, paginated and calendar searches
+    iterate, so adding a provider is one subclass plus register_source_adapter(). A subclass that
+    misses resolve, search_request or normalize cannot be instantiated. Searches go out through
+    upstream_get, or upstream_get_async when the fan-out runs on the async upstream loop.
+    """
+    name = None         # key used in ?sources=, cache keys and SOURCE_ADAPTERS
+    label = None        # HotelRecord.source value
+    host = None         # upstream host for quotas, breakers and sessions
+    result_limit = None # hotels kept by the classic first-page endpoints
+    cache_ttl = 600
+    deadline = 6.0
+
+    @abstractmethod
+    def resolve(self, city_info):
+        """Returns the provider's location identifier for a city, or None when it has none."""
+
+    @abstractmethod
+    def search_request(self, location, params, page=1):
+        """Returns (host, path, query, endpoint) of the upstream GET for one result page."""
+
+    @abstractmethod
+    def normalize(self, payload, params, limit=None):
+        """Returns HotelRecords for a raw payload, at most limit of them."""
+
+    def search_cost(self, city_info):
+        """Estimated upstream calls for one uncached search of a city, for quota budgeting."""
+        return 1
+
+    def fetch(self, city_info, params, page=None):
+        """Uncached search; raises on upstream errors so failures are never cached.
+
+        page=None is the capped first page of the classic endpoints, page=N one full upstream page.
+        """
+        location = self.resolve(city_info)
+        if not location: return []
+        payload = self.search(location, params, page or 1)
+        with timed_stage(f'process-{self.name}'):
+            return self.normalize(payload, params, self.result_limit if page is None else None)
+
+    def search(self, location, params, page=1):
+        """Returns the raw provider payload for one result page."""
+        return upstream_get(*self.search_request(location, params, page))
+
+    async def resolve_async(self, city_info):
+        """resolve() on the async upstream loop; override it if resolving can call upstream."""
+        return self.resolve(city_info)
+
+    async def fetch_async(self, city_info, params, page=None):
+        """fetch() on the async upstream loop."""
+        location = await self.resolve_async(city_info)
+        if not location: return []
+        payload = await upstream_get_async(*self.search_request(location, params, page or 1))
+        with timed_stage(f'process-{self.name}'):
+            return self.normalize(payload, params, self.result_limit if page is None else None)
+
+class BookingAdapter(SourceAdapter):
+    name, label, host, result_limit = 'booking', 'booking.com', BOOKING_API_HOST, BOOKING_HOTEL_LIMIT
+
+    def resolve(self, city_info):
+        return BOOKING_LOCATION_INDEX.lookup(city_info)
+
+    async def resolve_async(self, city_info):
+        if BOOKING_LOCATION_INDEX.has(city_info):
+            return self.resolve(city_info)
+        # An unindexed city needs an auto-complete lookup; that is rare, so it keeps its blocking path.
+        return await asyncio.wrap_future(UPSTREAM_EXECUTOR.submit(self.resolve, city_info))
+
+    def search_cost(self, city_info):
+        return 1 if BOOKING_LOCATION_INDEX.has(city_info) else 2  # plus an auto-complete lookup
+
+    def search_request(self, location, params, page=1):
+        query = {"locationId": location, "checkinDate": params['checkin'], "checkoutDate": params['checkout'], "adults": params['adults'], "rooms": params['rooms'], "currency": "EUR"}
+        if page > 1: query["page"] = page
+        return BOOKING_API_HOST, "/stays/search", query, 'booking-search'
+
+    def normalize(self, payload, params, limit=None):
+        hotels_data = payload.get('data', []) if payload else []
+        if not isinstance(hotels_data, list): return []
+        nights = (datetime.strptime(params['checkout'], '%Y-%m-%d') - datetime.strptime(params['checkin'], '%Y-%m-%d')).days
+        processed = []
+        for hotel in hotels_data[:limit]:
+            price = 'N/A'
+            if price_info := hotel.get('priceBreakdown', {}).get('grossPrice', {}).get('value'):
+                price = int(price_info / nights) if nights > 0 else int(price_info)
+            processed.append(HotelRecord(
+                hotel.get('id'), hotel.get('name', 'Unknown Hotel'), hotel.get('address', 'N/A'),
+                [float(hotel.get('latitude', 0)), float(hotel.get('longitude', 0))],
+                price, round(float(hotel.get('reviewScore', 0.0)) / 2, 1), self.label, hotel.get('url', '#')))
+        return processed
+
+class TripAdvisorAdapter(SourceAdapter):
+    name, label, host, result_limit = 'tripadvisor', 'tripadvisor', TRIPADVISOR_API_HOST, TRIPADVISOR_HOTEL_LIMIT
+
+    def resolve(self, city_info):
+        return city_info.get('tripadvisor_id')
+
+    def search_request(self, location, params, page=1):
+        """Searches TripAdvisor using the confirmed working legacy endpoint."""
+        query = {"geoId": location, "checkIn": params['checkin'], "checkOut": params['checkout'], "adults": params['adults'], "rooms": "1", "currencyCode": "EUR"}
+        if page > 1: query["pageNumber"] = page
+        return TRIPADVISOR_API_HOST, "/api/v1/hotels/searchHotels", query, 'tripadvisor-search'
+
+    def normalize(self, payload, params, limit=None):
+        hotels_data = payload.get('data', {}).get('data', []) if payload else []
+        if not isinstance(hotels_data, list): return []
+        processed = []
+        for hotel in hotels_data[:limit]:
+            price = 'N/A'
+            if price_str := hotel.get('priceForDisplay'):
+                if numbers := URL_REGEX.findall(price_str.replace(',', '')):
+                    price = int(numbers[0])
+
+            # KORRIGERING: Använd den externa URL:en direkt, eftersom den är komplett.
+            booking_url = hotel.get('commerceInfo', {}).get('externalUrl')
+            # Fallback om den externa länken saknas
+            if not booking_url:
+                booking_url = f"https://www.tripadvisor.com/Search?q={quote_plus(hotel.get('title', 'Hotel'))}"
+
+            geo = hotel.get('geoSummary', {})
+            processed.append(HotelRecord(
+                hotel.get('id'), hotel.get('title', 'Unknown Hotel'), hotel.get('secondaryInfo', 'N/A'),
+                [float(geo.get('latitude', 0)), float(geo.get('longitude', 0))],
+                price, float(hotel.get('bubbleRating', {}).get('rating', 4.0)), self.label, booking_url))
+        return processed
+
+SOURCE_ADAPTERS = {}
+SOURCE_LABELS = {}  # HotelRecord.source -> adapter name
+
+def register_source_adapter(adapter):
+    """Makes a provider available to every search route; settings for it default from the adapter."""
+    if not isinstance(adapter, SourceAdapter):
+        raise TypeError(f"Source adapters must subclass SourceAdapter, got {type(adapter).__name__}")
+    missing = [attr for attr in ('name', 'label', 'host') if not getattr(adapter, attr)]
+    if missing:
+        raise ValueError(f"{type(adapter).__name__} is missing {', '.join(missing)}")
+    SOURCE_ADAPTERS[adapter.name] = adapter
+    SOURCE_LABELS[adapter.label] = adapter.name
+    SEARCH_CACHE_TTLS.setdefault(adapter.name, adapter.cache_ttl)
+    SOURCE_DEADLINES.setdefault(adapter.name, adapter.deadline)
+    return adapter
+
+register_source_adapter(BookingAdapter())
+register_source_adapter(TripAdvisorAdapter())
+
+# --- Cross-source Merge ---
+
+def normalize_hotel_name(name):
+    """Accent-free, lower-case name tokens without generic words like 'hotel', for fuzzy matching."""
+    ascii_name = unicodedata.normalize('NFKD', str(name or '')).encode('ascii', 'ignore').decode('ascii').lower()
+    tokens = [token for token in NAME_TOKEN_REGEX.findall(ascii_name) if token not in NAME_STOPWORDS]
+    return frozenset(tokens) or frozenset(NAME_TOKEN_REGEX.findall(ascii_name))
+
+def name_similarity(tokens_a, tokens_b):
+    """Token Jaccard similarity, treating one name contained in the other as a match."""
+    if not tokens_a or not tokens_b:
+        return 0.0
+    if tokens_a <= tokens_b or tokens_b <= tokens_a:
+        return 1.0
+    return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
+def grid_cell(lat, lon, cell_degrees):
+    return (math.floor(lat / cell_degrees), math.floor(lon / cell_degrees))
+
+def has_coordinates(hotel):
+    coordinates = hotel.get('coordinates') or [0, 0]
+    return len(coordinates) == 2 and (coordinates[0] or coordinates[1])
+
+def _merged_record(offers):
+    priced = [offer for offer in offers if isinstance(offer['price'], (int, float))]
+    cheapest = min(priced, key=lambda offer: offer['price']) if priced else None
+    primary = offers[0]['hotel']
+    ratings = [offer['rating'] for offer in offers if offer['rating']]
+    best = cheapest or offers[0]
+    return {
+        'id': primary.get('id'), 'name': primary.get('name'), 'address': primary.get('address'),
+        'coordinates': primary.get('coordinates'),
+        'price': cheapest['price'] if cheapest else 'N/A',
+        'rating': round(sum(ratings) / len(ratings), 1) if ratings else 0,
+        'source': best['source'], 'booking_url': best['booking_url'],
+        'sources': [offer['source'] for offer in offers],
+        'prices': {offer['source']: offer['price'] for offer in offers},
+        'offers': [{key: value for key, value in offer.items() if key != 'hotel'} for offer in offers],
+        'cheapest': {key: cheapest[key] for key in ('source', 'price', 'booking_url')} if cheapest else None,
+    }
+
+def merge_hotel_sources(hotel_lists):
+    """Collapses the same property found by several sources into one record with per-source prices.
+
+    Hotels are bucketed into a lat/lon grid and only compared by normalized name against groups
+    in the 3x3 neighbouring cells, so the merge is near-linear rather than all-pairs. Hotels
+    without coordinates only match on an identical normalized name.
+    """
+    groups = []
+    grid = {}
+    by_name = {}
+    for hotels in hotel_lists:
+        for hotel in hotels:
+            tokens = normalize_hotel_name(hotel.get('name'))
+            offer = {'source': hotel.get('source'), 'id': hotel.get('id'), 'price': hotel.get('price'), 'rating': hotel.get('rating'), 'booking_url': hotel.get('booking_url'), 'hotel': hotel}
+            match, best_score = None, MERGE_NAME_SIMILARITY
+            if has_coordinates(hotel):
+                row, col = grid_cell(hotel['coordinates'][0], hotel['coordinates'][1], MERGE_CELL_DEGREES)
+                for d_row in (-1, 0, 1):
+                    for d_col in (-1, 0, 1):
+                        for group in grid.get((row + d_row, col + d_col), ()):
+                            if offer['source'] in group['sources']:
+                                continue
+                            score = name_similarity(tokens, group['tokens'])
+                            if score >= best_score:
+                                match, best_score = group, score
+            else:
+                match = next((group for group in by_name.get(tokens, ()) if offer['source'] not in group['sources']), None)
+            if match is None:
+                match = {'tokens': tokens, 'offers': [], 'sources': set()}
+                groups.append(match)
+                if has_coordinates(hotel):
+                    grid.setdefault((row, col), []).append(match)
+                else:
+                    by_name.setdefault(tokens, []).append(match)
+            match['offers'].append(offer)
+            match['sources'].add(offer['source'])
+    return [_merged_record(group['offers']) for group in groups]
+
+def wants_merge(args):
+    return str(args.get('merge', '')).lower() in ('1', 'true')
+
+# --- Search Result Cache ---
+
+class _Flight:
+    """One in-progress upstream fetch that concurrent identical misses wait on, from threads or the async loop."""
+    __slots__ = ('done', 'value', 'error', '_callbacks', '_lock')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def finish(self):
+        with self._lock:
+            self.done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def notify(self, callback):
+        """Calls callback() once the flight is done, right away if it already is."""
+        with self._lock:
+            if not self.done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    async def wait_async(self, timeout):
+        """done.wait() for the async upstream loop; False on timeout."""
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self.notify(lambda: loop.call_soon_threadsafe(lambda: waiter.done() or waiter.set_result(None)))
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+class SearchResultCache:
+    """Bounded LRU cache of processed hotel lists with TTL, stale-while-revalidate and single-flight.
+
+    With a SharedCache, misses first look in the host-wide cache and fetches are coalesced across
+    worker processes, so one upstream call fills every worker. decode turns a value read back from
+    the shared cache's JSON into its in-memory form.
+    """
+
+    def __init__(self, max_entries, stale_seconds, shared=None, namespace='search', decode=None):
+        self.max_entries = max_entries
+        self.stale_seconds = stale_seconds
+        self.shared = shared
+        self.namespace = namespace
+        self.decode = decode
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'coalesced': 0, 'refreshes': 0, 'errors': 0, 'evictions': 0, 'shared_hits': 0}
+
+    def _store(self, key, value, fresh_until, stale_until, fetched=True):
+        digest = hashlib.blake2b(dump_json_bytes(value), digest_size=12).hexdigest()
+        with self._lock:
+            self._entries[key] = (value, fresh_until, stale_until, digest)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters['evictions'] += 1
+        for listener, include_shared in self._listeners:
+            if not fetched and not include_shared:
+                continue
+            try:
+                listener(key, value, stale_until)
+            except Exception as e:
+                logging.error(f"Search cache listener failed: {e}", exc_info=True)
+
+    def add_listener(self, listener, include_shared=True):
+        """Registers listener(key, value, expires_at), called after every freshly stored result.
+
+        include_shared=False skips results another worker fetched, for listeners that must see
+        each upstream result once per host.
+        """
+        self._listeners.append((listener, include_shared))
+
+    def _run_flight(self, key, flight, ttl, fetch, force=False):
+        try:
+            if self.shared is None:
+                now = time.time()
+                flight.value = fetch()
+                self._store(key, flight.value, now + ttl, now + ttl + self.stale_seconds)
+            else:
+                newer_than = 0.0
+                if force:
+                    with self._lock:
+                        entry = self._entries.get(key)
+                    newer_than = entry[1] if entry else time.time()
+                self._land_shared(key, flight, *self.shared.fetch(SharedCache.key_for(self.namespace, key), fetch, ttl, self.stale_seconds, newer_than))
+        except Exception as e:
+            self._flight_failed(flight, e)
+        finally:
+            self._flight_landed(key, flight)
+
+    async def _run_flight_async(self, key, flight, ttl, fetch):
+        """_run_flight on the async upstream loop; fetch is a coroutine function."""
+        try:
+            if self.shared is None:
+                now = time.time()
+                flight.value = await fetch()
+                self._store(key, flight.value, now + ttl, now + ttl + self.stale_seconds)
+            else:
+                self._land_shared(key, flight, *await self.shared.fetch_async(SharedCache.key_for(self.namespace, key), fetch, ttl, self.stale_seconds))
+        except Exception as e:
+            self._flight_failed(flight, e)
+        finally:
+            self._flight_landed(key, flight)
+
+    def _land_shared(self, key, flight, entry, fetched):
+        flight.value, fresh_until, stale_until = entry
+        if not fetched:
+            if self.decode is not None:
+                flight.value = self.decode(flight.value)
+            with self._lock:
+                self.counters['shared_hits'] += 1
+        self._store(key, flight.value, fresh_until, stale_until, fetched)
+
+    def _flight_failed(self, flight, error):
+        flight.error = error
+        with self._lock:
+            self.counters['errors'] += 1
+
+    def _flight_landed(self, key, flight):
+        with self._lock:
+            self._flights.pop(key, None)
+        flight.finish()
+
+    def _end_flight(self, key, flight, error):
+        """Completes a flight whose fetch never ran, so nobody waits on it and a later hit retries."""
+        flight.error = error
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.finish()
+
+    def _start_background_refresh(self, key, ttl, fetch):
+        # Called with self._lock held; returns the flight to submit once the lock is released.
+        if key in self._flights:
+            return None
+        flight = self._flights[key] = _Flight()
+        self.counters['refreshes'] += 1
+        return flight
+
+    def _submit_refresh(self, key, flight, ttl, fetch):
+        try:
+            future = UPSTREAM_EXECUTOR.submit(self._run_flight, key, flight, ttl, fetch)
+        except UpstreamCapacityError as e:
+            # No capacity for a refresh right now; keep serving stale and retry on a later hit.
+            self._end_flight(key, flight, e)
+            return
+        def on_done(future):
+            # The executor drops work that queued too long without calling _run_flight, whose
+            # finally would otherwise be the only thing that ever completes the flight.
+            if not flight.done.is_set():
+                self._end_flight(key, flight, future.exception() or UpstreamCapacityError("Search refresh did not run"))
+        future.add_done_callback(on_done)
 
-def fetch_booking_hotels_helper(city_info, params):
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def is_fresh(self, key):
+        """True if key is fresh here or in the shared cache, i.e. a fetch would cost no upstream call."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and time.time() < entry[1]:
+            return True
+        if self.shared is None:
+            return False
+        shared_entry = self.shared.get(SharedCache.key_for(self.namespace, key))
+        return shared_entry is not None and time.time() < shared_entry[1]
+
+    def peek(self, key):
+        """Returns a fresh or stale cached value without fetching, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and time.time() < entry[2]:
+            return entry[0]
+        return None
+
+    def _cached(self, key, ttl, fetch, now):
+        # Called with self._lock held; returns (value or None on a miss, refresh flight to submit or None).
+        entry = self._entries.get(key)
+        if entry is None:
+            return None, None
+        value, fresh_until, stale_until, _ = entry
+        if now < fresh_until:
+            self._entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return value, None
+        if now < stale_until:
+            self._entries.move_to_end(key)
+            self.counters['stale_hits'] += 1
+            return value, self._start_background_refresh(key, ttl, fetch)
+        del self._entries[key]
+        return None, None
+
+    def get_if_cached(self, key, ttl, fetch):
+        """Returns a fresh or stale cached value without waiting on a fetch, else None.
+
+        A stale hit still schedules its background refresh, exactly as get_or_fetch would.
+        """
+        with self._lock:
+            value, refresh = self._cached(key, ttl, fetch, time.time())
+        if refresh is not None:
+            self._submit_refresh(key, refresh, ttl, fetch)
+        return value
+
+    def _join(self, key, ttl, fetch):
+        """Returns (cached value, None, False) on a hit, else (None, flight, whether this caller leads it)."""
+        with self._lock:
+            value, refresh = self._cached(key, ttl, fetch, time.time())
+            if value is None:
+                flight = self._flights.get(key)
+                if flight is not None:
+                    self.counters['coalesced'] += 1
+                    leader = False
+                else:
+                    flight = self._flights[key] = _Flight()
+                    self.counters['misses'] += 1
+                    leader = True
+        if value is not None:
+            if refresh is not None:
+                self._submit_refresh(key, refresh, ttl, fetch)
+            return value, None, False
+        return None, flight, leader
+
+    def get_or_fetch(self, key, ttl, fetch):
+        """Returns the cached value for key, calling fetch() at most once across concurrent misses."""
+        value, flight, leader = self._join(key, ttl, fetch)
+        if flight is None:
+            return value
+        return self._await_flight(key, flight, leader, ttl, fetch)
+
+    async def get_or_fetch_async(self, key, ttl, fetch, fetch_async):
+        """get_or_fetch on the async upstream loop: a miss awaits fetch_async(), and joining another
+        caller's fetch suspends instead of blocking. A stale hit still refreshes with fetch() on the executor.
+        """
+        value, flight, leader = self._join(key, ttl, fetch)
+        if flight is None:
+            return value
+        if leader:
+            await self._run_flight_async(key, flight, ttl, fetch_async)
+        elif not await flight.wait_async(SEARCH_FLIGHT_MAX_WAIT_SECONDS):
+            raise UpstreamCapacityError("Timed out waiting for an identical search in flight")
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def refresh(self, key, ttl, fetch):
+        """Fetches and stores a new value now, joining a refresh that is already in flight."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.counters['refreshes'] += 1
+        return self._await_flight(key, flight, leader, ttl, fetch, force=True)
+
+    def _await_flight(self, key, flight, leader, ttl, fetch, force=False):
+        if leader:
+            self._run_flight(key, flight, ttl, fetch, force)
+        elif not flight.done.wait(SEARCH_FLIGHT_MAX_WAIT_SECONDS):
+            raise UpstreamCapacityError("Timed out waiting for an identical search in flight")
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def digest_of(self, key, value):
+        """Content hash of the cached value for key, or None if value is not the one currently cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry[3] if entry and entry[0] is value else None
+
+    def time_to_live(self, key):
+        """Seconds until the cached value stops being fresh (negative once stale), or None if absent."""
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry[1] - time.time() if entry else None
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, size=len(self._entries), in_flight=len(self._flights), max_entries=self.max_entries)
+
+SEARCH_CACHE = SearchResultCache(SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_STALE_SECONDS, SHARED_CACHE,
+                                 decode=lambda hotels: [HotelRecord.from_dict(hotel) for hotel in hotels])
+
+def search_cache_key(source, params, page=None):
+    """Key for a source's capped first page, or with page=N for one full upstream page."""
+    key = (source, params['city_key'], params['checkin'], params['checkout'], str(params['adults']), str(params['rooms']))
+    return key if page is None else key + (page,)
+
+# --- Spatial Index ---
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    d_lat, d_lon = math.radians(lat2 - lat1), math.radians(lon2 - lon1)
+    a = math.sin(d_lat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(d_lon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+class SpatialIndex:
+    """Thread-safe uniform lat/lon grid supporting radius, bounding-box and nearest-item queries."""
+
+    def __init__(self, cell_degrees):
+        self.cell_degrees = cell_degrees
+        self._cells = {}
+        self._locations = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._locations)
+
+    def insert(self, item_key, lat, lon, payload):
+        cell = grid_cell(lat, lon, self.cell_degrees)
+        with self._lock:
+            old_cell = self._locations.get(item_key)
+            if old_cell is not None and old_cell != cell:
+                self._cells[old_cell].pop(item_key, None)
+            self._cells.setdefault(cell, {})[item_key] = (lat, lon, payload)
+            self._locations[item_key] = cell
+
+    def remove(self, item_key):
+        with self._lock:
+            cell = self._locations.pop(item_key, None)
+            if cell is not None:
+                self._cells[cell].pop(item_key, None)
+                if not self._cells[cell]:
+                    del self._cells[cell]
+
+    def _cells_in_bbox(self, south, west, north, east):
+        """Cell contents overlapping the box, scanning occupied cells when the box spans more of them."""
+        row_min, col_min = grid_cell(south, west, self.cell_degrees)
+        row_max, col_max = grid_cell(north, east, self.cell_degrees)
+        with self._lock:
+            if (row_max - row_min + 1) * (col_max - col_min + 1) > len(self._cells):
+                return [list(items.values()) for (row, col), items in self._cells.items() if row_min <= row <= row_max and col_min <= col <= col_max]
+            return [list(self._cells[(row, col)].values()) for row in range(row_min, row_max + 1) for col in range(col_min, col_max + 1) if (row, col) in self._cells]
+
+    def within_bbox(self, south, west, north, east):
+        """Returns (lat, lon, payload) for every item inside the box."""
+        return [(lat, lon, payload) for items in self._cells_in_bbox(south, west, north, east) for lat, lon, payload in items
+                if south <= lat <= north and west <= lon <= east]
+
+    def within_radius(self, lat, lon, radius_km):
+        """Returns (distance_km, payload) for items within radius_km, nearest first."""
+        d_lat = radius_km / 111.32
+        d_lon = radius_km / max(0.01, 111.32 * math.cos(math.radians(lat)))
+        found = []
+        for items in self._cells_in_bbox(lat - d_lat, lon - d_lon, lat + d_lat, lon + d_lon):
+            for item_lat, item_lon, payload in items:
+                distance = haversine_km(lat, lon, item_lat, item_lon)
+                if distance <= radius_km:
+                    found.append((distance, payload))
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def nearest(self, lat, lon, limit=1, max_rings=180):
+        """Returns up to limit (distance_km, payload) pairs, searching outward ring by ring."""
+        row, col = grid_cell(lat, lon, self.cell_degrees)
+        found = []
+        for ring in range(max_rings):
+            with self._lock:
+                if not self._cells:
+                    return []
+                ring_items = [item for (r, c), items in ((cell, self._cells.get(cell)) for cell in self._ring(row, col, ring)) if items for item in items.values()]
+            found.extend((haversine_km(lat, lon, item_lat, item_lon), payload) for item_lat, item_lon, payload in ring_items)
+            # Anything outside this ring is at least `ring` cells away, so stop once enough closer items exist.
+            if len(found) >= limit and ring > 0:
+                found.sort(key=lambda item: item[0])
+                if found[limit - 1][0] <= ring * self.cell_degrees * 111.32 * max(0.01, math.cos(math.radians(min(89.0, abs(lat) + ring * self.cell_degrees)))):
+                    break
+        found.sort(key=lambda item: item[0])
+        return found[:limit]
+
+    @staticmethod
+    def _ring(row, col, ring):
+        if ring == 0:
+            return [(row, col)]
+        cells = [(row + d, col + e) for d in (-ring, ring) for e in range(-ring, ring + 1)]
+        return cells + [(row + d, col + e) for e in (-ring, ring) for d in range(-ring + 1, ring)]
+
+def build_city_index(cities):
+    index = SpatialIndex(CITY_INDEX_CELL_DEGREES)
+    for key, city_info in cities.items():
+        if city_info.get('lat') is not None and city_info.get('lon') is not None:
+            index.insert(key, city_info['lat'], city_info['lon'], key)
+    return index
+
+# --- City Catalog ---
+
+def normalize_city_term(text):
+    """Accent-free, lower-case words joined by single spaces: 'Göteborg ' -> 'goteborg'."""
+    ascii_text = unicodedata.normalize('NFKD', str(text or '')).encode('ascii', 'ignore').decode('ascii').lower()
+    return ' '.join(NAME_TOKEN_REGEX.findall(ascii_text))
+
+class CityCatalog:
+    """An immutable snapshot of the city list plus every lookup index, built once per load.
+
+    Reloads build a new catalog and swap the module globals, so a request keeps whatever
+    snapshot it started with and never sees a half-built index.
+    """
+
+    def __init__(self, cities, mtime=None):
+        self.cities = cities
+        self.mtime = mtime
+        self.spatial = build_city_index(cities)
+        self.by_country = {}
+        self.by_name = {}
+        self._trie = {}
+        self._words = {}
+        ranked = sorted(cities, key=lambda key: cities[key].get('name', key))
+        terms = {key: self._terms(key, cities[key]) for key in ranked}
+        for key in ranked:
+            self.by_country.setdefault(cities[key]['country'], []).append(key)
+            self._words[key] = tuple(dict.fromkeys(terms[key] + [word for term in terms[key] for word in term.split(' ')[1:]]))
+        # Full names and aliases are inserted before single words, so they rank first in suggestions.
+        for key in ranked:
+            for term in terms[key]:
+                self.by_name.setdefault(term, key)
+                self._insert(term, key)
+        for key in ranked:
+            for word in self._words[key][len(terms[key]):]:
+                self._insert(word, key)
+
+    @staticmethod
+    def _terms(key, city_info):
+        query_name = city_info.get('search_query', '').rsplit(' ', 1)[0]
+        raw_terms = [key, city_info.get('name'), query_name] + city_info.get('aliases', [])
+        return list(dict.fromkeys(term for term in map(normalize_city_term, raw_terms) if term))
+
+    def _insert(self, term, key):
+        node = self._trie
+        for char in term:
+            node = node.setdefault(char, {})
+            keys = node.setdefault('', [])
+            if key not in keys and len(keys) < CITY_TRIE_KEYS_PER_NODE:
+                keys.append(key)
+
+    def resolve(self, text):
+        """Maps a key, name or alias (any case or accents) to a city key, or None."""
+        if text in self.cities:
+            return text
+        return self.by_name.get(normalize_city_term(text))
+
+    def suggest(self, prefix, limit=10, country=None):
+        """City keys whose name, alias or any word of them starts with prefix, best matches first."""
+        node = self._trie
+        for char in normalize_city_term(prefix):
+            node = node.get(char)
+            if node is None:
+                return []
+        keys = node.get('', [])
+        if country:
+            matches = [key for key in keys if self.cities[key]['country'] == country]
+            if len(matches) < limit and len(keys) >= CITY_TRIE_KEYS_PER_NODE:
+                # The node kept only its best keys; scan the country's own cities instead.
+                prefix = normalize_city_term(prefix)
+                matches = [key for key in self.by_country.get(country, []) if any(word.startswith(prefix) for word in self._words[key])]
+            keys = matches
+        return keys[:limit]
+
+CITY_CATALOG = CityCatalog(CITIES, os.path.getmtime(CITIES_FILE) if os.path.exists(CITIES_FILE) else None)
+CITY_INDEX = CITY_CATALOG.spatial
+
+def reload_city_catalog(force=False):
+    """Rebuilds the catalog when the CSV changed and swaps it in; a bad or empty file keeps the old one."""
+    global CITY_CATALOG, CITIES, CITY_INDEX
     try:
-        location_id = get_booking_location_id(city_info['search_query'], city_info['country'])
-        if not location_id: return []
-        api_data = search_booking_hotels(location_id, params['checkin'], params['checkout'], params['adults'], params['rooms'])
-        return process_booking_hotels(api_data, params, city_info)
-    except Exception as e:
-        logging.error(f"Exception in fetch_booking_hotels_helper: {e}")
-        return []
+        mtime = os.path.getmtime(CITIES_FILE)
+    except OSError:
+        return False
+    if not force and mtime == CITY_CATALOG.mtime:
+        return False
+    cities = load_cities_from_csv(CITIES_FILE)
+    if not cities:
+        logging.error(f"City catalog reload skipped, {CITIES_FILE} produced no cities; keeping {len(CITIES)} cities.")
+        CITY_CATALOG.mtime = mtime
+        return False
+    catalog = CityCatalog(cities, mtime)
+    added, removed = cities.keys() - CITIES.keys(), CITIES.keys() - cities.keys()
+    CITY_CATALOG, CITIES, CITY_INDEX = catalog, cities, catalog.spatial
+    logging.info(f"City catalog reloaded: {len(cities)} cities ({len(added)} added, {len(removed)} removed).")
+    return True
+
+def start_city_catalog_watcher(interval=CITY_CATALOG_POLL_SECONDS):
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                reload_city_catalog()
+            except Exception as e:
+                logging.error(f"City catalog reload failed: {e}", exc_info=True)
+    threading.Thread(target=run, name='city-catalog-watcher', daemon=True).start()
+
+if os.environ.get('CITY_CATALOG_WATCH', '1') == '1':
+    start_city_catalog_watcher()
+
+class HotelSpatialIndex:
+    """Indexes every hotel the search cache stores, so map queries never go upstream."""
+
+    def __init__(self, cell_degrees):
+        self.index = SpatialIndex(cell_degrees)
+        self._expiry = {}
+        self._lock = threading.Lock()
+        self._stores = 0
+
+    def on_cache_store(self, cache_key, hotels, expires_at):
+        source, city_key, checkin, checkout, adults, rooms = cache_key[:6]
+        search = {'city_key': city_key, 'checkin': checkin, 'checkout': checkout, 'adults': adults, 'rooms': rooms}
+        for hotel in hotels or []:
+            if not has_coordinates(hotel):
+                continue
+            item_key = (source, hotel.get('id'), checkin, checkout, adults, rooms)
+            self.index.insert(item_key, hotel['coordinates'][0], hotel['coordinates'][1], (hotel, search, expires_at))
+            with self._lock:
+                self._expiry[item_key] = expires_at
+        with self._lock:
+            self._stores += 1
+            prune = self._stores % 50 == 0
+        if prune:
+            self.prune()
+
+    def prune(self):
+        now = time.time()
+        with self._lock:
+            expired = [item_key for item_key, expires_at in self._expiry.items() if expires_at < now]
+            for item_key in expired:
+                del self._expiry[item_key]
+        for item_key in expired:
+            self.index.remove(item_key)
+
+    @staticmethod
+    def _select(entries, filters):
+        """Drops expired entries and ones from other searches, keeping one record per (source, hotel id)."""
+        now = time.time()
+        chosen = {}
+        for distance, (hotel, search, expires_at) in entries:
+            if expires_at < now or any(search[name] != value for name, value in filters.items() if value):
+                continue
+            identity = (hotel.get('source'), hotel.get('id'))
+            if identity not in chosen or chosen[identity][2] < expires_at:
+                chosen[identity] = (distance, hotel, expires_at, search)
+        return list(chosen.values())
+
+    def within_radius(self, lat, lon, radius_km, filters):
+        selected = self._select(self.index.within_radius(lat, lon, radius_km), filters)
+        selected.sort(key=lambda item: item[0])
+        return [dict(hotel, distance_km=round(distance, 3), city_key=search['city_key']) for distance, hotel, _, search in selected]
+
+    def within_bbox(self, south, west, north, east, filters):
+        entries = [(None, payload) for _, _, payload in self.index.within_bbox(south, west, north, east)]
+        return [dict(hotel, city_key=search['city_key']) for _, hotel, _, search in self._select(entries, filters)]
+
+HOTEL_INDEX = HotelSpatialIndex(HOTEL_INDEX_CELL_DEGREES)
+SEARCH_CACHE.add_listener(HOTEL_INDEX.on_cache_store)
+
+# --- Price History ---
+
+class PriceHistoryStore:
+    """Append-only SQLite store of observed nightly prices per hotel, source and stay date.
+
+    Observations are queued by the search cache listener and written in batches by one writer
+    thread, so requests never wait on disk. An unchanged price for the same stay is only
+    recorded again after min_interval seconds, which keeps the table compact. The writer also
+    keeps latest_prices, one row per stay, so city percentiles never scan the history.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS price_snapshots ("
+        " source TEXT NOT NULL, hotel_id TEXT NOT NULL, checkin INTEGER NOT NULL, nights INTEGER NOT NULL,"
+        " observed_at INTEGER NOT NULL, city_key TEXT NOT NULL, price INTEGER NOT NULL,"
+        " PRIMARY KEY (source, hotel_id, checkin, nights, observed_at)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS price_snapshots_city ON price_snapshots (city_key, observed_at, checkin, price)",
+        "CREATE TABLE IF NOT EXISTS latest_prices ("
+        " source TEXT NOT NULL, hotel_id TEXT NOT NULL, checkin INTEGER NOT NULL, nights INTEGER NOT NULL,"
+        " observed_at INTEGER NOT NULL, city_key TEXT NOT NULL, price INTEGER NOT NULL,"
+        " PRIMARY KEY (source, hotel_id, checkin, nights)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS latest_prices_city ON latest_prices (city_key, observed_at, price)",
+        "CREATE INDEX IF NOT EXISTS latest_prices_city_checkin ON latest_prices (city_key, checkin, observed_at, price)",
+    )
+    LATEST_UPSERT = ('INSERT INTO latest_prices VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (source, hotel_id, checkin, nights)'
+                     ' DO UPDATE SET observed_at = excluded.observed_at, city_key = excluded.city_key, price = excluded.price'
+                     ' WHERE excluded.observed_at >= latest_prices.observed_at')
+
+    def __init__(self, path, flush_seconds, batch_size, max_pending, min_interval, retention_days):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.min_interval = min_interval
+        self.retention_days = retention_days
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._last_seen = {}
+        self._last_seen_lock = threading.Lock()
+        self._local = threading.local()
+        self._writer = None
+        self.counters = {'observed': 0, 'skipped_unchanged': 0, 'dropped': 0, 'written': 0, 'batches': 0, 'pruned': 0}
+        with self._connect() as conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            if conn.execute('SELECT 1 FROM latest_prices LIMIT 1').fetchone() is None:
+                # A store written before latest_prices existed: one pass picks each stay's newest row.
+                conn.execute('INSERT INTO latest_prices SELECT source, hotel_id, checkin, nights, MAX(observed_at), city_key, price'
+                             ' FROM price_snapshots GROUP BY source, hotel_id, checkin, nights')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def observe(self, city_key, checkin, checkout, hotels, observed_at=None):
+        """Queues one observation per priced hotel; never blocks the caller."""
+        observed_at = int(observed_at or time.time())
+        checkin_day = datetime.strptime(checkin, '%Y-%m-%d').date().toordinal()
+        nights = max(1, datetime.strptime(checkout, '%Y-%m-%d').date().toordinal() - checkin_day)
+        for hotel in hotels:
+            price = hotel.get('price')
+            if not isinstance(price, (int, float)) or hotel.get('id') is None:
+                continue
+            source = SOURCE_LABELS.get(hotel.get('source'), hotel.get('source'))
+            hotel_id = str(hotel['id'])
+            stay = (source, hotel_id, checkin_day, nights)
+            with self._last_seen_lock:
+                last_price, last_at = self._last_seen.get(stay, (None, 0))
+                if last_price == int(price) and observed_at - last_at < self.min_interval:
+                    self.counters['skipped_unchanged'] += 1
+                    continue
+                self._last_seen[stay] = (int(price), observed_at)
+            try:
+                self._pending.put_nowait(stay + (observed_at, city_key, int(price)))
+                self.counters['observed'] += 1
+            except queue.Full:
+                self.counters['dropped'] += 1
 
-def fetch_tripadvisor_hotels_helper(city_info, params):
+    def on_cache_store(self, cache_key, hotels, expires_at):
+        source, city_key, checkin, checkout = cache_key[:4]
+        self.observe(city_key, checkin, checkout, hotels)
+
+    def flush(self, conn=None):
+        """Writes every queued observation in batches and returns how many rows were written."""
+        conn = conn or self._reader()
+        written = 0
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return written
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO price_snapshots VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+                conn.executemany(self.LATEST_UPSERT, batch)
+            written += len(batch)
+            self.counters['written'] += len(batch)
+            self.counters['batches'] += 1
+
+    def prune(self, conn=None):
+        """Drops snapshots older than the retention window and forgets stale dedupe entries."""
+        cutoff = int(time.time()) - self.retention_days * 86400
+        conn = conn or self._reader()
+        with conn:
+            removed = conn.execute('DELETE FROM price_snapshots WHERE observed_at < ?', (cutoff,)).rowcount
+            conn.execute('DELETE FROM latest_prices WHERE observed_at < ?', (cutoff,))
+        with self._last_seen_lock:
+            self._last_seen = {stay: seen for stay, seen in self._last_seen.items() if seen[1] >= time.time() - self.min_interval}
+        self.counters['pruned'] += removed
+        return removed
+
+    def start(self):
+        if self._writer is not None:
+            return
+        def run():
+            conn = self._connect()
+            last_prune = 0
+            while True:
+                time.sleep(self.flush_seconds)
+                try:
+                    self.flush(conn)
+                    if time.time() - last_prune > 3600:
+                        self.prune(conn)
+                        last_prune = time.time()
+                except Exception as e:
+                    logging.error(f"Price history flush failed: {e}", exc_info=True)
+        self._writer = threading.Thread(target=run, name='price-history-writer', daemon=True)
+        self._writer.start()
+
+    def trend(self, source, hotel_id, checkin=None, nights=None, since=None):
+        """Price observations for one hotel, oldest first, optionally for one stay."""
+        sql = 'SELECT checkin, nights, observed_at, price FROM price_snapshots WHERE source = ? AND hotel_id = ?'
+        args = [source, str(hotel_id)]
+        if checkin:
+            sql += ' AND checkin = ?'
+            args.append(datetime.strptime(checkin, '%Y-%m-%d').date().toordinal())
+        if nights:
+            sql += ' AND nights = ?'
+            args.append(nights)
+        if since:
+            sql += ' AND observed_at >= ?'
+            args.append(int(since))
+        rows = self._reader().execute(sql + ' ORDER BY observed_at', args).fetchall()
+        return [{'checkin': datetime.fromordinal(day).strftime('%Y-%m-%d'), 'nights': stay_nights,
+                 'observed_at': datetime.fromtimestamp(at, timezone.utc).isoformat(timespec='seconds'), 'price': price}
+                for day, stay_nights, at, price in rows]
+
+    def city_prices(self, city_key, since, checkin=None):
+        """Latest nightly price per hotel and stay in a city, for stays last observed since a timestamp."""
+        if checkin:
+            sql = 'SELECT price FROM latest_prices WHERE city_key = ? AND checkin = ? AND observed_at >= ?'
+            args = (city_key, datetime.strptime(checkin, '%Y-%m-%d').date().toordinal(), int(since))
+        else:
+            sql = 'SELECT price FROM latest_prices WHERE city_key = ? AND observed_at >= ?'
+            args = (city_key, int(since))
+        return sorted(price for (price,) in self._reader().execute(sql, args))
+
+    def stats(self):
+        return dict(self.counters, pending=self._pending.qsize(), path=self.path)
+
+def percentile_of(sorted_values, pct):
+    """Linear-interpolated percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * pct / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return round(sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower), 1)
+
+PRICE_HISTORY = None
+if os.environ.get('PRICE_HISTORY_ENABLED', '1') == '1':
+    try:
+        PRICE_HISTORY = PriceHistoryStore(PRICE_HISTORY_DB, PRICE_HISTORY_FLUSH_SECONDS, PRICE_HISTORY_BATCH_SIZE, PRICE_HISTORY_MAX_PENDING,
+                                          PRICE_HISTORY_MIN_INTERVAL_SECONDS, PRICE_HISTORY_RETENTION_DAYS)
+        SEARCH_CACHE.add_listener(PRICE_HISTORY.on_cache_store, include_shared=False)
+        PRICE_HISTORY.start()
+    except sqlite3.Error as e:
+        logging.error(f"Price history disabled, could not open {PRICE_HISTORY_DB}: {e}")
+
+# --- Helper Functions for Parallel Execution ---
+
+def cached_source_search(source, city_info, params, refresh=False):
+    """Cached, coalesced search for one source; raises on upstream errors. refresh=True bypasses a fresh entry."""
+    cache_call = SEARCH_CACHE.refresh if refresh else SEARCH_CACHE.get_or_fetch
+    return cache_call(search_cache_key(source, params), SEARCH_CACHE_TTLS[source], lambda: SOURCE_ADAPTERS[source].fetch(city_info, params))
+
+def cached_source_page(source, city_info, params, page):
+    """Cached, coalesced full upstream page for one source; raises on upstream errors."""
+    return SEARCH_CACHE.get_or_fetch(search_cache_key(source, params, page), SEARCH_CACHE_TTLS[source], lambda: SOURCE_ADAPTERS[source].fetch(city_info, params, page))
+
+async def cached_source_search_async(source, city_info, params, page=None):
+    """cached_source_search, or cached_source_page with a page, on the async upstream loop."""
+    adapter = SOURCE_ADAPTERS[source]
+    return await SEARCH_CACHE.get_or_fetch_async(search_cache_key(source, params, page), SEARCH_CACHE_TTLS[source],
+                                                 lambda: adapter.fetch(city_info, params, page), lambda: adapter.fetch_async(city_info, params, page))
+
+def source_search_job(source, city_info, params, page=None):
+    """The fan-out callable for an uncached search: a coroutine function on the async upstream loop when it runs, else a blocking call."""
+    if ASYNC_UPSTREAM is not None:
+        return functools.partial(cached_source_search_async, source, city_info, params, page)
+    if page is None:
+        return functools.partial(cached_source_search, source, city_info, params)
+    return functools.partial(cached_source_page, source, city_info, params, page)
+
+def cached_source_hit(source, city_info, params, page=None):
+    """The cached hotels for a search or page (stale ones are refreshed in the background), else None.
+
+    Routes check this on the request thread, so warm searches never need an upstream executor slot.
+    """
+    return SEARCH_CACHE.get_if_cached(search_cache_key(source, params, page), SEARCH_CACHE_TTLS[source], lambda: SOURCE_ADAPTERS[source].fetch(city_info, params, page))
+
+def cached_status(hotels):
+    """Fan-out status for a search answered from the cache without scheduling a job."""
+    return {'status': 'ok', 'count': len(hotels), 'elapsed_ms': 0.0}
+
+def fetch_source_hotels_helper(source, city_info, params):
     try:
-        geo_id = city_info.get('tripadvisor_id')
-        if not geo_id: return []
-        api_data = search_tripadvisor_hotels(geo_id, params['checkin'], params['checkout'], params['adults'])
-        return process_tripadvisor_hotels(api_data)
+        return cached_source_search(source, city_info, params)
+    except UpstreamCapacityError:
+        raise
     except Exception as e:
-        logging.error(f"Exception in fetch_tripadvisor_hotels_helper: {e}")
+        logging.error(f"Exception in fetch_source_hotels_helper ({source}): {e}")
+        METRICS.inc('actionly_source_failures_total', source=source, error=type(e).__name__)
         return []
 
+# --- Fan-out Engine ---
+
+class FanoutEngine:
+    """Runs source searches with a latency budget per job, waiting on their futures from the calling thread.
+
+    Coroutine-function jobs run on the async upstream loop and hold no thread while in flight;
+    blocking jobs each hold an upstream executor thread. Either way a request never builds its
+    own pool or waits past its budget, and a job that misses its deadline keeps running and
+    lands in the search cache.
+    """
+
+    def __init__(self, executor, async_upstream=None):
+        self.executor = executor
+        self.async_upstream = async_upstream
+
+    def _submit(self, fn):
+        if self.async_upstream is not None and inspect.iscoroutinefunction(fn):
+            return self.async_upstream.submit(fn)
+        return self.executor.submit(fn)
+
+    @staticmethod
+    def _outcome(name, source, started, future=None, error=None):
+        status = {'status': 'ok'}
+        value = None
+        if error is None:
+            try:
+                value = future.result()
+                status['count'] = len(value) if isinstance(value, list) else None
+            except Exception as e:
+                error = e
+        if error is not None:
+            logging.error(f"Fan-out job {name} failed: {error}")
+            METRICS.inc('actionly_source_failures_total', source=source, error=type(error).__name__)
+            status.update(status='error', error=type(error).__name__)
+        status['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        return name, value, status
+
+    def stream(self, jobs, max_parallel=None, overall_deadline=None):
+        """Yields (name, value, status) for each (name, source, fn, deadline_seconds) job in completion order.
+
+        A job's deadline starts when it gets a slot. max_parallel caps how many jobs of this call
+        occupy the upstream executor at once (a timed-out job keeps its slot until it finishes),
+        and overall_deadline bounds the whole call; jobs still waiting for a slot then report a
+        timeout. source labels a failed job in the source-failure metric.
+        """
+        waiting = deque(jobs)
+        running = {}     # future -> (name, source, started, ends_at)
+        holding = set()  # futures occupying this call's slots, including ones past their deadline
+        slots = max_parallel or len(waiting)
+        stop_at = time.monotonic() + overall_deadline if overall_deadline else None
+        while waiting or running:
+            now = time.monotonic()
+            if stop_at is not None and now >= stop_at:
+                while waiting:
+                    name, source, _, _ = waiting.popleft()
+                    yield name, None, {'status': 'timeout', 'elapsed_ms': 0.0}
+            while waiting and len(holding) < slots:
+                name, source, fn, deadline = waiting.popleft()
+                started = time.perf_counter()
+                try:
+                    future = self._submit(fn)
+                except Exception as e:
+                    yield self._outcome(name, source, started, error=e)
+                    continue
+                holding.add(future)
+                running[future] = (name, source, started, now + deadline if stop_at is None else min(now + deadline, stop_at))
+            if not waiting and not running:
+                return
+            wake_at = min([ends_at for _, _, _, ends_at in running.values()] + ([stop_at] if stop_at is not None else []), default=None)
+            done, _ = wait(holding, timeout=None if wake_at is None else max(0, wake_at - time.monotonic()), return_when=FIRST_COMPLETED)
+            holding -= done
+            now = time.monotonic()
+            for future, (name, source, started, ends_at) in list(running.items()):
+                if future.done():
+                    del running[future]
+                    yield self._outcome(name, source, started, future)
+                elif now >= ends_at:
+                    del running[future]
+                    yield name, None, {'status': 'timeout', 'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)}
+
+    def run(self, jobs, max_parallel=None, overall_deadline=None):
+        """Runs jobs concurrently; returns ({name: value}, {name: status})."""
+        results, statuses = {}, {}
+        for name, value, status in self.stream(jobs, max_parallel, overall_deadline):
+            results[name] = value
+            statuses[name] = status
+        return results, statuses
+
+FANOUT_ENGINE = FanoutEngine(UPSTREAM_EXECUTOR, ASYNC_UPSTREAM)
+
+# --- Cache Warming ---
+
+class SearchDemand:
+    """Exponentially decaying request counts per search tuple, used to rank what gets prefetched."""
+
+    def __init__(self, max_tracked, decay):
+        self.max_tracked = max_tracked
+        self.decay = decay
+        self._scores = {}
+        self._lock = threading.Lock()
+
+    def record(self, params):
+        key = (params['city_key'], params['checkin'], params['checkout'], str(params['adults']), str(params['rooms']))
+        with self._lock:
+            self._scores[key] = self._scores.get(key, 0.0) + 1.0
+            if len(self._scores) > self.max_tracked:
+                keep = sorted(self._scores.items(), key=lambda item: item[1], reverse=True)[:self.max_tracked // 2]
+                self._scores = dict(keep)
+
+    def age(self):
+        """Decays every score once per warming cycle so yesterday's spikes fade out."""
+        with self._lock:
+            self._scores = {key: score * self.decay for key, score in self._scores.items() if score * self.decay >= 0.05}
+
+    def top(self, n):
+        """Returns search params for the n most requested searches whose check-in is not in the past."""
+        today = datetime.now().strftime('%Y-%m-%d')
+        with self._lock:
+            ranked = sorted(self._scores.items(), key=lambda item: item[1], reverse=True)
+        keys = [key for key, _ in ranked if key[1] >= today][:n]
+        return [{'city_key': c, 'checkin': ci, 'checkout': co, 'adults': a, 'rooms': r} for c, ci, co, a, r in keys]
+
+class CacheWarmer:
+    """Refreshes the most requested searches before they expire, within a share of the daily quota.
+
+    Every upstream request a refresh makes, auto-completes and retries included, is charged to the
+    warmer's daily share; with a SharedCache that share is counted host-wide, so it holds however
+    many workers run a warmer.
+    """
+
+    def __init__(self, demand, interval, top_n, quota_share, max_calls_per_cycle, max_parallel, shared=None):
+        self.demand = demand
+        self.interval = interval
+        self.top_n = top_n
+        self.quota_share = quota_share
+        self.max_calls_per_cycle = max_calls_per_cycle
+        self.max_parallel = max_parallel
+        self.shared = shared
+        self._day = None
+        self._daily = None
+        self._thread = None
+        self.counters = {'cycles': 0, 'refreshed': 0, 'skipped_fresh': 0, 'skipped_budget': 0, 'errors': 0}
+
+    def _daily_budget(self):
+        today = datetime.now(timezone.utc).date()
+        if today != self._day:
+            prefix = f"warmer:{today.isoformat()}:"
+            if self.shared is not None:
+                self.shared.drop_counters('warmer:', prefix)
+            shares = {host: int(quota * self.quota_share) for host, quota in UPSTREAM_DAILY_QUOTAS.items() if quota}
+            self._day, self._daily = today, UpstreamBudget(shares, self.shared, prefix)
+        return self._daily
+
+    def _budgets(self, daily):
+        """Estimated calls each source may still spend this cycle, for scheduling only."""
+        budgets = {}
+        for source, adapter in SOURCE_ADAPTERS.items():
+            host = adapter.host
+            budget = self.max_calls_per_cycle
+            if host in daily.limits:
+                budget = min(budget, daily.limits[host] - daily.spent(host), UPSTREAM_LIMITER.quota.remaining(host))
+            budgets[source] = max(0, budget)
+        return budgets
+
+    def run_cycle(self):
+        daily = self._daily_budget()
+        cycle = UpstreamBudget({adapter.host: self.max_calls_per_cycle for adapter in SOURCE_ADAPTERS.values()})
+        budgets = self._budgets(daily)
+        jobs = []
+        for params in self.demand.top(self.top_n):
+            city_info = CITIES.get(params['city_key'])
+            if city_info is None:
+                continue
+            for source, adapter in SOURCE_ADAPTERS.items():
+                ttl_left = SEARCH_CACHE.time_to_live(search_cache_key(source, params))
+                if ttl_left is not None and ttl_left > self.interval:
+                    self.counters['skipped_fresh'] += 1
+                    continue
+                cost = adapter.search_cost(city_info)
+                if budgets[source] < cost:
+                    self.counters['skipped_budget'] += 1
+                    continue
+                budgets[source] -= cost
+                jobs.append(((source, params['city_key']), source, lambda source=source, city_info=city_info, params=params: cached_source_search(source, city_info, params, refresh=True), SEARCH_CACHE_TTLS[source]))
+        with daily.active(), cycle.active():
+            for _, _, status in FANOUT_ENGINE.stream(jobs, max_parallel=self.max_parallel):
+                self.counters['refreshed' if status['status'] == 'ok' else 'errors'] += 1
+        self.demand.age()
+        self.counters['cycles'] += 1
+
+    def start(self):
+        if self._thread is not None:
+            return
+        def run():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.run_cycle()
+                except Exception as e:
+                    logging.error(f"Cache warmer cycle failed: {e}", exc_info=True)
+        self._thread = threading.Thread(target=run, name='cache-warmer', daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        daily = self._daily_budget()
+        return dict(self.counters, used_today={host: daily.spent(host) for host in daily.limits})
+
+SEARCH_DEMAND = SearchDemand(SEARCH_DEMAND_MAX_TRACKED, SEARCH_DEMAND_DECAY)
+CACHE_WARMER = CacheWarmer(SEARCH_DEMAND, CACHE_WARMER_INTERVAL_SECONDS, CACHE_WARMER_TOP_N, CACHE_WARMER_QUOTA_SHARE, CACHE_WARMER_MAX_CALLS_PER_CYCLE, CACHE_WARMER_MAX_PARALLEL, SHARED_CACHE)
+
+_BACKGROUND_WORKERS_LOCK = threading.Lock()
+_background_workers_started = False
+
+def start_background_workers():
+    """Starts the threads that call upstream on their own: the cache warmer and the location index refresh.
+
+    Runs on the first request rather than at import, so CLI commands such as export-snapshots
+    only spend the upstream budget they were given.
+    """
+    global _background_workers_started
+    with _BACKGROUND_WORKERS_LOCK:
+        if _background_workers_started:
+            return
+        _background_workers_started = True
+    if os.environ.get('CACHE_WARMER_ENABLED', '1') == '1':
+        CACHE_WARMER.start()
+    if os.environ.get('BOOKING_LOCATION_INDEX_BACKGROUND', '1') == '1':
+        BOOKING_LOCATION_INDEX.start_background_refresh(lambda: CITIES)
+
+# --- Response Encoding ---
+
+def _json_default(value):
+    if isinstance(value, HotelRecord):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dump_json_bytes(payload):
+    """Serializes with orjson when installed, falling back to the compact stdlib encoder."""
+    if orjson is not None:
+        return orjson.dumps(payload, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False, default=_json_default).encode('utf-8')
+
+def requested_fields(args):
+    """Parses ?fields=id,coordinates,price into a tuple, or None for full hotel records."""
+    fields = tuple(field.strip() for field in args.get('fields', '').split(',') if field.strip())
+    return fields or None
+
+def project_payload(payload, fields):
+    """Returns payload with every 'hotels' list (including per-city results) reduced to the given fields."""
+    if not fields or not isinstance(payload, dict):
+        return payload
+    projected = dict(payload)
+    if isinstance(payload.get('hotels'), list):
+        projected['hotels'] = [{field: hotel[field] for field in fields if field in hotel} for hotel in payload['hotels']]
+    if isinstance(payload.get('cities'), dict) and any(isinstance(city, dict) and 'hotels' in city for city in payload['cities'].values()):
+        projected['cities'] = {key: project_payload(city, fields) for key, city in payload['cities'].items()}
+    return projected
+
+_COMPRESSED_BODIES = OrderedDict()
+_COMPRESSED_BODIES_LOCK = threading.Lock()
+
+def compress_body(body, encoding):
+    """Compresses body once per (body hash, encoding); repeated hot responses reuse the bytes.
+
+    Keyed on the bytes themselves rather than the ETag: result ETags hash cache digests, not the
+    rendered body, so two different bodies can share a tag.
+    """
+    cache_key = (hashlib.blake2b(body, digest_size=16).digest(), encoding)
+    with _COMPRESSED_BODIES_LOCK:
+        if cache_key in _COMPRESSED_BODIES:
+            _COMPRESSED_BODIES.move_to_end(cache_key)
+            return _COMPRESSED_BODIES[cache_key]
+    compressed = brotli.compress(body, quality=BROTLI_QUALITY) if encoding == 'br' else gzip.compress(body, compresslevel=GZIP_LEVEL)
+    with _COMPRESSED_BODIES_LOCK:
+        _COMPRESSED_BODIES[cache_key] = compressed
+        while len(_COMPRESSED_BODIES) > COMPRESSED_BODY_CACHE_SIZE:
+            _COMPRESSED_BODIES.popitem(last=False)
+    return compressed
+
+def negotiate_encoding():
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def encoded_response(body, etag, max_age):
+    """Builds a JSON response with a weak ETag, 304 on If-None-Match, and gzip/brotli negotiation.
+
+    The tag is weak because the gzip, br and identity bodies share it: they are the same JSON,
+    not the same bytes.
+    """
+    headers = {'ETag': f'W/"{etag}"', 'Cache-Control': f'private, max-age={max_age}', 'Vary': 'Accept-Encoding'}
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+    encoding = negotiate_encoding() if len(body) >= COMPRESSION_MIN_BYTES else None
+    if encoding:
+        body = compress_body(body, encoding)
+        headers['Content-Encoding'] = encoding
+    return Response(body, mimetype='application/json', headers=headers)
+
+def result_etag(params, results):
+    """ETag from the cached results' content hashes, so a 304 needs no serialization at all.
+
+    results maps cache keys to the values being returned; None if any value has no known digest.
+    """
+    digests = []
+    for key, value in results.items():
+        digest = SEARCH_CACHE.digest_of(key, value)
+        if digest is None:
+            return None
+        digests.append(f"{key}:{digest}")
+    basis = '|'.join([request.path, request.query_string.decode('utf-8', 'replace'), repr(sorted(params.items()))] + digests)
+    return hashlib.blake2b(basis.encode('utf-8'), digest_size=16).hexdigest()
+
+def json_response(payload, max_age=HOTEL_RESPONSE_MAX_AGE, etag=None):
+    """Projects hotel fields per ?fields=, serializes fast, and applies conditional GET and compression.
+
+    Without a precomputed etag the ETag is a hash of the serialized body.
+    """
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers={'ETag': f'W/"{etag}"', 'Cache-Control': f'private, max-age={max_age}', 'Vary': 'Accept-Encoding'})
+    with timed_stage('serialize'):
+        body = dump_json_bytes(project_payload(payload, requested_fields(request.args)))
+    return encoded_response(body, etag or hashlib.blake2b(body, digest_size=16).hexdigest(), max_age)
+
+_CITIES_BODY = (None, None, None)
+
+def cities_body():
+    """The serialized /api/cities payload and its ETag, rebuilt only when the catalog changes."""
+    global _CITIES_BODY
+    cities, body, etag = _CITIES_BODY
+    if cities is not CITIES:
+        body = dump_json_bytes({'cities': CITIES})
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        _CITIES_BODY = (CITIES, body, etag)
+    return body, etag
+
+# --- Request Instrumentation ---
+
+def _register_gauges():
+    METRICS.gauge('actionly_search_cache_entries', lambda: SEARCH_CACHE.stats()['size'])
+    METRICS.gauge('actionly_search_cache_in_flight', lambda: SEARCH_CACHE.stats()['in_flight'])
+    METRICS.gauge('actionly_search_cache_events_total', lambda: {(('event', name),): value for name, value in SEARCH_CACHE.stats().items() if name in SEARCH_CACHE.counters}, kind='counter')
+    METRICS.gauge('actionly_upstream_executor_tasks_total', lambda: {(('outcome', name),): UPSTREAM_EXECUTOR.stats()[name] for name in ('submitted', 'rejected', 'expired')}, kind='counter')
+    METRICS.gauge('actionly_upstream_executor_active', lambda: UPSTREAM_EXECUTOR.stats()['active'])
+    METRICS.gauge('actionly_upstream_executor_queued', lambda: UPSTREAM_EXECUTOR.stats()['queued'])
+    if ASYNC_UPSTREAM is not None:
+        METRICS.gauge('actionly_async_upstream_in_flight', lambda: ASYNC_UPSTREAM.stats()['active'])
+        METRICS.gauge('actionly_async_upstream_tasks_total', lambda: {(('outcome', name),): ASYNC_UPSTREAM.stats()[name] for name in ('submitted', 'rejected')}, kind='counter')
+    METRICS.gauge('actionly_upstream_quota_used', lambda: {(('host', host),): usage['used'] for host, usage in UPSTREAM_LIMITER.quota.snapshot().items()})
+    METRICS.gauge('actionly_hotel_index_entries', lambda: len(HOTEL_INDEX.index))
+    METRICS.gauge('actionly_circuit_state', lambda: {(('host', host),): CircuitBreaker.STATES[breaker.snapshot()['state']] for host, breaker in CIRCUIT_BREAKERS.items()})
+    if PRICE_HISTORY is not None:
+        METRICS.gauge('actionly_price_history_pending', lambda: PRICE_HISTORY.stats()['pending'])
+        METRICS.gauge('actionly_price_history_rows_total', lambda: {(('outcome', name),): PRICE_HISTORY.counters[name] for name in ('written', 'skipped_unchanged', 'dropped')}, kind='counter')
+    METRICS.gauge('actionly_circuit_opens_total', lambda: {(('host', host),): breaker.snapshot()['opens'] for host, breaker in CIRCUIT_BREAKERS.items()}, kind='counter')
+
+_register_gauges()
+
+@app.before_request
+def start_request_timings():
+    if not _background_workers_started: start_background_workers()
+    request.timings_token = REQUEST_TIMINGS.set([])
+    request.started_at = time.perf_counter()
+
+@app.after_request
+def add_server_timing(response):
+    timings = REQUEST_TIMINGS.get()
+    if timings is None or not request.path.startswith('/api/'):
+        return response
+    if response.is_streamed:
+        return response  # headers are sent before the work finishes
+    totals = {}
+    for name, seconds in list(timings):
+        total, count = totals.get(name, (0.0, 0))
+        totals[name] = (total + seconds, count + 1)
+    entries = [f'{name};dur={total * 1000:.1f}' + (f';desc="x{count}"' if count > 1 else '') for name, (total, count) in totals.items()]
+    entries.append(f'total;dur={(time.perf_counter() - request.started_at) * 1000:.1f}')
+    response.headers['Server-Timing'] = ', '.join(entries)
+    METRICS.observe('actionly_request_seconds', time.perf_counter() - request.started_at, route=request.url_rule.rule if request.url_rule else 'unmatched', status=str(response.status_code))
+    return response
+
+@app.teardown_request
+def reset_request_timings(exc=None):
+    token = getattr(request, 'timings_token', None)
+    if token is not None:
+        REQUEST_TIMINGS.reset(token)
+
 # --- Flask Routes ---
 @app.route('/')
 def home(): return render_template_string('<h1>STAYFINDR Backend v12.8</h1><p>Final link fix version.</p>')
 
 @app.route('/api/cities')
-def get_cities_route(): return jsonify({'cities': CITIES})
+def get_cities_route(): return encoded_response(*cities_body(), max_age=CITIES_RESPONSE_MAX_AGE)
+
+@app.route('/api/cities/suggest')
+def get_city_suggestions_route():
+    """Type-ahead over city names, aliases and their words: ?q=sto&limit=8, optionally &country=se."""
+    catalog = CITY_CATALOG
+    query = request.args.get('q', '')
+    country = request.args.get('country', '').lower() or None
+    try:
+        limit = int(float_arg(request.args, 'limit', 1, CITY_SUGGEST_MAX_RESULTS, default=8))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if normalize_city_term(query):
+        keys = catalog.suggest(query, limit, country)
+    else:
+        keys = catalog.by_country.get(country, [])[:limit] if country else []
+    suggestions = [{'key': key, 'name': catalog.cities[key]['name'], 'country': catalog.cities[key]['country']} for key in keys]
+    return json_response({'query': query, 'suggestions': suggestions}, max_age=CITIES_RESPONSE_MAX_AGE)
 
 @app.route('/api/room-types')
 def get_room_types_route():
     room_types = {'single': {'name': 'Single Room'}, 'double': {'name': 'Double Room'}, 'family': {'name': 'Family Room'}}
     return jsonify({'room_types': room_types})
 
-def handle_single_source_search(source, params, city_info):
-    """Handles a search for a single, isolated source."""
-    if source == 'booking':
-        return fetch_booking_hotels_helper(city_info, params)
-    elif source == 'tripadvisor':
-        return fetch_tripadvisor_hotels_helper(city_info, params)
-    return []
-
-@app.route('/api/hotels/booking')
-def get_booking_hotels_route():
-    today = datetime.now()
-    params = {'city_key': request.args.get('city', 'stockholm').lower(), 'checkin': request.args.get('checkin', (today + timedelta(days=1)).strftime('%Y-%m-%d')), 'checkout': request.args.get('checkout', (today + timedelta(days=2)).strftime('%Y-%m-%d')), 'adults': request.args.get('adults', '2'), 'rooms': request.args.get('rooms', '1')}
-    if params['city_key'] not in CITIES: return jsonify({'error': f"City '{params['city_key']}' not supported"}), 400
-    city_info = CITIES[params['city_key']]
-    processed_hotels = handle_single_source_search('booking', params, city_info)
-    return jsonify({'city': city_info['name'], 'hotels': processed_hotels, 'total_found': len(processed_hotels), 'search_params': params})
-
-@app.route('/api/hotels/tripadvisor')
-def get_tripadvisor_hotels_route():
+@app.errorhandler(UpstreamCapacityError)
+def handle_upstream_capacity_error(e):
+    response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+class InvalidSearchParams(ValueError):
+    """Raised for search parameters no upstream call should be spent on."""
+
+@app.errorhandler(InvalidSearchParams)
+def handle_invalid_search_params(e):
+    return jsonify({'error': str(e)}), 400
+
+def parse_stay_date(value, name):
+    try:
+        return datetime.strptime(str(value), '%Y-%m-%d').date()
+    except ValueError:
+        raise InvalidSearchParams(f"'{name}' must be a date formatted YYYY-MM-DD")
+
+def search_params_from_args(args):
+    """Builds the normalized search parameters shared by all hotel routes; raises InvalidSearchParams for malformed dates."""
     today = datetime.now()
-    params = {'city_key': request.args.get('city', 'stockholm').lower(), 'checkin': request.args.get('checkin', (today + timedelta(days=1)).strftime('%Y-%m-%d')), 'checkout': request.args.get('checkout', (today + timedelta(days=2)).strftime('%Y-%m-%d')), 'adults': request.args.get('adults', '2'), 'rooms': request.args.get('rooms', '1')}
-    if params['city_key'] not in CITIES: return jsonify({'error': f"City '{params['city_key']}' not supported"}), 400
-    city_info = CITIES[params['city_key']]
-    processed_hotels = handle_single_source_search('tripadvisor', params, city_info)
-    return jsonify({'city': city_info['name'], 'hotels': processed_hotels, 'total_found': len(processed_hotels), 'search_params': params})
+    city = str(args.get('city', 'stockholm')).lower()
+    checkin = parse_stay_date(args.get('checkin') or (today + timedelta(days=1)).strftime('%Y-%m-%d'), 'checkin')
+    checkout = parse_stay_date(args.get('checkout') or (checkin + timedelta(days=1)).strftime('%Y-%m-%d'), 'checkout')
+    if checkout <= checkin: raise InvalidSearchParams("'checkout' must be after 'checkin'")
+    return {'city_key': CITY_CATALOG.resolve(city) or city, 'checkin': checkin.strftime('%Y-%m-%d'), 'checkout': checkout.strftime('%Y-%m-%d'), 'adults': str(args.get('adults', '2')), 'rooms': str(args.get('rooms', '1'))}
+
+def handle_single_source_search(source, params, city_info):
+    """Handles a search for a single, isolated source; only cache misses use the shared upstream executor."""
+    if source not in SOURCE_ADAPTERS: return []
+    hotels = cached_source_hit(source, city_info, params)
+    if hotels is not None:
+        return hotels
+    return UPSTREAM_EXECUTOR.submit(fetch_source_hotels_helper, source, city_info, params).result()
+
+@app.route('/api/hotels/<source>')
+def get_single_source_hotels_route(source):
+    """Hotels from one registered source, e.g. /api/hotels/booking or /api/hotels/tripadvisor."""
+    if source not in SOURCE_ADAPTERS: return jsonify({'error': f"Unknown source '{source}'"}), 404
+    params = search_params_from_args(request.args)
+    cities = CITIES
+    if params['city_key'] not in cities: return jsonify({'error': f"City '{params['city_key']}' not supported"}), 400
+    city_info = cities[params['city_key']]
+    SEARCH_DEMAND.record(params)
+    processed_hotels = handle_single_source_search(source, params, city_info)
+    etag = result_etag(params, {search_cache_key(source, params): processed_hotels})
+    return json_response({'city': city_info['name'], 'hotels': processed_hotels, 'total_found': len(processed_hotels), 'search_params': params}, etag=etag)
+
+def requested_stream_format(args):
+    """Returns 'ndjson' or 'sse' when the client asked for a streamed response, else None."""
+    stream = str(args.get('stream', '')).lower()
+    if stream == 'sse' or (stream in ('1', 'true') and request.accept_mimetypes.best == 'text/event-stream'):
+        return 'sse'
+    return 'ndjson' if stream in ('1', 'true', 'ndjson') else None
+
+def streaming_response(events, stream_format):
+    """Serializes an iterable of event dicts as NDJSON lines or Server-Sent Events, flushing each one."""
+    fields = requested_fields(request.args)
+    def generate():
+        for event in events:
+            data = dump_json_bytes(project_payload(event, fields))
+            if stream_format == 'sse':
+                yield b'event: ' + event.get('event', 'message').encode() + b'\ndata: ' + data + b'\n\n'
+            else:
+                yield data + b'\n'
+    mimetype = 'text/event-stream' if stream_format == 'sse' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def dual_search_jobs(city_info, params):
+    """Answers cached sources on the request thread; returns ({source: (hotels, status)}, fan-out jobs for the misses)."""
+    cached, jobs = {}, []
+    for source in SOURCE_ADAPTERS:
+        hotels = cached_source_hit(source, city_info, params)
+        if hotels is not None:
+            cached[source] = (hotels, cached_status(hotels))
+        else:
+            jobs.append((source, source, source_search_job(source, city_info, params), SOURCE_DEADLINES[source]))
+    return cached, jobs
+
+def iter_dual_events(city_info, params, merge=False):
+    """Yields one event per source as soon as its hotels are processed, then a summary event.
+
+    With merge=True the summary also carries the cross-source merged hotel list.
+    """
+    statuses = {}
+    results = {}
+    cached, jobs = dual_search_jobs(city_info, params)
+    outcomes = [(source, hotels, status) for source, (hotels, status) in cached.items()]
+    for source, hotels, status in itertools.chain(outcomes, FANOUT_ENGINE.stream(jobs)):
+        statuses[source] = status
+        results[source] = hotels = sorted(hotels or [], key=lambda x: x.get('rating', 0), reverse=True)
+        yield {'event': 'source', 'source': source, 'hotels': hotels, 'status': status}
+    summary = {'event': 'summary', 'city': city_info['name'], 'total_found': sum(len(hotels) for hotels in results.values()), 'search_params': params,
+               'data_source': 'dual', 'sources': statuses, 'partial': any(status['status'] != 'ok' for status in statuses.values())}
+    if merge:
+        merged = merge_hotel_sources([results[source] for source in SOURCE_ADAPTERS if source in results])
+        summary['hotels'] = sorted(merged, key=lambda x: x.get('rating', 0), reverse=True)
+    yield summary
 
 @app.route('/api/hotels/dual')
 def get_dual_hotels():
-    """Get hotels from BOTH Booking.com and TripAdvisor in parallel."""
-    today = datetime.now()
-    params = {'city_key': request.args.get('city', 'stockholm').lower(), 'checkin': request.args.get('checkin', (today + timedelta(days=1)).strftime('%Y-%m-%d')), 'checkout': request.args.get('checkout', (today + timedelta(days=2)).strftime('%Y-%m-%d')), 'adults': request.args.get('adults', '2'), 'rooms': request.args.get('rooms', '1')}
-    if params['city_key'] not in CITIES: return jsonify({'error': f"City '{params['city_key']}' not supported"}), 400
+    """Get hotels from BOTH Booking.com and TripAdvisor in parallel, within per-source deadlines.
+
+    With ?stream=1 (NDJSON) or ?stream=sse each source is sent as soon as it is ready, and
+    ?merge=1 collapses properties listed by both sources into one record.
+    """
+    params = search_params_from_args(request.args)
+    cities = CITIES
+    if params['city_key'] not in cities: return jsonify({'error': f"City '{params['city_key']}' not supported"}), 400
     
-    city_info = CITIES[params['city_key']]
+    city_info = cities[params['city_key']]
+    SEARCH_DEMAND.record(params)
+    if stream_format := requested_stream_format(request.args):
+        return streaming_response(iter_dual_events(city_info, params, wants_merge(request.args)), stream_format)
     all_hotels = []
+    snapshot = SNAPSHOTS.lookup(params)
+    if snapshot is not None and not any(SEARCH_CACHE.peek(key) is not None or SEARCH_CACHE.is_fresh(key) for key in (search_cache_key(source, params) for source in SOURCE_ADAPTERS)):
+        # Nothing live is cached (failures never are, so this also covers a down upstream):
+        # answer from the exported snapshot and warm the live path in the background.
+        SNAPSHOTS.counters['cold_served'] += 1
+        warm_sources_in_background(city_info, params)
+        return snapshot_response(snapshot, wants_merge(request.args))
     
-    with ThreadPoolExecutor(max_workers=2) as executor:
-        booking_future = executor.submit(fetch_booking_hotels_helper, city_info, params)
-        tripadvisor_future = executor.submit(fetch_tripadvisor_hotels_helper, city_info, params)
-        
-        booking_hotels = booking_future.result()
-        tripadvisor_hotels = tripadvisor_future.result()
-        
-        all_hotels.extend(booking_hotels)
-        all_hotels.extend(tripadvisor_hotels)
+    cached, jobs = dual_search_jobs(city_info, params)
+    results, statuses = FANOUT_ENGINE.run(jobs)
+    for source, (hotels, status) in cached.items():
+        results[source], statuses[source] = hotels, status
+    statuses = {source: statuses[source] for source in SOURCE_ADAPTERS}
+    if all(status.get('error') == 'UpstreamCapacityError' for status in statuses.values()):
+        raise UpstreamCapacityError("Upstream capacity exhausted for all sources")
+    for source in SOURCE_ADAPTERS:
+        if statuses[source]['status'] != 'ok':
+            logging.warning(f"Dual search for {params['city_key']}: {source} {statuses[source]['status']} after {statuses[source]['elapsed_ms']} ms")
+        all_hotels.extend(results[source] or [])
+    if wants_merge(request.args):
+        all_hotels = merge_hotel_sources([results[source] or [] for source in SOURCE_ADAPTERS])
 
     all_hotels.sort(key=lambda x: x.get('rating', 0), reverse=True)
+    etag = result_etag(params, {search_cache_key(source, params): results[source] for source in SOURCE_ADAPTERS})
     
-    return jsonify({
+    return json_response({
         'city': city_info['name'],
         'hotels': all_hotels,
         'total_found': len(all_hotels),
         'search_params': params,
-        'data_source': 'dual'
+        'data_source': 'dual',
+        'merged': wants_merge(request.args),
+        'sources': statuses,
+        'partial': any(status['status'] != 'ok' for status in statuses.values())
+    }, etag=etag)
+
+def iter_batch_city_results(params, city_keys, sources, merge=False, max_parallel=BATCH_MAX_PARALLEL, overall_deadline=BATCH_DEADLINE_SECONDS, cities=None):
+    """Schedules every uncached city x source search on the shared pool and yields each city once all its sources finish.
+
+    Cached searches are answered on the calling thread, so fully cached cities come first.
+    Pass the cities the caller validated city_keys against; a catalog reload mid-batch must not change them.
+    """
+    cities = cities if cities is not None else CITIES
+    city_params = {key: dict(params, city_key=key) for key in city_keys}
+    pending = {key: {} for key in city_keys}
+    jobs = []
+    for key in city_keys:
+        for source in sources:
+            hotels = cached_source_hit(source, cities[key], city_params[key])
+            if hotels is not None:
+                pending[key][source] = (hotels, cached_status(hotels))
+            else:
+                jobs.append(((key, source), source, source_search_job(source, cities[key], city_params[key]), BATCH_DEADLINE_SECONDS))
+
+    def city_result(key):
+        outcomes = pending.pop(key)
+        if merge:
+            city_hotels = merge_hotel_sources([outcomes[source][0] for source in sources])
+        else:
+            city_hotels = [hotel for source in sources for hotel in outcomes[source][0]]
+        city_hotels.sort(key=lambda x: x.get('rating', 0), reverse=True)
+        statuses = {source: outcomes[source][1] for source in sources}
+        return {'event': 'city', 'city_key': key, 'city': cities[key]['name'], 'hotels': city_hotels, 'total_found': len(city_hotels),
+                'sources': statuses, 'partial': any(status['status'] != 'ok' for status in statuses.values())}
+
+    for key in city_keys:
+        if len(pending[key]) == len(sources):
+            yield city_result(key)
+    for (key, source), hotels, status in FANOUT_ENGINE.stream(jobs, max_parallel=max_parallel, overall_deadline=overall_deadline):
+        pending[key][source] = (hotels or [], status)
+        if len(pending[key]) == len(sources):
+            yield city_result(key)
+
+@app.route('/api/hotels/batch', methods=['GET', 'POST'])
+def get_batch_hotels():
+    """Get hotels for many cities at once; ?stream=1 (or sse) sends each city as it completes."""
+    body = request.get_json(silent=True)
+    if body is None: body = {}
+    if not isinstance(body, dict): return jsonify({'error': 'The JSON body must be an object'}), 400
+    args = dict(request.args.to_dict(), **{k: v for k, v in body.items() if not isinstance(v, list)})
+    raw_cities = body.get('cities') or request.args.get('cities', '')
+    raw_sources = body.get('sources') or request.args.get('sources', '')
+    if not isinstance(raw_cities, (list, str)) or not isinstance(raw_sources, (list, str)):
+        return jsonify({'error': 'cities and sources must be lists or comma-separated strings'}), 400
+    if isinstance(raw_cities, str): raw_cities = raw_cities.split(',')
+    if isinstance(raw_sources, str): raw_sources = raw_sources.split(',')
+    city_keys = [str(key).strip().lower() for key in raw_cities if str(key).strip()]
+    catalog = CITY_CATALOG
+    cities = catalog.cities
+    if city_keys == ['all']: city_keys = list(cities)
+    city_keys = list(dict.fromkeys(catalog.resolve(key) or key for key in city_keys))
+    sources = [source for source in SOURCE_ADAPTERS if source in raw_sources] if any(raw_sources) else list(SOURCE_ADAPTERS)
+    unsupported = [key for key in city_keys if key not in cities]
+    city_keys = [key for key in city_keys if key in cities]
+    if not city_keys: return jsonify({'error': 'No supported cities requested', 'unsupported': unsupported}), 400
+    if len(city_keys) > BATCH_MAX_CITIES: return jsonify({'error': f"At most {BATCH_MAX_CITIES} cities per batch"}), 400
+    if not sources: return jsonify({'error': f"Unknown sources, expected any of {', '.join(SOURCE_ADAPTERS)}"}), 400
+
+    params = search_params_from_args(args)
+    params.pop('city_key')
+    for key in city_keys:
+        SEARCH_DEMAND.record(dict(params, city_key=key))
+    city_results = iter_batch_city_results(params, city_keys, sources, wants_merge(args), cities=cities)
+
+    if stream_format := requested_stream_format(args):
+        def events():
+            yield from city_results
+            yield {'event': 'summary', 'cities': len(city_keys), 'unsupported': unsupported, 'search_params': params}
+        return streaming_response(events(), stream_format)
+
+    results = {result['city_key']: result for result in city_results}
+    return json_response({
+        'cities': {key: results[key] for key in city_keys},
+        'unsupported': unsupported,
+        'search_params': params,
+        'sources': sources,
+        'partial': any(result['partial'] for result in results.values())
+    })
+
+# --- Price Calendar ---
+
+def nightly_price_summary(hotels):
+    prices = sorted(hotel['price'] for hotel in hotels if isinstance(hotel.get('price'), (int, float)))
+    if not prices:
+        return {'cheapest': None, 'median': None, 'priced_hotels': 0}
+    middle = len(prices) // 2
+    median = prices[middle] if len(prices) % 2 else (prices[middle - 1] + prices[middle]) / 2
+    return {'cheapest': prices[0], 'median': median, 'priced_hotels': len(prices)}
+
+def calendar_day_event(checkin, outcomes, cached):
+    hotels = [hotel for hotels, _ in outcomes.values() for hotel in hotels]
+    statuses = {source: status for source, (_, status) in outcomes.items()}
+    return dict(nightly_price_summary(hotels), event='day', checkin=checkin, cached=cached, sources=statuses,
+                partial=any(status['status'] != 'ok' for status in statuses.values()))
+
+def iter_calendar_days(city_info, params, checkins, nights, sources):
+    """Yields one price summary per check-in date: cached nights first, then the rest as they complete.
+
+    Only the (night, source) searches missing from the search cache are scheduled, all on one
+    bounded fan-out so a long range cannot monopolize the upstream executor.
+    """
+    night_params, pending, jobs = {}, {}, []
+    for checkin in checkins:
+        checkout = (datetime.strptime(checkin, '%Y-%m-%d') + timedelta(days=nights)).strftime('%Y-%m-%d')
+        night_params[checkin] = dict(params, checkin=checkin, checkout=checkout)
+        outcomes = {}
+        for source in sources:
+            cached = SEARCH_CACHE.peek(search_cache_key(source, night_params[checkin]))
+            if cached is not None:
+                outcomes[source] = (cached, {'status': 'ok', 'elapsed_ms': 0.0})
+            else:
+                jobs.append(((checkin, source), source, source_search_job(source, city_info, night_params[checkin]), SOURCE_DEADLINES[source]))
+        if len(outcomes) == len(sources):
+            yield calendar_day_event(checkin, outcomes, cached=True)
+        else:
+            pending[checkin] = outcomes
+    for (checkin, source), hotels, status in FANOUT_ENGINE.stream(jobs, max_parallel=CALENDAR_MAX_PARALLEL, overall_deadline=CALENDAR_DEADLINE_SECONDS):
+        pending[checkin][source] = (hotels or [], status)
+        if len(pending[checkin]) == len(sources):
+            yield calendar_day_event(checkin, pending.pop(checkin), cached=False)
+
+@app.route('/api/calendar')
+def get_price_calendar():
+    """Cheapest and median nightly price per check-in date between start and end (inclusive).
+
+    Takes city, start, end, nights (default 1), adults, rooms and sources; ?stream=1 (or sse)
+    sends cached dates immediately and the others as their searches finish.
+    """
+    catalog = CITY_CATALOG
+    city = str(request.args.get('city', '')).lower()
+    city_key = catalog.resolve(city) or city
+    city_info = catalog.cities.get(city_key)
+    if city_info is None: return jsonify({'error': f"City '{city_key}' not supported"}), 400
+    raw_sources = [source for source in request.args.get('sources', '').split(',') if source]
+    sources = [source for source in SOURCE_ADAPTERS if source in raw_sources] if raw_sources else list(SOURCE_ADAPTERS)
+    if not sources: return jsonify({'error': f"Unknown sources, expected any of {', '.join(SOURCE_ADAPTERS)}"}), 400
+    try:
+        start = datetime.strptime(request.args.get('start', ''), '%Y-%m-%d')
+        end = datetime.strptime(request.args.get('end', ''), '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'start and end are required as YYYY-MM-DD'}), 400
+    try:
+        nights = int(float_arg(request.args, 'nights', 1, CALENDAR_MAX_NIGHTS, default=1))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    days = (end - start).days + 1
+    if not 1 <= days <= CALENDAR_MAX_DAYS: return jsonify({'error': f"The range must cover 1 to {CALENDAR_MAX_DAYS} days"}), 400
+    # Past check-ins cannot be booked, but every one of them would still cost upstream calls.
+    if start.date() < datetime.now().date(): return jsonify({'error': "'start' must not be before today"}), 400
+
+    checkins = [(start + timedelta(days=offset)).strftime('%Y-%m-%d') for offset in range(days)]
+    params = dict(search_params_from_args({name: value for name, value in request.args.items() if name not in ('checkin', 'checkout')}), city_key=city_key)
+    params.pop('checkin'), params.pop('checkout')
+    calendar_days = iter_calendar_days(city_info, params, checkins, nights, sources)
+    search_params = dict(params, start=checkins[0], end=checkins[-1], nights=nights, sources=sources)
+
+    if stream_format := requested_stream_format(request.args):
+        def events():
+            yield from calendar_days
+            yield {'event': 'summary', 'city': city_info['name'], 'days': days, 'search_params': search_params}
+        return streaming_response(events(), stream_format)
+
+    by_date = {day['checkin']: day for day in calendar_days}
+    ordered = [by_date[checkin] for checkin in checkins]
+    priced = [day for day in ordered if day['cheapest'] is not None]
+    return json_response({
+        'city': city_info['name'],
+        'days': ordered,
+        'cheapest_day': min(priced, key=lambda day: day['cheapest'])['checkin'] if priced else None,
+        'search_params': search_params,
+        'partial': any(day['partial'] for day in ordered)
     })
 
+def float_arg(args, name, minimum, maximum, default=None):
+    """Parses a bounded float query parameter, raising ValueError with a client-facing message."""
+    raw = args.get(name, default)
+    try:
+        value = float(raw)
+    except (TypeError, ValueError):
+        raise ValueError(f"Parameter '{name}' must be a number")
+    if not minimum <= value <= maximum:
+        raise ValueError(f"Parameter '{name}' must be between {minimum} and {maximum}")
+    return value
+
+def search_filters_from_args(args):
+    """Optional search-tuple filters for spatial hotel queries; omitted values match any search."""
+    return {name: args.get(name) for name in ('checkin', 'checkout', 'adults', 'rooms')}
+
+# --- Paginated Search ---
+
+RESULT_SET_CACHE = SearchResultCache(RESULT_SET_CACHE_MAX_ENTRIES, 0)
+
+def _cursor_signature(raw):
+    return hmac.new(CURSOR_SECRET, raw, hashlib.sha256).digest()[:16]
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def encode_cursor(query, offset):
+    raw = json.dumps({'q': query, 'o': offset}, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    return f"{_b64encode(raw)}.{_b64encode(_cursor_signature(raw))}"
+
+def decode_cursor(cursor):
+    """Returns (query, offset) from a signed cursor, raising ValueError when it is malformed.
+
+    The carried query is checked again like fresh arguments, so a cursor can never exceed the
+    current limits (pages, sources, sort) even if it was issued under older settings.
+    """
+    try:
+        payload, signature = cursor.split('.')
+        raw = _b64decode(payload)
+        if not hmac.compare_digest(_b64decode(signature), _cursor_signature(raw)):
+            raise ValueError("bad signature")
+        data = json.loads(raw)
+        carried, offset = dict(data['q']), int(data['o'])
+        if offset < 0:
+            raise ValueError("negative offset")
+        query = search_query_from_args(dict(carried, city=carried.get('city_key'), sources=','.join(carried.get('sources') or [])))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    return query, offset
+
+def search_query_from_args(args):
+    """Normalizes search, filter and sort arguments into the query a cursor carries."""
+    params = search_params_from_args(args)
+    sources = [source for source in args.get('sources', ','.join(SOURCE_ADAPTERS)).split(',') if source in SOURCE_ADAPTERS]
+    if not sources: raise ValueError(f"Unknown sources, expected any of {', '.join(SOURCE_ADAPTERS)}")
+    sort = args.get('sort', 'rating')
+    if sort not in SEARCH_SORTS: raise ValueError(f"Unknown sort, expected one of {', '.join(SEARCH_SORTS)}")
+    query = dict(params, sources=sources, sort=sort, merge=wants_merge(args),
+                 pages=int(float_arg(args, 'pages', 1, SEARCH_MAX_PAGES, default=SEARCH_MAX_PAGES)))
+    for name, maximum in (('min_price', 100000), ('max_price', 100000), ('min_rating', 5)):
+        if args.get(name) not in (None, ''):
+            query[name] = float_arg(args, name, 0, maximum)
+    return query
+
+def _sort_key(sort):
+    if sort == 'price':
+        return lambda hotel: (not isinstance(hotel.get('price'), (int, float)), hotel.get('price') if isinstance(hotel.get('price'), (int, float)) else 0)
+    if sort == '-price':
+        return lambda hotel: (not isinstance(hotel.get('price'), (int, float)), -hotel['price'] if isinstance(hotel.get('price'), (int, float)) else 0)
+    if sort == 'distance':
+        return lambda hotel: (hotel.get('distance_km') is None, hotel.get('distance_km') or 0)
+    return lambda hotel: -(hotel.get('rating') or 0)
+
+def build_result_set(query, city_info):
+    """Fetches every page of every requested source concurrently, then filters and sorts once.
+
+    Returns (hotels, statuses); the list is cached per query so cursor pages are just slices.
+    """
+    params = {name: query[name] for name in ('city_key', 'checkin', 'checkout', 'adults', 'rooms')}
+    results, page_statuses, jobs = {}, {}, []
+    for source in query['sources']:
+        for page in range(1, query['pages'] + 1):
+            hotels = cached_source_hit(source, city_info, params, page)
+            if hotels is not None:
+                results[(source, page)], page_statuses[(source, page)] = hotels, cached_status(hotels)
+            else:
+                jobs.append(((source, page), source, source_search_job(source, city_info, params, page), SOURCE_DEADLINES[source]))
+    fetched, fetched_statuses = FANOUT_ENGINE.run(jobs, max_parallel=BATCH_MAX_PARALLEL, overall_deadline=max(SOURCE_DEADLINES.values()))
+    results.update(fetched)
+    page_statuses.update(fetched_statuses)
+    statuses, per_source = {}, {}
+    for source in query['sources']:
+        pages = [page_statuses[(source, page)] for page in range(1, query['pages'] + 1)]
+        ok_pages = sum(1 for status in pages if status['status'] == 'ok')
+        statuses[source] = {'status': 'ok' if ok_pages == len(pages) else ('partial' if ok_pages else pages[0]['status']),
+                            'pages_ok': ok_pages, 'pages': len(pages), 'elapsed_ms': max(status['elapsed_ms'] for status in pages)}
+        seen, hotels = set(), []
+        for page in range(1, query['pages'] + 1):
+            for hotel in results[(source, page)] or []:
+                if hotel.get('id') not in seen:
+                    seen.add(hotel.get('id'))
+                    hotels.append(hotel)
+        per_source[source] = hotels
+    hotels = merge_hotel_sources(list(per_source.values())) if query['merge'] else [hotel for source_hotels in per_source.values() for hotel in source_hotels]
+
+    center = (city_info.get('lat'), city_info.get('lon'))
+    selected = []
+    for hotel in hotels:
+        price = hotel.get('price')
+        numeric = isinstance(price, (int, float))
+        if ('min_price' in query or 'max_price' in query) and not numeric: continue
+        if numeric and not query.get('min_price', 0) <= price <= query.get('max_price', float('inf')): continue
+        if (hotel.get('rating') or 0) < query.get('min_rating', 0): continue
+        distance = round(haversine_km(center[0], center[1], *hotel['coordinates']), 3) if None not in center and has_coordinates(hotel) else None
+        selected.append(dict(hotel, distance_km=distance))
+    selected.sort(key=_sort_key(query['sort']))
+    return selected, statuses
+
+@app.route('/api/hotels/search')
+def get_paginated_hotels():
+    """Multi-page search with server-side filters (min_price, max_price, min_rating, sources),
+    sort (rating, price, -price, distance) and cursor pagination via next_cursor."""
+    try:
+        if cursor := request.args.get('cursor'):
+            query, offset = decode_cursor(cursor)
+        else:
+            query, offset = search_query_from_args(request.args), 0
+        limit = int(float_arg(request.args, 'limit', 1, SEARCH_PAGE_SIZE_MAX, default=SEARCH_PAGE_SIZE_DEFAULT))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    cities = CITIES
+    if query.get('city_key') not in cities: return jsonify({'error': f"City '{query.get('city_key')}' not supported"}), 400
+    city_info = cities[query['city_key']]
+    if not cursor: SEARCH_DEMAND.record(query)
+
+    result_set_key = json.dumps(query, sort_keys=True)
+    built = {}
+    def build():
+        built['value'] = build_result_set(query, city_info)
+        return built['value']
+    hotels, statuses = RESULT_SET_CACHE.get_or_fetch(result_set_key, RESULT_SET_TTL_SECONDS, build)
+    if 'value' in built and any(status['status'] != 'ok' for status in statuses.values()):
+        RESULT_SET_CACHE.invalidate(result_set_key)  # never page through an incomplete set for long
+    page = hotels[offset:offset + limit]
+    next_offset = offset + len(page)
+    return json_response({
+        'city': city_info['name'],
+        'hotels': page,
+        'total_found': len(hotels),
+        'offset': offset,
+        'next_cursor': encode_cursor(query, next_offset) if next_offset < len(hotels) else None,
+        'search_params': query,
+        'sources': statuses,
+        'partial': any(status['status'] != 'ok' for status in statuses.values())
+    })
+
+@app.route('/api/hotels/nearby')
+def get_nearby_hotels():
+    """Cached hotels within radius_km of lat/lon, nearest first."""
+    try:
+        lat = float_arg(request.args, 'lat', -90, 90)
+        lon = float_arg(request.args, 'lon', -180, 180)
+        radius_km = float_arg(request.args, 'radius_km', 0, SPATIAL_MAX_RADIUS_KM, default=2)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    hotels = HOTEL_INDEX.within_radius(lat, lon, radius_km, search_filters_from_args(request.args))[:SPATIAL_MAX_RESULTS]
+    return json_response({'hotels': hotels, 'total_found': len(hotels), 'center': [lat, lon], 'radius_km': radius_km})
+
+@app.route('/api/hotels/viewport')
+def get_viewport_hotels():
+    """Cached hotels inside a map viewport (south, west, north, east or bbox=s,w,n,e).
+
+    With dates and ?fill=1, up to VIEWPORT_MAX_FILL_CITIES uncached cities in view are searched first.
+    """
+    args = request.args.to_dict()
+    if 'bbox' in args:
+        args.update(zip(('south', 'west', 'north', 'east'), args.pop('bbox').split(',')))
+    try:
+        south, north = float_arg(args, 'south', -90, 90), float_arg(args, 'north', -90, 90)
+        west, east = float_arg(args, 'west', -180, 180), float_arg(args, 'east', -180, 180)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if south > north or west > east: return jsonify({'error': 'Viewport must satisfy south <= north and west <= east'}), 400
+    filters = search_filters_from_args(args)
+    catalog = CITY_CATALOG
+    cities_in_view = sorted(key for _, _, key in catalog.spatial.within_bbox(south, west, north, east))
+    if filters['checkin'] and filters['checkout']:
+        params = search_params_from_args(args)
+        params.pop('city_key')
+        def find_uncached():
+            return [key for key in cities_in_view if all(SEARCH_CACHE.peek(search_cache_key(source, dict(params, city_key=key))) is None for source in SOURCE_ADAPTERS)]
+        uncached = find_uncached()
+        if str(args.get('fill', '')).lower() in ('1', 'true') and uncached:
+            for _ in iter_batch_city_results(params, uncached[:VIEWPORT_MAX_FILL_CITIES], list(SOURCE_ADAPTERS), cities=catalog.cities):
+                pass
+            uncached = find_uncached()
+    else:
+        indexed_cities = {hotel['city_key'] for hotel in HOTEL_INDEX.within_bbox(south, west, north, east, filters)}
+        uncached = [key for key in cities_in_view if key not in indexed_cities]
+    hotels = HOTEL_INDEX.within_bbox(south, west, north, east, filters)
+    hotels = hotels[:SPATIAL_MAX_RESULTS]
+    return json_response({'hotels': hotels, 'total_found': len(hotels), 'cities_in_view': cities_in_view, 'uncached_cities': uncached})
+
+@app.route('/api/cities/nearest')
+def get_nearest_city():
+    """Nearest supported cities to lat/lon."""
+    try:
+        lat = float_arg(request.args, 'lat', -90, 90)
+        lon = float_arg(request.args, 'lon', -180, 180)
+        limit = int(float_arg(request.args, 'limit', 1, 20, default=1))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    catalog = CITY_CATALOG
+    nearest = [dict(catalog.cities[key], key=key, distance_km=round(distance, 2)) for distance, key in catalog.spatial.nearest(lat, lon, limit)]
+    return jsonify({'cities': nearest})
+
+@app.route('/api/prices/trend')
+def get_price_trend_route():
+    """Observed nightly prices for one hotel (source, hotel_id, optional checkin, nights and days)."""
+    if PRICE_HISTORY is None: return jsonify({'error': 'Price history is disabled'}), 503
+    source, hotel_id = request.args.get('source'), request.args.get('hotel_id')
+    if source not in SOURCE_ADAPTERS or not hotel_id: return jsonify({'error': f"source ({', '.join(SOURCE_ADAPTERS)}) and hotel_id are required"}), 400
+    try:
+        checkin = request.args.get('checkin')
+        if checkin: datetime.strptime(checkin, '%Y-%m-%d')
+        nights = int(float_arg(request.args, 'nights', 1, 60)) if request.args.get('nights') else None
+        days = float_arg(request.args, 'days', 1, PRICE_HISTORY_RETENTION_DAYS, default=90)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    with timed_stage('price-history'):
+        points = PRICE_HISTORY.trend(source, hotel_id, checkin, nights, since=time.time() - days * 86400)
+    prices = [point['price'] for point in points]
+    summary = {'observations': len(points)}
+    if prices:
+        summary.update(min=min(prices), max=max(prices), latest=prices[-1], first=prices[0], change=prices[-1] - prices[0])
+    return jsonify({'source': source, 'hotel_id': hotel_id, 'summary': summary, 'points': points})
+
+@app.route('/api/prices/percentiles')
+def get_price_percentiles_route():
+    """Nightly price percentiles for a city; pass price=X to see where a given price ranks."""
+    if PRICE_HISTORY is None: return jsonify({'error': 'Price history is disabled'}), 503
+    catalog = CITY_CATALOG
+    city = str(request.args.get('city', '')).lower()
+    city_key = catalog.resolve(city) or city
+    city_info = catalog.cities.get(city_key)
+    if city_info is None: return jsonify({'error': f"City '{city_key}' not supported"}), 400
+    try:
+        checkin = request.args.get('checkin')
+        if checkin: datetime.strptime(checkin, '%Y-%m-%d')
+        days = float_arg(request.args, 'days', 1, PRICE_HISTORY_RETENTION_DAYS, default=30)
+        price = float_arg(request.args, 'price', 0, 100000) if request.args.get('price') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    with timed_stage('price-history'):
+        prices = PRICE_HISTORY.city_prices(city_key, time.time() - days * 86400, checkin)
+    result = {'city': city_info['name'], 'samples': len(prices), 'days': days, 'checkin': checkin,
+              'percentiles': {f'p{pct}': percentile_of(prices, pct) for pct in PRICE_PERCENTILES}}
+    if price is not None and prices:
+        result['price'] = price
+        result['price_rank_pct'] = round(100 * sum(1 for value in prices if value <= price) / len(prices), 1)
+    return jsonify(result)
+
+# --- Offline Snapshots ---
+
+def next_weekend(today=None):
+    """(checkin, checkout) for the coming Friday to Sunday; from Friday on, the weekend after."""
+    today = today or datetime.now().date()
+    friday = today + timedelta(days=(4 - today.weekday()) % 7 or 7)
+    return friday.strftime('%Y-%m-%d'), (friday + timedelta(days=2)).strftime('%Y-%m-%d')
+
+def snapshot_search_params(params):
+    return {name: str(params[name]) for name in ('checkin', 'checkout', 'adults', 'rooms')}
+
+class SnapshotStore:
+    """Serves the latest exported snapshot version from memory-mapped, gzipped per-city files.
+
+    The export writes each version to its own directory and then swaps the 'current' pointer,
+    so readers pick up a new version on their next check without ever seeing a partial one.
+    Every worker maps the same files, so the page cache holds one copy per host.
+    """
+
+    def __init__(self, directory, max_age, check_seconds=5):
+        self.directory = directory
+        self.max_age = max_age
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._pointer_mtime = None
+        self._checked_at = 0.0
+        self.version = None
+        self.manifest = None
+        self._maps = {}
+        self.counters = {'served': 0, 'cold_served': 0}
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_seconds:
+            return
+        self._checked_at = now
+        pointer = os.path.join(self.directory, 'current.json')
+        try:
+            mtime = os.path.getmtime(pointer)
+            if mtime == self._pointer_mtime:
+                return
+            with open(pointer, encoding='utf-8') as infile:
+                version = json.load(infile)['version']
+            with open(os.path.join(self.directory, version, 'manifest.json'), encoding='utf-8') as infile:
+                manifest = json.load(infile)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Ignoring unreadable snapshot pointer in {self.directory}: {e}")
+            return
+        # Old maps are dropped rather than closed; a response may still be copying from one.
+        self.version, self.manifest, self._maps, self._pointer_mtime = version, manifest, {}, mtime
+        logging.info(f"Serving snapshot version {version} with {len(manifest['cities'])} cities.")
+
+    def _map(self, city_key, entry):
+        buffer = self._maps.get(city_key)
+        if buffer is None:
+            with open(os.path.join(self.directory, self.version, entry['file']), 'rb') as infile:
+                buffer = self._maps[city_key] = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        return buffer
+
+    def get(self, city_key):
+        """Returns (manifest entry, gzip bytes buffer) for a city in the current version, or None."""
+        with self._lock:
+            self._refresh()
+            entry = self.manifest['cities'].get(city_key) if self.manifest else None
+            if entry is None:
+                return None
+            try:
+                return entry, self._map(city_key, entry)
+            except (OSError, ValueError) as e:
+                logging.error(f"Snapshot file for {city_key} unreadable: {e}")
+                return None
+
+    def current_manifest(self):
+        with self._lock:
+            self._refresh()
+            return self.manifest
+
+    def recent(self, city_key):
+        """Like get, but only while the city's data is younger than max_age."""
+        snapshot = self.get(city_key)
+        if snapshot is None or time.time() - snapshot[0]['generated_at'] > self.max_age:
+            return None
+        return snapshot
+
+    def lookup(self, params):
+        """The city's snapshot if it was taken for exactly these search params and is recent enough."""
+        snapshot = self.recent(params['city_key'])
+        if snapshot is None or snapshot[0]['search_params'] != snapshot_search_params(params):
+            return None
+        return snapshot
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, version=self.version, cities=len(self.manifest['cities']) if self.manifest else 0, mapped=len(self._maps))
+
+SNAPSHOTS = SnapshotStore(SNAPSHOT_DIR, SNAPSHOT_MAX_AGE_SECONDS)
+
+def snapshot_response(snapshot, merge=False):
+    """Sends a snapshot; the stored gzip bytes go out untouched unless fields, merge or the client need decoding."""
+    entry, buffer = snapshot
+    SNAPSHOTS.counters['served'] += 1
+    if merge or requested_fields(request.args):
+        payload = json.loads(gzip.decompress(buffer[:]))
+        if merge:
+            payload['hotels'] = sorted(merge_hotel_sources([[hotel for hotel in payload['hotels'] if hotel.get('source') == SOURCE_ADAPTERS[source].label] for source in payload['sources']]),
+                                       key=lambda x: x.get('rating', 0), reverse=True)
+            payload['total_found'], payload['merged'] = len(payload['hotels']), True
+        return json_response(payload, etag=f"{entry['etag']}-{hashlib.blake2b(request.query_string, digest_size=6).hexdigest()}")
+    headers = {'ETag': f'W/"{entry["etag"]}"', 'Cache-Control': f'private, max-age={HOTEL_RESPONSE_MAX_AGE}', 'Vary': 'Accept-Encoding', 'X-Data-Source': 'snapshot'}
+    if request.if_none_match.contains_weak(entry['etag']):
+        return Response(status=304, headers=headers)
+    if request.accept_encodings['gzip']:
+        headers['Content-Encoding'] = 'gzip'
+        return Response(buffer[:], mimetype='application/json', headers=headers)
+    return Response(gzip.decompress(buffer[:]), mimetype='application/json', headers=headers)
+
+def warm_sources_in_background(city_info, params):
+    """Starts live searches for a city after a cold snapshot hit, so the next request is served live."""
+    for source in SOURCE_ADAPTERS:
+        try:
+            UPSTREAM_EXECUTOR.submit(fetch_source_hotels_helper, source, city_info, params)
+        except UpstreamCapacityError:
+            return
+
+def export_snapshots(directory, params, budget, max_parallel=SNAPSHOT_EXPORT_MAX_PARALLEL, city_keys=None, keep=SNAPSHOT_KEEP_VERSIONS, max_age=SNAPSHOT_MAX_AGE_SECONDS, log=logging.info):
+    """Crawls cities through the regular cached fetch path and writes a new snapshot version.
+
+    Searches already cached (locally or by another worker) are free; the rest are scheduled while
+    their estimated upstream calls fit in budget, and the crawl runs under an UpstreamBudget so
+    retries and extra lookups can never take it past budget requests. Cities that do not fit, or
+    whose sources all failed, keep their previous snapshot if it was taken for the same search params less than
+    max_age seconds ago.
+    Returns the new manifest.
+    """
+    cities = CITIES
+    city_keys = [key for key in (city_keys or sorted(cities)) if key in cities]
+    sources = list(SOURCE_ADAPTERS)
+    search_params = snapshot_search_params(params)
+    previous = SnapshotStore(directory, max_age, check_seconds=0)
+    previous._refresh()
+
+    scheduled, skipped, remaining = [], [], budget
+    for key in city_keys:
+        city_params = dict(params, city_key=key)
+        cost = sum(SOURCE_ADAPTERS[source].search_cost(cities[key]) for source in sources if not SEARCH_CACHE.is_fresh(search_cache_key(source, city_params)))
+        if cost <= remaining:
+            scheduled.append(key)
+            remaining -= cost
+        else:
+            skipped.append(key)
+    log(f"Snapshot export: {len(scheduled)} cities within a budget of {budget} upstream calls, {len(skipped)} over budget.")
+
+    version = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    staging = os.path.join(directory, f'.{version}.tmp')
+    os.makedirs(staging, exist_ok=True)
+    manifest = {'format': SNAPSHOT_FORMAT_VERSION, 'version': version, 'generated_at': time.time(), 'search_params': search_params, 'sources': sources, 'cities': {}, 'skipped': []}
+
+    def write_city(key, body, generated_at, partial, hotels, carried_from=None):
+        filename = f'{key}.json.gz'
+        with open(os.path.join(staging, filename), 'wb') as outfile:
+            outfile.write(body)
+        manifest['cities'][key] = {'file': filename, 'bytes': len(body), 'etag': hashlib.blake2b(body, digest_size=16).hexdigest(), 'generated_at': generated_at,
+                                   'search_params': search_params, 'hotels': hotels, 'partial': partial, **({'carried_from': carried_from} if carried_from else {})}
+
+    failed = []
+    upstream_budget = UpstreamBudget({None: budget})
+    with upstream_budget.active():
+        for result in iter_batch_city_results(params, scheduled, sources, max_parallel=max_parallel, overall_deadline=None, cities=cities):
+            key = result['city_key']
+            if all(status['status'] != 'ok' for status in result['sources'].values()):
+                failed.append(key)
+                continue
+            generated_at = time.time()
+            payload = {'city': result['city'], 'city_key': key, 'hotels': result['hotels'], 'total_found': result['total_found'], 'search_params': dict(search_params, city_key=key),
+                       'data_source': 'snapshot', 'merged': False, 'sources': result['sources'], 'partial': result['partial'],
+                       'generated_at': datetime.fromtimestamp(generated_at, timezone.utc).isoformat(timespec='seconds'), 'snapshot_version': version}
+            write_city(key, gzip.compress(dump_json_bytes(payload), compresslevel=9, mtime=0), generated_at, result['partial'], result['total_found'])
+
+    for key in skipped + failed:
+        carried = previous.recent(key)
+        if carried is not None and carried[0]['search_params'] == search_params:
+            write_city(key, carried[1][:], carried[0]['generated_at'], carried[0]['partial'], carried[0]['hotels'], carried[0].get('carried_from', previous.version))
+        else:
+            manifest['skipped'].append(key)
+
+    with open(os.path.join(staging, 'manifest.json'), 'w', encoding='utf-8') as outfile:
+        json.dump(manifest, outfile, indent=1, sort_keys=True)
+    os.replace(staging, os.path.join(directory, version))
+    pointer_tmp = os.path.join(directory, 'current.json.tmp')
+    with open(pointer_tmp, 'w', encoding='utf-8') as outfile:
+        json.dump({'version': version}, outfile)
+    os.replace(pointer_tmp, os.path.join(directory, 'current.json'))
+
+    versions = sorted(name for name in os.listdir(directory) if re.fullmatch(r'\d{8}T\d{6}Z', name))
+    for old in versions[:-keep]:
+        shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+    log(f"Snapshot {version}: {len(manifest['cities'])} cities written, {len(failed)} failed, {len(manifest['skipped'])} without a snapshot, {upstream_budget.spent()} upstream calls.")
+    return manifest
+
+@app.cli.command('export-snapshots')
+@click.option('--out', 'directory', default=SNAPSHOT_DIR, show_default=True, help='Snapshot root directory.')
+@click.option('--budget', default=SNAPSHOT_EXPORT_BUDGET, show_default=True, help='Maximum upstream calls to spend.')
+@click.option('--max-parallel', default=SNAPSHOT_EXPORT_MAX_PARALLEL, show_default=True)
+@click.option('--cities', default='', help='Comma-separated city keys (default: all).')
+@click.option('--checkin', default=None, help='Defaults to next Friday.')
+@click.option('--checkout', default=None, help='Defaults to the Sunday after checkin.')
+@click.option('--adults', default='2', show_default=True)
+@click.option('--rooms', default='1', show_default=True)
+@click.option('--keep', default=SNAPSHOT_KEEP_VERSIONS, show_default=True, help='Snapshot versions to keep.')
+@click.option('--max-age', default=SNAPSHOT_MAX_AGE_SECONDS, show_default=True, help='Seconds a city snapshot may be carried forward.')
+def export_snapshots_command(directory, budget, max_parallel, cities, checkin, checkout, adults, rooms, keep, max_age):
+    """Export per-city "next weekend" snapshots for static serving and the backend fallback tier."""
+    weekend = next_weekend()
+    params = {'checkin': checkin or weekend[0], 'checkout': checkout or weekend[1], 'adults': adults, 'rooms': rooms}
+    os.makedirs(directory, exist_ok=True)
+    city_keys = [CITY_CATALOG.resolve(key.strip().lower()) or key.strip().lower() for key in cities.split(',') if key.strip()] or None
+    manifest = export_snapshots(directory, params, budget, max_parallel, city_keys, keep, max_age, log=click.echo)
+    if PRICE_HISTORY is not None:
+        PRICE_HISTORY.flush()  # the writer thread would lose whatever is still queued at exit
+    click.echo(json.dumps({'version': manifest['version'], 'cities': len(manifest['cities']), 'skipped': manifest['skipped']}))
+
+@app.route('/api/snapshots/manifest')
+def get_snapshot_manifest_route():
+    manifest = SNAPSHOTS.current_manifest()
+    if manifest is None: return jsonify({'error': 'No snapshot has been exported'}), 404
+    return json_response(manifest, max_age=CITIES_RESPONSE_MAX_AGE)
+
+@app.route('/api/snapshots/<city_key>')
+def get_city_snapshot_route(city_key):
+    """The latest exported snapshot for a city, whatever dates it was taken for, while younger than SNAPSHOT_MAX_AGE_SECONDS."""
+    snapshot = SNAPSHOTS.recent(CITY_CATALOG.resolve(city_key.lower()) or city_key.lower())
+    if snapshot is None: return jsonify({'error': f"No recent snapshot for '{city_key}'"}), 404
+    return snapshot_response(snapshot)
+
+@app.route('/metrics')
+def get_metrics_route():
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/cache/stats')
+def get_cache_stats_route():
+    return jsonify({'search_cache': SEARCH_CACHE.stats(), 'upstream_executor': UPSTREAM_EXECUTOR.stats(),
+                    'async_upstream': ASYNC_UPSTREAM.stats() if ASYNC_UPSTREAM else None, 'daily_quota': UPSTREAM_LIMITER.quota.snapshot(), 'cache_warmer': CACHE_WARMER.stats(),
+                    'circuits': {host: breaker.snapshot() for host, breaker in CIRCUIT_BREAKERS.items()},
+                    'price_history': PRICE_HISTORY.stats() if PRICE_HISTORY else None,
+                    'shared_cache': SHARED_CACHE.stats() if SHARED_CACHE else None,
+                    'snapshots': SNAPSHOTS.stats(),
+                    'city_catalog': {'cities': len(CITY_CATALOG.cities), 'countries': len(CITY_CATALOG.by_country), 'names': len(CITY_CATALOG.by_name)}})
+
 @app.route('/test')
 def test_endpoint_route(): return jsonify({'status': 'STAYFINDR Backend v12.8 Active'})
 
@@ -0,0 +1,324 @@
+# BACKEND BEHAVIOUR CHECKS - end-to-end checks of the search features against the local fake RapidAPI server
+# Starts api-testing/fake_rapidapi.py and actionly_backend.py in-process (like benchmark.py) and checks
+# what the caches, fan-out and guards promise: cursor pagination, cross-source merge, spatial
+# lookups and distance sort, city suggest, the price calendar, snapshot fallback, cached hits under a full
+# executor, async fan-out beyond the executor's threads, input validation, retries charged to the quota
+# and the circuit breaker.
+#
+# Usage:
+#   python api-testing/behaviour_checks.py
+#   python api-testing/behaviour_checks.py --checks cursor,merge   # exits 1 if any check fails
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from benchmark import start_backend  # noqa: E402
+from fake_rapidapi import SYNTHETIC_HOTELS_PER_PAGE, SYNTHETIC_SHARED_PER_PAGE, FakeRapidAPIConfig, start_server  # noqa: E402
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def expect(condition, message):
+    if not condition:
+        raise CheckFailed(message)
+
+
+def stay(days_ahead, nights=2):
+    """Dates no other check uses, so every check starts with a cold search cache."""
+    checkin = datetime.now() + timedelta(days=days_ahead)
+    return {'checkin': checkin.strftime('%Y-%m-%d'), 'checkout': (checkin + timedelta(days=nights)).strftime('%Y-%m-%d')}
+
+
+class Checks:
+    def __init__(self, backend, backend_url, config):
+        self.backend = backend
+        self.url = backend_url
+        self.config = config
+        self.session = requests.Session()
+
+    def get(self, path, **params):
+        return self.session.get(f"{self.url}{path}", params=params, timeout=60)
+
+    def upstream_calls(self):
+        with self.config.lock:
+            return sum(count for path, count in self.config.calls.items() if ' ' not in path)
+
+    def quota_used(self, host):
+        return self.backend.UPSTREAM_LIMITER.quota.snapshot()[host]['used']
+
+    def wait_for_idle_executor(self, timeout=30):
+        """Waits out background work (e.g. a snapshot hit warming the live path) so it cannot skew call counts."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            stats = self.backend.UPSTREAM_EXECUTOR.stats()
+            if stats['active'] == 0 and stats['queued'] == 0:
+                return
+            time.sleep(0.02)
+
+    def forget_cached_searches(self, params):
+        """Drops a city's searches from this worker and the shared cache, as if they had expired."""
+        for source in self.backend.SOURCE_ADAPTERS:
+            self.backend.SEARCH_CACHE.invalidate(self.backend.search_cache_key(source, params))
+        if self.backend.SHARED_CACHE is not None:
+            with sqlite3.connect(self.backend.SHARED_CACHE_DB) as conn:
+                conn.execute("DELETE FROM entries")
+
+    def check_city_suggest(self):
+        suggestions = self.get('/api/cities/suggest', q='sto').json()['suggestions']
+        expect('stockholm' in [s['key'] for s in suggestions], f"'sto' did not suggest stockholm: {suggestions}")
+        suggestions = self.get('/api/cities/suggest', q='', country='se', limit=self.backend.CITY_SUGGEST_MAX_RESULTS).json()['suggestions']
+        expect(suggestions and all(s['country'] == 'se' for s in suggestions), f"country=se returned {suggestions}")
+        expect(len(self.get('/api/cities/suggest', q='a', limit=2).json()['suggestions']) <= 2, "limit=2 was not honoured")
+
+    def check_city_names(self):
+        dates = stay(50)
+        batch = self.get('/api/hotels/batch', cities='Düsseldorf,PALMA DE MALLORCA', **dates)
+        expect(batch.status_code == 200 and sorted(batch.json()['cities']) == ['dusseldorf', 'palmademallorca'] and not batch.json()['unsupported'],
+               f"batch by city name answered {batch.status_code}: {batch.text[:200]}")
+        calendar = self.get('/api/calendar', city='Palma de Mallorca', start=dates['checkin'], end=dates['checkin'])
+        expect(calendar.status_code == 200 and calendar.json()['city'] == 'Palma de Mallorca', f"calendar by city name answered {calendar.status_code}")
+        percentiles = self.get('/api/prices/percentiles', city='düsseldorf')
+        expect(percentiles.status_code == 200 and percentiles.json()['city'] == 'Düsseldorf', f"percentiles by city name answered {percentiles.status_code}")
+
+    def check_bad_dates(self):
+        before = self.upstream_calls()
+        for params in ({'checkin': '2026-13-01'}, {'checkin': 'tomorrow'}, dict(stay(40), checkout=stay(40)['checkin'])):
+            response = self.get('/api/hotels/dual', city='paris', **params)
+            expect(response.status_code == 400, f"{params} answered {response.status_code}, expected 400")
+        expect(self.upstream_calls() == before, "rejected dates still called upstream")
+
+    def check_batch_body(self):
+        for body in ([{'cities': ['paris']}], 'paris', {'cities': 5}):
+            response = self.session.post(f"{self.url}/api/hotels/batch", json=body, timeout=60)
+            expect(response.status_code == 400, f"batch body {body!r} answered {response.status_code}, expected 400")
+
+    def check_cursor(self):
+        first = self.get('/api/hotels/search', city='stockholm', limit=20, **stay(41)).json()
+        seen, cursor, pages = [hotel['id'] for hotel in first['hotels']], first['next_cursor'], 1
+        expect(cursor, "the first page had no next_cursor")
+        while cursor:
+            page = self.get('/api/hotels/search', cursor=cursor, limit=20).json()
+            seen += [hotel['id'] for hotel in page['hotels']]
+            cursor, pages = page['next_cursor'], pages + 1
+        expect(len(seen) == first['total_found'], f"paged through {len(seen)} of {first['total_found']} hotels in {pages} pages")
+        before = self.upstream_calls()
+        for tampered in (first['next_cursor'][:-2] + ('AA' if not first['next_cursor'].endswith('AA') else 'BB'), 'not-a-cursor'):
+            response = self.get('/api/hotels/search', cursor=tampered)
+            expect(response.status_code == 400, f"tampered cursor answered {response.status_code}, expected 400")
+        expect(self.upstream_calls() == before, "tampered cursors called upstream")
+
+    def check_merge(self):
+        same = [[{'id': 1, 'name': 'Grand Hotel Stockholm', 'coordinates': [59.3294, 18.0753], 'price': 210, 'rating': 8.8, 'source': 'booking.com', 'booking_url': 'b'}],
+                [{'id': 'x', 'name': 'The Grand Stockholm', 'coordinates': [59.3295, 18.0751], 'price': 190, 'rating': 9.0, 'source': 'tripadvisor', 'booking_url': 't'},
+                 {'id': 'y', 'name': 'Hostel Nord', 'coordinates': [59.34, 18.06], 'price': 40, 'rating': 7.0, 'source': 'tripadvisor', 'booking_url': 'h'}]]
+        merged = self.backend.merge_hotel_sources(same)
+        expect(len(merged) == 2, f"expected 2 merged hotels, got {len(merged)}")
+        grand = next(hotel for hotel in merged if len(hotel['sources']) == 2)
+        expect(grand['price'] == 190 and grand['cheapest']['source'] == 'tripadvisor', f"merged record kept the wrong price: {grand['cheapest']}")
+        params = dict(city='rome', **stay(42))
+        plain = self.get('/api/hotels/dual', **params).json()
+        response = self.get('/api/hotels/dual', merge=1, **params)
+        expect(response.status_code == 200, f"dual merge answered {response.status_code}")
+        hotels = response.json()['hotels']
+        # The fake lists the same properties on both sources from the second window onwards (see fake_rapidapi.py)
+        booking_limit, tripadvisor_limit = self.backend.BOOKING_HOTEL_LIMIT, self.backend.TRIPADVISOR_HOTEL_LIMIT
+        shared = max(0, min(booking_limit - (SYNTHETIC_HOTELS_PER_PAGE - SYNTHETIC_SHARED_PER_PAGE), tripadvisor_limit))
+        both = [hotel for hotel in hotels if len(hotel['sources']) == 2]
+        expect(shared > 0 and len(both) == shared, f"expected {shared} hotels listed by both sources, got {len(both)}")
+        expect(len(hotels) == plain['total_found'] - shared, f"merged {plain['total_found']} records into {len(hotels)}, expected {plain['total_found'] - shared}")
+        expect(all(hotel['price'] == min(hotel['prices'].values()) for hotel in both), "a merged hotel does not show its cheapest offer")
+
+    def check_spatial(self):
+        city = self.backend.CITIES['vienna']
+        hotels = self.get('/api/hotels/search', city='vienna', sort='distance', pages=1, **stay(48)).json()['hotels']
+        distances = [hotel['distance_km'] for hotel in hotels]
+        expect(distances and None not in distances, "sort=distance returned hotels without distance_km")
+        expect(distances == sorted(distances) and distances[-1] < 6, f"hotels are not sorted by distance from the centre: {distances[:3]}..{distances[-1:]}")
+        nearby = self.get('/api/hotels/nearby', lat=city['lat'], lon=city['lon'], radius_km=2).json()['hotels']
+        expect(nearby and all(hotel['city_key'] == 'vienna' for hotel in nearby), f"/nearby around vienna found {len(nearby)} vienna hotels")
+        nearby_distances = [hotel['distance_km'] for hotel in nearby]
+        expect(nearby_distances == sorted(nearby_distances) and nearby_distances[-1] <= 2, "/nearby is not nearest first within the radius")
+        box = self.get('/api/hotels/viewport', south=city['lat'] - 0.01, west=city['lon'] - 0.01, north=city['lat'] + 0.01, east=city['lon'] + 0.01).json()
+        inside = [hotel for hotel in box['hotels'] if abs(hotel['coordinates'][0] - city['lat']) <= 0.01 and abs(hotel['coordinates'][1] - city['lon']) <= 0.01]
+        expect(box['hotels'] and len(inside) == len(box['hotels']) and 'vienna' in box['cities_in_view'], f"/viewport around vienna returned {len(box['hotels'])} hotels, {len(inside)} inside")
+
+    def check_calendar(self):
+        dates = stay(43)
+        start = datetime.strptime(dates['checkin'], '%Y-%m-%d')
+        end = (start + timedelta(days=2)).strftime('%Y-%m-%d')
+        calendar = self.get('/api/calendar', city='berlin', start=dates['checkin'], end=end).json()
+        checkins = [day['checkin'] for day in calendar['days']]
+        expect(checkins == [(start + timedelta(days=offset)).strftime('%Y-%m-%d') for offset in range(3)], f"calendar days {checkins}")
+        cheapest = min(day['cheapest'] for day in calendar['days'] if day['cheapest'] is not None)
+        expect(next(day for day in calendar['days'] if day['checkin'] == calendar['cheapest_day'])['cheapest'] == cheapest, "cheapest_day is not the cheapest")
+        before = self.upstream_calls()
+        again = self.get('/api/calendar', city='berlin', start=dates['checkin'], end=end).json()
+        expect(self.upstream_calls() == before and all(day['cached'] for day in again['days']), "a repeated calendar called upstream")
+        past = self.get('/api/calendar', city='berlin', start=(datetime.now() - timedelta(days=3)).strftime('%Y-%m-%d'), end=dates['checkin'])
+        expect(past.status_code == 400 and self.upstream_calls() == before, f"a calendar starting in the past answered {past.status_code}, expected 400 without upstream calls")
+
+    def check_cached_hit_with_full_executor(self):
+        params = dict(city='madrid', **stay(44))
+        expect(self.get('/api/hotels/dual', **params).status_code == 200, "warming the cache failed")
+        gate, blockers = threading.Event(), []
+        try:
+            while True:
+                blockers.append(self.backend.UPSTREAM_EXECUTOR.submit(gate.wait, 30))
+        except self.backend.UpstreamCapacityError:
+            pass
+        try:
+            for path in ('/api/hotels/dual', '/api/hotels/booking', '/api/hotels/search'):
+                response = self.get(path, **params)
+                expect(response.status_code == 200, f"cached {path} answered {response.status_code} with the executor full")
+            response = self.get('/api/hotels/booking', city='lisbon', **stay(44))
+            expect(response.status_code == 503, f"an uncached search answered {response.status_code} with the executor full, expected 503")
+        finally:
+            gate.set()
+            for blocker in blockers:
+                blocker.result()
+
+    def check_async_fanout(self):
+        if self.backend.ASYNC_UPSTREAM is None:
+            print("   (skipped: async upstream off or httpx not installed)")
+            return
+        cities = sorted(self.backend.CITIES)[:self.backend.UPSTREAM_MAX_CONCURRENCY]
+        for key in cities:
+            self.backend.BOOKING_LOCATION_INDEX.lookup(self.backend.CITIES[key])  # the search itself needs no auto-complete
+        gate, blockers, peak, latency = threading.Event(), [], [0], self.config.latency_ms
+        try:
+            while True:
+                blockers.append(self.backend.UPSTREAM_EXECUTOR.submit(gate.wait, 30))
+        except self.backend.UpstreamCapacityError:
+            pass
+        def watch():
+            while not gate.is_set():
+                peak[0] = max(peak[0], self.backend.ASYNC_UPSTREAM.stats()['active'])
+                time.sleep(0.005)
+        watcher = threading.Thread(target=watch, daemon=True)
+        self.config.latency_ms = 300
+        try:
+            watcher.start()
+            with ThreadPoolExecutor(len(cities)) as pool:
+                responses = list(pool.map(lambda key: requests.get(f"{self.url}/api/hotels/dual", params=dict(city=key, **stay(49)), timeout=60), cities))
+        finally:
+            self.config.latency_ms = latency
+            gate.set()
+            for blocker in blockers:
+                blocker.result()
+            watcher.join()
+        failed = [(key, response.status_code) for key, response in zip(cities, responses) if response.status_code != 200 or response.json()['partial']]
+        expect(not failed, f"uncached dual searches failed with the executor full: {failed}")
+        expect(peak[0] > self.backend.UPSTREAM_MAX_CONCURRENCY, f"at most {peak[0]} searches were in flight, not more than the {self.backend.UPSTREAM_MAX_CONCURRENCY} executor threads")
+
+    def check_snapshot_fallback(self):
+        dates = stay(45)
+        params = dict(dates, adults='2', rooms='1')
+        self.backend.export_snapshots(self.backend.SNAPSHOT_DIR, params, budget=10, city_keys=['vienna'], log=lambda message: None)
+        self.backend.SNAPSHOTS.check_seconds = 0
+        self.forget_cached_searches(dict(params, city_key='vienna'))
+        self.config.error_rate = 1.0
+        try:
+            response = self.get('/api/hotels/dual', city='vienna', **dates)
+            self.wait_for_idle_executor()
+        finally:
+            self.config.error_rate = 0.0
+        expect(response.status_code == 200, f"cold dual answered {response.status_code}")
+        expect(response.headers.get('X-Data-Source') == 'snapshot', "a cold search with a down upstream was not served from the snapshot")
+        expect(response.json()['total_found'] > 0, "the snapshot had no hotels")
+
+    def check_retries_charge_quota(self):
+        host = self.backend.TRIPADVISOR_API_HOST
+        calls, used = self.upstream_calls(), self.quota_used(host)
+        self.config.error_rate = 1.0
+        try:
+            self.get('/api/hotels/tripadvisor', city='prague', **stay(46))
+        finally:
+            self.config.error_rate = 0.0
+        sent, charged = self.upstream_calls() - calls, self.quota_used(host) - used
+        expect(sent == 1 + self.backend.UPSTREAM_MAX_RETRIES, f"{sent} upstream attempts, expected {1 + self.backend.UPSTREAM_MAX_RETRIES}")
+        expect(charged == sent, f"{sent} upstream attempts but {charged} charged to the daily quota")
+
+    def check_circuit_breaker(self):
+        breaker = self.backend.CIRCUIT_BREAKERS[self.backend.TRIPADVISOR_API_HOST]
+        cities = sorted(self.backend.CITIES)
+        self.config.error_rate = 1.0
+        try:
+            for index, city in enumerate(cities[:self.backend.CIRCUIT_WINDOW]):
+                self.get('/api/hotels/tripadvisor', city=city, **stay(47))
+                if breaker.state == 'open':
+                    break
+            expect(breaker.state == 'open', f"the breaker is {breaker.state} after {index + 1} failing searches")
+            before = self.upstream_calls()
+            self.get('/api/hotels/tripadvisor', city=cities[-1], **stay(47))
+            expect(self.upstream_calls() == before, "an open circuit still called upstream")
+        finally:
+            self.config.error_rate = 0.0
+
+
+CHECKS = {
+    'suggest': Checks.check_city_suggest,
+    'city-names': Checks.check_city_names,
+    'dates': Checks.check_bad_dates,
+    'batch-body': Checks.check_batch_body,
+    'cursor': Checks.check_cursor,
+    'merge': Checks.check_merge,
+    'spatial': Checks.check_spatial,
+    'calendar': Checks.check_calendar,
+    'full-executor': Checks.check_cached_hit_with_full_executor,
+    'async-fanout': Checks.check_async_fanout,
+    'snapshot': Checks.check_snapshot_fallback,
+    'retries': Checks.check_retries_charge_quota,
+    'circuit': Checks.check_circuit_breaker,  # last: it leaves the TripAdvisor circuit open
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Behaviour checks for the ACTIONLY backend against the fake RapidAPI server.')
+    parser.add_argument('--checks', default=','.join(CHECKS), help='comma-separated checks to run')
+    parser.add_argument('--latency-ms', type=float, default=20)
+    args = parser.parse_args()
+    selected = [name.strip() for name in args.checks.split(',') if name.strip()]
+    unknown = [name for name in selected if name not in CHECKS]
+    if unknown:
+        parser.error(f"unknown checks: {', '.join(unknown)}")
+
+    config = FakeRapidAPIConfig(args.latency_ms, 0)
+    _, fake_base_url = start_server(config)
+    workdir = tempfile.mkdtemp(prefix='actionly-checks-')
+    os.environ.update({'SNAPSHOT_DIR': os.path.join(workdir, 'snapshots'), 'CITY_CATALOG_WATCH': '0'})
+    os.environ.setdefault('UPSTREAM_BACKOFF_FACTOR', '0.01')
+    backend, backend_url = start_backend(fake_base_url, workdir)
+    checks = Checks(backend, backend_url, config)
+
+    print(f"🔎 Behaviour checks: backend {backend_url}, fake upstream {fake_base_url}")
+    failures = 0
+    for name in selected:
+        started = time.perf_counter()
+        try:
+            CHECKS[name](checks)
+            print(f"✅ {name} ({(time.perf_counter() - started) * 1000:.0f} ms)")
+        except (CheckFailed, requests.RequestException, KeyError, ValueError) as e:
+            failures += 1
+            print(f"❌ {name}: {e}")
+    if failures:
+        print(f"❌ {failures} of {len(selected)} checks failed")
+        sys.exit(1)
+    print(f"✅ All {len(selected)} checks passed")
+
+
+if __name__ == '__main__':
+    main()
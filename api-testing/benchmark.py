@@ -0,0 +1,182 @@
+# BACKEND LOAD BENCHMARK - drives the hotel endpoints against the local fake RapidAPI server
+# Starts api-testing/fake_rapidapi.py and actionly_backend.py in-process, hits
+# /api/hotels/booking, /api/hotels/tripadvisor and /api/hotels/dual at fixed concurrency levels
+# and reports throughput, p50/p95/p99 latency and upstream call counts.
+#
+# Usage:
+#   python api-testing/benchmark.py --save-baseline api-testing/benchmark_baseline.json
+#   python api-testing/benchmark.py --baseline api-testing/benchmark_baseline.json   # exits 1 on regression
+#
+# benchmark_baseline.json is committed, recorded with the default settings. CI runs the --baseline
+# form on the runner class that recorded it. Re-save it when that runner or the expected numbers change.
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from fake_rapidapi import FakeRapidAPIConfig, start_server  # noqa: E402
+
+DEFAULT_ENDPOINTS = ['/api/hotels/booking', '/api/hotels/tripadvisor', '/api/hotels/dual']
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def start_backend(fake_base_url, workdir):
+    """Imports the backend wired to the fake upstream and serves it on a local port."""
+    os.environ.setdefault('RAPIDAPI_KEY', 'benchmark')
+    os.environ.update({
+        'BOOKING_API_BASE_URL': fake_base_url,
+        'TRIPADVISOR_API_BASE_URL': fake_base_url,
+        'BOOKING_LOCATION_INDEX_FILE': os.path.join(workdir, 'booking_location_ids.json'),
+        'BOOKING_LOCATION_INDEX_BACKGROUND': '0',
+        'CACHE_WARMER_ENABLED': '0',
+        'PRICE_HISTORY_DB': os.path.join(workdir, 'price_history.sqlite3'),
+        'SHARED_CACHE_DB': os.path.join(workdir, 'shared_cache.sqlite3'),
+    })
+    # The benchmark measures the backend, not the quota guards, unless asked to.
+    for name in ('BOOKING_RATE_PER_SECOND', 'TRIPADVISOR_RATE_PER_SECOND'):
+        os.environ.setdefault(name, '100000')
+    for name in ('BOOKING_RATE_BURST', 'TRIPADVISOR_RATE_BURST'):
+        os.environ.setdefault(name, '100000')
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+    import logging
+    import actionly_backend
+    from werkzeug.serving import make_server
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, actionly_backend.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='backend', daemon=True).start()
+    return actionly_backend, f"http://127.0.0.1:{server.server_port}"
+
+
+def run_scenario(backend_url, fake_base_url, endpoint, concurrency, total_requests, city_keys, checkin):
+    checkout = (datetime.strptime(checkin, '%Y-%m-%d') + timedelta(days=2)).strftime('%Y-%m-%d')
+    sessions = threading.local()
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def one(i):
+        session = getattr(sessions, 'session', None) or requests.Session()
+        sessions.session = session
+        params = {'city': city_keys[i % len(city_keys)], 'checkin': checkin, 'checkout': checkout}
+        started = time.perf_counter()
+        try:
+            response = session.get(f"{backend_url}{endpoint}", params=params, timeout=60)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors.append(i)
+
+    before = requests.get(f"{fake_base_url}/_stats", timeout=5).json()['calls']
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total_requests)))
+    wall = time.perf_counter() - started
+    after = requests.get(f"{fake_base_url}/_stats", timeout=5).json()['calls']
+
+    latencies.sort()
+    upstream_calls = sum(count for path, count in after.items() if ' ' not in path) - sum(count for path, count in before.items() if ' ' not in path)
+    return {
+        'endpoint': endpoint, 'concurrency': concurrency, 'requests': total_requests, 'errors': len(errors),
+        'throughput_rps': round(total_requests / wall, 1),
+        'p50_ms': round(percentile(latencies, 50), 1), 'p95_ms': round(percentile(latencies, 95), 1), 'p99_ms': round(percentile(latencies, 99), 1),
+        'upstream_calls': upstream_calls,
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Returns human-readable regressions of results against a saved baseline."""
+    previous = {(r['endpoint'], r['concurrency']): r for r in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        old = previous.get((result['endpoint'], result['concurrency']))
+        if not old:
+            continue
+        label = f"{result['endpoint']} @ c={result['concurrency']}"
+        if result['p95_ms'] > old['p95_ms'] * (1 + tolerance) + 5:
+            regressions.append(f"{label}: p95 {result['p95_ms']} ms vs baseline {old['p95_ms']} ms")
+        if result['throughput_rps'] < old['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{label}: throughput {result['throughput_rps']} rps vs baseline {old['throughput_rps']} rps")
+        if result['upstream_calls'] > old['upstream_calls'] * (1 + tolerance) + 2:
+            regressions.append(f"{label}: {result['upstream_calls']} upstream calls vs baseline {old['upstream_calls']}")
+        if result['errors'] > old['errors']:
+            regressions.append(f"{label}: {result['errors']} errors vs baseline {old['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load benchmark for the ACTIONLY hotel endpoints.')
+    parser.add_argument('--endpoints', default=','.join(DEFAULT_ENDPOINTS))
+    parser.add_argument('--concurrency', default='1,8,32', help='comma-separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--cities', type=int, default=10, help='number of distinct cities per scenario')
+    parser.add_argument('--latency-ms', type=float, default=150)
+    parser.add_argument('--jitter-ms', type=float, default=40)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--fixtures', help='directory with recorded payloads for the fake server')
+    parser.add_argument('--baseline', help='fail if results regress against this baseline file')
+    parser.add_argument('--save-baseline', help='write results to this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+    args = parser.parse_args()
+
+    config = FakeRapidAPIConfig(args.latency_ms, args.jitter_ms, args.error_rate, fixtures_dir=args.fixtures)
+    _, fake_base_url = start_server(config)
+    workdir = tempfile.mkdtemp(prefix='actionly-bench-')
+    backend, backend_url = start_backend(fake_base_url, workdir)
+    city_keys = sorted(backend.CITIES)[:args.cities]
+
+    print(f"🏁 Benchmark: backend {backend_url}, fake upstream {fake_base_url} ({args.latency_ms}±{args.jitter_ms} ms)")
+    print(f"{'endpoint':<26}{'conc':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'upstream':>10}{'errors':>8}")
+    results = []
+    scenario = 0
+    for endpoint in [e.strip() for e in args.endpoints.split(',') if e.strip()]:
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            # Each scenario uses its own dates, so it starts with a cold result cache.
+            checkin = (datetime.now() + timedelta(days=30 + scenario)).strftime('%Y-%m-%d')
+            scenario += 1
+            result = run_scenario(backend_url, fake_base_url, endpoint, concurrency, args.requests, city_keys, checkin)
+            results.append(result)
+            print(f"{endpoint:<26}{concurrency:>6}{result['throughput_rps']:>9}{result['p50_ms']:>9}{result['p95_ms']:>9}"
+                  f"{result['p99_ms']:>9}{result['upstream_calls']:>10}{result['errors']:>8}")
+
+    report = {'created': datetime.now().isoformat(timespec='seconds'), 'settings': vars(args), 'results': results}
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as outfile:
+            json.dump(report, outfile, indent=2)
+        print(f"💾 Baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as infile:
+            regressions = compare_to_baseline(results, json.load(infile), args.tolerance)
+        if regressions:
+            print("❌ Performance regressions:")
+            for regression in regressions:
+                print(f"   - {regression}")
+            sys.exit(1)
+        print("✅ No regressions against baseline")
+
+
+if __name__ == '__main__':
+    main()
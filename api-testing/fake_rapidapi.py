@@ -0,0 +1,247 @@
+# FAKE RAPIDAPI SERVER - local stand-in for Booking.com (booking-com18) and TripAdvisor (tripadvisor16)
+# Serves stays/auto-complete, stays/search and api/v1/hotels/searchHotels with configurable
+# latency, jitter and error rates, so the backend can be benchmarked without touching quota.
+#
+# Usage:
+#   python api-testing/fake_rapidapi.py --port 8099 --latency-ms 300 --jitter-ms 100 --error-rate 0.02
+#   BOOKING_API_BASE_URL=http://127.0.0.1:8099 TRIPADVISOR_API_BASE_URL=http://127.0.0.1:8099 python actionly_backend.py
+#
+# Recorded payloads: pass --fixtures DIR containing auto-complete.json, stays-search.json and/or
+# searchHotels.json (raw API responses) and they are replayed verbatim; otherwise deterministic
+# synthetic payloads with the same shape are generated per location. Synthetic hotels sit around
+# the city's centre from cities.csv, and both sources list the same properties with offset
+# windows: on every page the last SYNTHETIC_SHARED_PER_PAGE Booking hotels are the first
+# TripAdvisor ones, under the same name and within a few metres, so cross-source merges happen.
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FIXTURE_FILES = {
+    '/stays/auto-complete': 'auto-complete.json',
+    '/stays/search': 'stays-search.json',
+    '/api/v1/hotels/searchHotels': 'searchHotels.json',
+}
+SYNTHETIC_HOTELS_PER_PAGE = 25
+SYNTHETIC_SHARED_PER_PAGE = 15  # TripAdvisor's window starts this many hotels before Booking's ends
+SYNTHETIC_RADIUS_DEGREES = 0.03  # ~3 km around the city centre
+DEFAULT_CITIES_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cities.csv')
+NAME_WORDS = ('Grand', 'Royal', 'Harbour', 'Central', 'Park', 'Garden', 'Old Town', 'River', 'Station', 'Plaza', 'Opera', 'Cathedral', 'Market', 'Bridge', 'Castle', 'Lake')
+NAME_KINDS = ('Palace', 'Lodge', 'House', 'Residence', 'Quarters', 'Court', 'Manor', 'Loft', 'Rooms', 'Retreat', 'Tower', 'Gallery')
+
+
+class FakeRapidAPIConfig:
+    """Latency/error behaviour plus call counters shared by all handler threads."""
+
+    def __init__(self, latency_ms=200, jitter_ms=50, error_rate=0.0, rate_limit_rate=0.0, fixtures_dir=None, seed=42, cities_file=DEFAULT_CITIES_FILE):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.fixtures = {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.centres = load_city_centres(cities_file)
+        if fixtures_dir:
+            for path, filename in FIXTURE_FILES.items():
+                fixture_path = os.path.join(fixtures_dir, filename)
+                if os.path.exists(fixture_path):
+                    with open(fixture_path, encoding='utf-8') as infile:
+                        self.fixtures[path] = infile.read().encode('utf-8')
+
+    def count(self, key):
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def draw(self):
+        """Returns (delay_seconds, forced_status or None) for one request."""
+        with self.lock:
+            delay = max(0.0, self.random.gauss(self.latency_ms, self.jitter_ms)) / 1000 if self.jitter_ms else self.latency_ms / 1000
+            roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            return delay, 429
+        if roll < self.rate_limit_rate + self.error_rate:
+            return delay, 503
+        return delay, None
+
+
+def _seeded(*parts):
+    return random.Random(int(hashlib.md5('|'.join(map(str, parts)).encode()).hexdigest()[:12], 16))
+
+
+def booking_location_id(query):
+    return f"LOC-{query.replace(' ', '-')}"
+
+
+def load_city_centres(path):
+    """Maps Booking location ids and TripAdvisor geoIds to (city_key, lat, lon) from the backend's city list."""
+    centres = {'booking': {}, 'tripadvisor': {}}
+    if not path or not os.path.exists(path):
+        return centres
+    with open(path, encoding='utf-8') as infile:
+        for row in csv.DictReader(infile):
+            try:
+                centre = (row['key'], float(row['lat']), float(row['lon']))
+            except (KeyError, TypeError, ValueError):
+                continue
+            if row.get('search_query'):
+                centres['booking'][booking_location_id(row['search_query'])] = centre
+            if row.get('tripadvisor_id'):
+                centres['tripadvisor'][row['tripadvisor_id']] = centre
+    return centres
+
+
+def synthetic_property(city, lat, lon, index):
+    """The index-th hotel of a city, identical whichever source lists it."""
+    rng = _seeded('property', city, index)
+    words = list(NAME_WORDS)
+    _seeded('names', city).shuffle(words)
+    name = f"{words[index % len(NAME_WORDS)]} {NAME_KINDS[(index // len(NAME_WORDS)) % len(NAME_KINDS)]}"
+    if index >= len(NAME_WORDS) * len(NAME_KINDS):
+        name += f" {index}"
+    return {'name': name, 'district': f"District {index % 7}",
+            'latitude': lat + rng.uniform(-SYNTHETIC_RADIUS_DEGREES, SYNTHETIC_RADIUS_DEGREES),
+            'longitude': lon + rng.uniform(-SYNTHETIC_RADIUS_DEGREES, SYNTHETIC_RADIUS_DEGREES),
+            'rating': rng.uniform(0.6, 0.98)}
+
+
+def _centre(centres, location):
+    """A known city's centre, or a made-up one somewhere in Europe for unknown locations."""
+    if location in centres:
+        return centres[location]
+    rng = _seeded('centre', location)
+    return location, rng.uniform(40, 60), rng.uniform(-5, 25)
+
+
+def synthetic_auto_complete(query):
+    name, _, country = query.rpartition(' ')
+    return {'data': [{'id': booking_location_id(query), 'name': name or query, 'cc1': country.lower() or 'com', 'dest_type': 'city'}]}
+
+
+def synthetic_booking_search(location_id, checkin, checkout, page, centres=None):
+    city, lat, lon = _centre((centres or {}).get('booking', {}), location_id)
+    hotels = []
+    for i in range(SYNTHETIC_HOTELS_PER_PAGE):
+        index = (page - 1) * SYNTHETIC_HOTELS_PER_PAGE + i
+        hotel = synthetic_property(city, lat, lon, index)
+        price_rng = _seeded('booking-price', city, index, checkin, checkout)
+        hotels.append({
+            'id': index + 1, 'name': hotel['name'], 'address': f"Street {index + 1}, {hotel['district']}",
+            'latitude': hotel['latitude'], 'longitude': hotel['longitude'],
+            'reviewScore': round(hotel['rating'] * 10, 1),
+            'priceBreakdown': {'grossPrice': {'value': round(price_rng.uniform(60, 400), 2)}},
+            'url': f"https://www.booking.com/hotel/fake/{city}-{index + 1}.html",
+        })
+    return {'data': hotels}
+
+
+def synthetic_tripadvisor_search(geo_id, checkin, checkout, page, centres=None):
+    city, lat, lon = _centre((centres or {}).get('tripadvisor', {}), geo_id)
+    offset = SYNTHETIC_HOTELS_PER_PAGE - SYNTHETIC_SHARED_PER_PAGE
+    hotels = []
+    for i in range(SYNTHETIC_HOTELS_PER_PAGE):
+        index = (page - 1) * SYNTHETIC_HOTELS_PER_PAGE + offset + i
+        hotel = synthetic_property(city, lat, lon, index)
+        jitter = _seeded('tripadvisor-position', city, index)
+        price_rng = _seeded('tripadvisor-price', city, index, checkin, checkout)
+        hotel_id = str(int(geo_id) * 1000 + index + 1) if str(geo_id).isdigit() else f"{geo_id}-{index + 1}"
+        hotels.append({
+            'id': hotel_id, 'title': f"{i + 1}. {hotel['name']}", 'secondaryInfo': hotel['district'],
+            'geoSummary': {'latitude': hotel['latitude'] + jitter.uniform(-0.0002, 0.0002), 'longitude': hotel['longitude'] + jitter.uniform(-0.0002, 0.0002)},
+            'bubbleRating': {'rating': round(hotel['rating'] * 10) / 2},
+            'priceForDisplay': f"€{int(price_rng.uniform(60, 400))}",
+            'commerceInfo': {'externalUrl': f"https://www.tripadvisor.com/Hotel_Review-fake-{hotel_id}"},
+        })
+    return {'data': {'data': hotels}}
+
+
+def make_handler(config):
+    class FakeRapidAPIHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _send(self, status, payload):
+            body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if url.path == '/_stats':
+                with config.lock:
+                    return self._send(200, {'calls': dict(config.calls)})
+            if url.path == '/_reset':
+                with config.lock:
+                    config.calls.clear()
+                return self._send(200, {'reset': True})
+            if url.path not in FIXTURE_FILES:
+                return self._send(404, {'message': f"Unknown endpoint {url.path}"})
+
+            config.count(url.path)
+            delay, forced_status = config.draw()
+            time.sleep(delay)
+            if forced_status:
+                config.count(f"{url.path} {forced_status}")
+                return self._send(forced_status, {'message': 'Injected failure'})
+            if url.path in config.fixtures:
+                return self._send(200, config.fixtures[url.path])
+
+            page = int(query.get('page') or query.get('pageNumber') or 1)
+            if url.path == '/stays/auto-complete':
+                payload = synthetic_auto_complete(query.get('query', ''))
+            elif url.path == '/stays/search':
+                payload = synthetic_booking_search(query.get('locationId', ''), query.get('checkinDate'), query.get('checkoutDate'), page, config.centres)
+            else:
+                payload = synthetic_tripadvisor_search(query.get('geoId', '0'), query.get('checkIn'), query.get('checkOut'), page, config.centres)
+            self._send(200, payload)
+
+        def log_message(self, *args):
+            pass
+
+    return FakeRapidAPIHandler
+
+
+def start_server(config, host='127.0.0.1', port=0):
+    """Starts the fake server on a daemon thread and returns (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-rapidapi', daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local RapidAPI stand-in for the ACTIONLY backend.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency-ms', type=float, default=200)
+    parser.add_argument('--jitter-ms', type=float, default=50)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 503')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--fixtures', help='directory with recorded payloads to replay')
+    parser.add_argument('--cities', default=DEFAULT_CITIES_FILE, help='city list whose centres synthetic hotels are placed around')
+    args = parser.parse_args()
+
+    config = FakeRapidAPIConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate, args.fixtures, cities_file=args.cities)
+    server, base_url = start_server(config, args.host, args.port)
+    print(f"🧪 Fake RapidAPI listening on {base_url} (latency {args.latency_ms}±{args.jitter_ms} ms, "
+          f"errors {args.error_rate:.0%}, 429s {args.rate_limit_rate:.0%})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()